@@ -6,9 +6,9 @@
 
 import sublime, sublime_plugin
 
-from threading import Timer, Lock
-from .complete.complete import find_uses, get_completions, get_diagnostics, get_definition, get_type, reparse, free_tu, free_all
-import os, re, sys, bisect, json, fnmatch, functools
+from threading import Timer, Lock, Thread, Condition
+from .complete.complete import find_uses, get_completions_async, get_diagnostics, get_definition, get_type, get_usr, get_annotations, get_includer, get_included_files, reparse, prefetch, cancel_prefetch, free_tu, free_all, set_cache_budget, set_ast_cache, set_fast_parse, set_shared_pch, get_shared_pch, set_server, get_metrics, get_buffer_change_count, set_buffer, edit_buffer, clear_buffer, index_file, find_indexed_uses, find_indexed_definition, find_indexed_symbols
+import os, re, sys, bisect, json, fnmatch, functools, shlex, time, hashlib, socket, html, collections
 
 def get_settings():
     return sublime.load_settings("ClangComplete.sublime-settings")
@@ -27,15 +27,105 @@ def get_project_path(view):
     return ""
 
 
-def get_unsaved_buffer(view):
-    buffer = None
-    if view.is_dirty():
-        buffer = view.substr(sublime.Region(0, view.size()))
-    return buffer
-
 def debug_print(*args):
     if get_settings().get("debug", False): print(*args)
 
+# With the server setting, libclang runs in a separate process shared by every
+# window, which is started when needed and restarted if it crashes
+def update_server():
+    settings = get_settings()
+    if settings.get("server", False) and hasattr(socket, 'AF_UNIX'):
+        os.makedirs(get_cache_path(), exist_ok=True)
+        set_server(get_cache_path('server.sock'), settings.get("server_python", "python3"))
+    else: set_server(None)
+
+def update_cache_budget():
+    settings = get_settings()
+    set_cache_budget(settings.get("cache_max_translation_units", 0), settings.get("cache_max_memory", 2048))
+    ast_cache_size = settings.get("ast_cache_max_size", 1024)
+    ast_cache_path = get_cache_path('ast')
+    if ast_cache_size > 0: os.makedirs(ast_cache_path, exist_ok=True)
+    set_ast_cache(ast_cache_path, ast_cache_size)
+
+def update_backend():
+    update_server()
+    update_cache_budget()
+    set_fast_parse(get_settings().get("fast_parse", True))
+    set_shared_pch(get_settings().get("shared_pch", False))
+
+def plugin_loaded():
+    get_settings().add_on_change("clangcomplete_cache_budget", update_backend)
+    update_backend()
+
+#
+#
+# Unsaved buffers
+#
+#
+
+# The unsaved contents of each file are kept in libcomplete, tagged with the
+# view's change count. The edits made since then are recorded here, so only
+# those have to be sent over instead of the whole buffer.
+buffer_edits = {}
+buffer_edits_lock = Lock()
+max_buffer_edits = 100
+
+if hasattr(sublime_plugin, 'TextChangeListener'):
+    class ClangCompleteBufferListener(sublime_plugin.TextChangeListener):
+        def on_text_changed(self, changes):
+            view = self.buffer.primary_view()
+            if view is None: return
+            edits = [(c.a.row, c.a.col_utf8, c.b.row, c.b.col_utf8, c.str) for c in changes]
+            with buffer_edits_lock:
+                history = buffer_edits.setdefault(self.buffer.id(), [])
+                history.append((view.change_count(), view.size(), edits))
+                del history[:-max_buffer_edits]
+
+def clear_buffer_edits(view):
+    with buffer_edits_lock:
+        buffer_edits.pop(view.buffer_id(), None)
+
+# Sends the edits up to the target change count
+def send_buffer_edits(view, filename, change_count, target):
+    with buffer_edits_lock:
+        history = list(buffer_edits.get(view.buffer_id(), []))
+    index = next((i for i, h in enumerate(history) if h[0] == change_count), None)
+    if index is None or index + 1 == len(history): return False
+    for new_change_count, size, edits in history[index+1:]:
+        if new_change_count > target: break
+        if len(edits) > 0 and not edit_buffer(filename, change_count, new_change_count, edits, size): return False
+        change_count = new_change_count
+    return change_count == target
+
+# The change count of a view when it was taken, so its buffer can be synced
+# up to it from another thread while the view changes. Only the edits are
+# sent from there, and the text is copied only when they can't be.
+class BufferSnapshot(object):
+    def __init__(self, view):
+        self.change_count = view.change_count()
+        self.dirty = view.is_dirty()
+
+# Without a snapshot, the buffer is synced as it is now
+def sync_unsaved_buffer(view, snapshot=None):
+    filename = view.file_name()
+    change_count = get_buffer_change_count(filename)
+    dirty = view.is_dirty() if snapshot is None else snapshot.dirty
+    target = view.change_count() if snapshot is None else snapshot.change_count
+    if not dirty:
+        if change_count >= 0: clear_buffer(filename)
+        return
+    # libcomplete never goes back to an older buffer, so one synced from
+    # another thread is kept
+    if change_count >= target: return
+    if change_count >= 0 and send_buffer_edits(view, filename, change_count, target): return
+    # Out of sync, so send the whole buffer as it is now, which can be newer
+    # than the snapshot
+    while True:
+        change_count = view.change_count()
+        buffer = view.substr(sublime.Region(0, view.size()))
+        if change_count == view.change_count(): break
+    set_buffer(filename, change_count, buffer)
+
 #
 #
 # Retrieve options from cmake 
@@ -50,27 +140,204 @@ def parse_flags(f):
     return flags
 
 def canonicalize_path(path, root):
-    if path.startswith('-I'): return '-I'+os.path.normpath(os.path.join(root, path[2:])) # rel or abs path
+    if path.startswith('-I'): return '-I'+os.path.normpath(os.path.join(root, path[2:].strip())) # rel or abs path
     else: return path
 
-def parse_compile_commands(root, f):
-    flags = []
-    compile_commands = json.load(open(os.path.join(root, f)))
-    for obj in compile_commands:
-        for key, value in obj.items():
-            if key == "command":
-                for string in value.split()[1:]:
-                    # ninja adds local paths as -I. and -I..
-                    # make adds full paths as i flags
-                    flags.append(canonicalize_path(string, root))
-    return flags
+# Scans a json array one element at a time, so a large compile database is
+# never loaded into memory all at once
+json_separator_regex = re.compile(r'[\s,]*')
+def iter_json_array(f, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size).lstrip()
+    if not buffer.startswith('['): return
+    pos = 1
+    eof = False
+    while True:
+        pos = json_separator_regex.match(buffer, pos).end()
+        if buffer.startswith(']', pos): return
+        try:
+            obj, pos = decoder.raw_decode(buffer, pos)
+            yield obj
+        except ValueError:
+            if eof: return
+            chunk = f.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+def get_command_args(entry):
+    if 'arguments' in entry: return entry['arguments']
+    command = entry.get('command', '')
+    # shlex is slow, so only use it when there is quoting to handle
+    if '"' in command or "'" in command or '\\' in command: return shlex.split(command)
+    return command.split()
+
+output_options = ('-o', '-MF', '-MT', '-MQ')
+
+# The flags of a compile command without the compiler, the source file and
+# the outputs, which are what make each command unique
+def get_command_flags(entry, directory, filename):
+    result = []
+    skip = False
+    for arg in get_command_args(entry)[1:]:
+        if skip: skip = False
+        elif arg in output_options: skip = True
+        elif arg.startswith('-') or os.path.normpath(os.path.join(directory, arg)) != filename: result.append(arg)
+    return tuple(result)
+
+def parse_compile_commands(f, intern):
+    files = {}
+    merged = {}
+    with open(f) as stream:
+        for entry in iter_json_array(stream):
+            directory = entry.get('directory', os.path.dirname(f))
+            filename = os.path.normpath(os.path.join(directory, entry.get('file', '')))
+            key = (directory, get_command_flags(entry, directory, filename))
+            if key not in merged:
+                # ninja adds local paths as -I. and -I..
+                # make adds full paths as i flags
+                flags = tuple(canonicalize_path(flag, directory) for flag in merge_flags(key[1], []))
+                merged[key] = intern.setdefault(flags, flags)
+            files[filename] = merged[key]
+    return files
+
+source_extensions = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.m', '.mm')
+header_extensions = ('.h', '.hh', '.hpp', '.hxx', '.h++')
+quoted_string_regex = re.compile(r'"([^"]+)"')
+
+# Cmake lists the sources of the target that a flags.make belongs to in the
+# DependInfo.cmake next to it
+def parse_flags_make(f, intern):
+    merged = merge_flags(parse_flags(f), [])
+    flags = intern.setdefault(tuple(merged), tuple(merged))
+    files = {}
+    depend_info = os.path.join(os.path.dirname(f), 'DependInfo.cmake')
+    if os.path.exists(depend_info):
+        for line in open(depend_info).readlines():
+            for path in quoted_string_regex.findall(line):
+                if os.path.isabs(path) and path.endswith(source_extensions): files[os.path.normpath(path)] = flags
+    return files, flags
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class CompileDatabase(object):
+    """Maps each source file to its own compile flags, using every
+    compile_commands.json and cmake flags.make file in a build directory.
+    Each of those files is reloaded on its own when its mtime changes."""
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+        self.lock = Lock()
+        self.reload_lock = Lock()
+        self.reloading = False
+        self.build_dir_mtime = None
+        self.checked = 0
+        # Path of a database -> (mtime, {filename: flags}, target flags)
+        self.databases = None
+        self.files = {}
+        # (files, flags) so the flags are never used with a newer set of files
+        self.project_flags = None
+        self.intern = {}
+
+    def discover(self):
+        self.build_dir_mtime = get_mtime(self.build_dir)
+        result = []
+        for root, dirs, filenames in os.walk(self.build_dir):
+            for f in filenames:
+                if f.endswith(('compile_commands.json', 'flags.make')): result.append(os.path.join(root, f))
+        return result
+
+    def load(self, path):
+        if path.endswith('flags.make'): return parse_flags_make(path, self.intern)
+        else: return parse_compile_commands(path, self.intern), None
+
+    def refresh(self):
+        # Nothing can be answered before the first load, so only that one
+        # blocks the caller
+        if self.databases is None:
+            self.reload()
+            return
+        with self.lock:
+            now = time.time()
+            if self.reloading or now - self.checked < 1: return
+            self.checked = now
+            self.reloading = True
+        Thread(target=self.reload, daemon=True).start()
+
+    def reload(self):
+        with self.reload_lock:
+            try:
+                old = self.databases or {}
+                paths = list(old.keys())
+                if self.build_dir_mtime is None or get_mtime(self.build_dir) != self.build_dir_mtime: paths = self.discover()
+                changed = self.databases is None or len(paths) != len(old)
+                databases = {}
+                for path in paths:
+                    mtime = get_mtime(path)
+                    if mtime is None:
+                        changed = True
+                        continue
+                    if path in old and old[path][0] == mtime:
+                        databases[path] = old[path]
+                        continue
+                    debug_print("Loading compile flags:", path)
+                    changed = True
+                    try:
+                        files, flags = self.load(path)
+                        databases[path] = (mtime, files, flags)
+                    except Exception as e:
+                        debug_print("Failed to load compile flags:", path, e)
+                if changed:
+                    # The files are swapped in at once, since they are read
+                    # without the lock
+                    files = {}
+                    for path in sorted(databases.keys()):
+                        files.update(databases[path][1])
+                    self.files = files
+                    self.databases = databases
+            finally:
+                self.checked = time.time()
+                self.reloading = False
+
+    def get_project_flags(self):
+        databases, files = self.databases or {}, self.files
+        if self.project_flags is None or self.project_flags[0] is not files:
+            flags = []
+            # The order decides the include precedence, and is part of the
+            # AST cache key, so it has to be the same on every run
+            seen = set()
+            candidates = [databases[path][2] for path in sorted(databases.keys())] + [files[filename] for filename in sorted(files.keys())]
+            for f in candidates:
+                if f is None or f in seen: continue
+                seen.add(f)
+                flags.extend(merge_flags(f, flags))
+            self.project_flags = (files, tuple(flags))
+        return self.project_flags[1]
+
+    def get_flags(self, filename):
+        self.refresh()
+        files = self.files
+        if filename is not None:
+            filename = os.path.normpath(filename)
+            if filename in files: return files[filename]
+            # A header can use the flags of its source file
+            stem = os.path.splitext(filename)[0]
+            for ext in source_extensions:
+                if stem + ext in files: return files[stem + ext]
+        return self.get_project_flags()
+
+    def has_file(self, filename):
+        return filename is not None and os.path.normpath(filename) in self.files
 
 def merge_flags(flags, pflags):
     result = []
     def append_result(f):
         if f.startswith(('-I', '-D', '-isystem', '-include', '-isysroot', '-W', '-std', '-pthread', '-f', '-pedantic', '-arch', '-m', '-hc')):
             if f not in pflags and f not in result: result.append(f)
-        elif not f.startswith(('-O', '-o', '-c', '-g')) and f.startswith('-'): result.append(f)
+        elif not f.startswith(('-O', '-o', '-c', '-g', '-M')) and f.startswith('-'): result.append(f)
     flag = ""
     for f in flags:
         if f.startswith('-'):
@@ -108,49 +375,93 @@ def split_flags(flags, exclude_options):
     if len(std_flags) > 0: result.append(functools.reduce(max_std, std_flags))
     return result
 
-def accumulate_options(path, exclude_options):
-    flags = []
-    for root, dirs, filenames in os.walk(path):
-        for f in filenames:
-            if f.endswith('compile_commands.json'):
-               flags.extend(merge_flags(parse_compile_commands(root, f), flags))
-               return split_flags(flags, exclude_options)
-            if f.endswith('flags.make'): 
-                flags.extend(merge_flags(parse_flags(os.path.join(root, f)), flags))
-    return split_flags(flags, exclude_options)
-
-project_options = {}
+compile_databases = {}
+split_options = {}
+# (build dir, header) -> (time, source, context), see `get_header_includer`
+header_includers = {}
 
 def clear_options():
-    global project_options
-    project_options = {}
+    global compile_databases
+    global split_options
+    global header_includers
+    compile_databases = {}
+    split_options = {}
+    header_includers = {}
 
 def get_build_dir(view):
     result = get_setting(view, "build_dir", ["build"])
     if isinstance(result, str): return [result]
     else: return result 
 
-def get_options(project_path, additional_options, exclude_options, build_dirs, default_options):
-    if project_path in project_options: return project_options[project_path]
-
-    build_dir = next((build_dir for d in build_dirs for build_dir in [os.path.join(project_path, d)] if os.path.exists(build_dir)), None)
+def get_compile_database(build_dir):
+    if build_dir not in compile_databases: compile_databases[build_dir] = CompileDatabase(build_dir)
+    return compile_databases[build_dir]
+
+language_options = { '.c': 'c', '.m': 'objective-c', '.mm': 'objective-c++' }
+
+def find_build_dir(project_path, build_dirs):
+    return next((build_dir for d in build_dirs for build_dir in [os.path.join(project_path, d)] if os.path.exists(build_dir)), None)
+
+# A header is parsed like it is in a source file that includes it, with the
+# flags of that file, and after the headers the file includes before it. The
+# header can be included through other headers, so their includers are
+# followed until a source file is found.
+def find_includer(db, filename, max_depth=8):
+    context = []
+    for i in range(max_depth):
+        includer = get_includer(filename)
+        if len(includer) == 0 or includer[0] in context: return None, []
+        context = includer[1:] + context
+        if db.has_file(includer[0]): return includer[0], context
+        filename = includer[0]
+    return None, []
+
+# Once an includer is found, the header keeps it, since a different one
+# changes the args, and its tu is then parsed again from scratch. While none
+# is found, the header is looked up again after a while. The header is first
+# looked up on the async thread when its view is activated, so the editor
+# doesn't wait on it.
+def get_header_includer(db, filename):
+    key = (db.build_dir, filename)
+    now = time.time()
+    cached = header_includers.get(key)
+    if cached is not None and (cached[1] is not None or now - cached[0] < 5): return cached[1], cached[2]
+    source, context = find_includer(db, filename)
+    header_includers[key] = (now, source, context)
+    return source, context
+
+def get_options(project_path, filename, additional_options, exclude_options, build_dirs, default_options):
+    build_dir = find_build_dir(project_path, build_dirs)
     if build_dir != None:
-        project_options[project_path] = ['-x', 'c++'] + accumulate_options(build_dir, exclude_options) + additional_options
+        db = get_compile_database(build_dir)
+        context = []
+        if filename is not None and not db.has_file(filename):
+            source, context = get_header_includer(db, filename)
+            if source is not None: filename = source
+        flags = db.get_flags(filename)
+        language = 'c++'
+        if db.has_file(filename): language = language_options.get(os.path.splitext(filename)[1], 'c++')
+        key = (flags, tuple(exclude_options))
+        if key not in split_options: split_options[key] = split_flags(flags, exclude_options)
+        return ['-x', language] + split_options[key] + [arg for header in context for arg in ('-include', header)] + additional_options
     else:
-        project_options[project_path] = ['-x', 'c++'] + default_options + additional_options
-
-    # debug_print(project_path, project_options[project_path])
-    return project_options[project_path]
+        return ['-x', 'c++'] + default_options + additional_options
 
-def get_args(view):
+# The args of another file are taken with the settings of the view
+def get_args(view, filename=None):
+    if filename is None: filename = view.file_name()
     project_path = get_project_path(view)
     additional_options = get_setting(view, "additional_options", [])
     exclude_options = get_setting(view, "exclude_options", [])
     build_dir = get_build_dir(view)
     debug_print("build dirs:", build_dir)
     default_options = get_setting(view, "default_options", ["-std=c++11"])
-    debug_print(get_options(project_path, additional_options, exclude_options, build_dir, default_options))
-    return get_options(project_path, additional_options, exclude_options, build_dir, default_options)
+    options = get_options(project_path, filename, additional_options, exclude_options, build_dir, default_options)
+    if get_setting(view, "shared_pch", False) and filename is not None:
+        pch = get_shared_pch(filename, options)
+        if pch: options = options + ['-include-pch', pch]
+    debug_print(options)
+    return options
 
 #
 #
@@ -177,70 +488,188 @@ def bisect_right_prefix(a, x, lo=0, hi=None):
 def find_prefix(items, prefix):
     return items[bisect.bisect_left(items, prefix): bisect_right_prefix(items, prefix)]
 
-project_includes = {}
-includes_lock = Lock()
+def get_cache_path(*paths):
+    return os.path.join(sublime.cache_path(), 'ClangComplete', *paths)
+
+def save_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = path + '.tmp'
+    with open(temp, 'w') as f: json.dump(data, f)
+    os.replace(temp, path)
 
-def clear_includes_impl():
-    global project_includes
-    if includes_lock.acquire(timeout=10000):
-        project_includes = {}
-        includes_lock.release()
+def list_dir(path):
+    result = []
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False): result.append(entry.name + '/')
+            else: result.append(entry.name)
     else:
-        debug_print("Can't clear includes")
+        for name in os.listdir(path):
+            full_name = os.path.join(path, name)
+            if os.path.isdir(full_name) and not os.path.islink(full_name): result.append(name + '/')
+            else: result.append(name)
+    return sorted(result)
+
+class IncludeIndex(object):
+    """The files and directories below one include search path, shared by
+    every project that uses it. Each directory maps to its sorted entries,
+    so the entries that start with a prefix are found with a binary search.
+    The index is saved to disk, and refreshing it only lists the
+    directories whose mtime changed since."""
+    def __init__(self, path):
+        self.path = path
+        self.cache_file = get_cache_path('includes', hashlib.md5(path.encode('utf-8')).hexdigest() + '.json')
+        # Directory relative to the search path, ending with a slash -> (mtime, entries)
+        self.dirs = {}
+        self.lock = Lock()
+        self.loaded = False
+        self.refreshed = 0
+
+    def load(self):
+        try:
+            with open(self.cache_file) as f: data = json.load(f)
+            if data.get('path') == self.path: self.dirs = dict((d, tuple(x)) for d, x in data['dirs'].items())
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        self.loaded = True
+
+    def refresh(self):
+        dirs = {}
+        changed = False
+        stack = ['']
+        while stack:
+            d = stack.pop()
+            mtime = get_mtime(os.path.join(self.path, d))
+            if mtime is None: continue
+            cached = self.dirs.get(d)
+            if cached is not None and cached[0] == mtime: entries = cached[1]
+            else:
+                try:
+                    entries = list_dir(os.path.join(self.path, d))
+                except OSError:
+                    continue
+                changed = True
+            dirs[d] = (mtime, entries)
+            stack.extend(d + e for e in entries if e.endswith('/'))
+        if changed or len(dirs) != len(self.dirs):
+            debug_print("Updated include index:", self.path)
+            self.dirs = dirs
+            try:
+                save_json(self.cache_file, { 'path': self.path, 'dirs': dirs })
+            except (IOError, OSError) as e:
+                debug_print("Can't save include index:", self.path, e)
+
+    def update(self):
+        try:
+            if not self.loaded: self.load()
+            self.refresh()
+        finally:
+            self.lock.release()
+
+    # Refreshes the index in the background, at most every 30 seconds
+    def update_async(self):
+        if time.time() - self.refreshed < 30: return
+        if not self.lock.acquire(blocking=False): return
+        self.refreshed = time.time()
+        Thread(target=self.update, daemon=True).start()
+
+    def find(self, prefix):
+        slash_index = prefix.rfind('/') + 1
+        entry = self.dirs.get(prefix[:slash_index])
+        if entry is None: return []
+        return find_prefix(entry[1], prefix[slash_index:])
+
+include_indexes = {}
+include_indexes_lock = Lock()
 
 def clear_includes():
-    sublime.set_timeout(lambda:clear_includes_impl() , 1)
+    global include_indexes
+    with include_indexes_lock:
+        include_indexes = {}
 
-def search_include(path):
-    start = len(path)
-    if path[-1] is not '/': start = start + 1
-    result = []
-    for root, dirs, filenames in os.walk(path):
-        for f in filenames:
-            full_name = os.path.join(root, f)
-            result.append(full_name[start:])
-    return result
+def get_include_index(path):
+    path = os.path.normpath(path)
+    with include_indexes_lock:
+        if path not in include_indexes: include_indexes[path] = IncludeIndex(path)
+        return include_indexes[path]
 
-def find_includes(view, project_path):
-    result = set()
+def get_include_paths(view):
+    result = []
     is_path = False
     for option in get_args(view):
-        if option.startswith('-I'): result.update(search_include(option[2:]))
-        if is_path: result.update(search_include(option))
-        if option == '-isystem': is_path = True
-        else: is_path = False 
-    for path in get_setting(view, "default_include_paths", ["/usr/include", "/usr/local/include"]):
-        result.update(search_include(path))
-    return sorted(result)
-
+        if is_path: result.append(option)
+        elif option.startswith('-I'): result.append(option[2:])
+        # The path can also be the next argument
+        is_path = option in ('-I', '-isystem')
+    result.extend(get_setting(view, "default_include_paths", ["/usr/include", "/usr/local/include"]))
+    # An empty path would index the current directory
+    return [path for path in result if path]
+
+# Returns the indexes for the view's include paths, which are built or
+# refreshed in the background, so this never waits on the file system
 def get_includes(view):
-    global project_includes
     result = []
-    if includes_lock.acquire(blocking=False):
-        try:
-            project_path = get_project_path(view)
-            if project_path not in project_includes:
-                project_includes[project_path] = find_includes(view, project_path)
-            result = project_includes[project_path]
-        except:
-            pass
-        finally:
-            includes_lock.release()
-    else:
-        debug_print("Includes locked: return nothing")
+    for path in get_include_paths(view):
+        index = get_include_index(path)
+        index.update_async()
+        result.append(index)
     return result
 
-def parse_slash(path, index):
-    last = path.find('/', index)
-    if last == -1: return path[index:]
-    return path[index:last + 1]
-
 def complete_includes(view, prefix):
-    slash_index = prefix.rfind('/') + 1
-    paths = find_prefix(get_includes(view), prefix)
-    return sorted(set([parse_slash(path, slash_index) for path in paths]))
+    result = set()
+    for index in get_includes(view):
+        result.update(index.find(prefix))
+    return sorted(result)
 
+#
+#
+# Project index
+#
+#
 
+# When the compile database of each build dir was last walked by the indexer
+indexed_projects = {}
+
+def get_index_build_dir(view):
+    if not get_setting(view, "index_project", True): return None
+    return find_build_dir(get_project_path(view), get_build_dir(view))
+
+def get_index_path(build_dir):
+    path = get_cache_path('index', hashlib.md5(build_dir.encode('utf-8')).hexdigest() + '.idx')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def get_project_index(view):
+    build_dir = get_index_build_dir(view)
+    if build_dir is None: return None
+    return get_index_path(build_dir)
+
+# Queues every file in the compile database to be indexed in the background.
+# Files that haven't changed since they were indexed are skipped by
+# libcomplete, so walking the database again is cheap.
+def index_project(view, interval=300):
+    build_dir = get_index_build_dir(view)
+    if build_dir is None: return
+    if time.time() - indexed_projects.get(build_dir, 0) < interval: return
+    indexed_projects[build_dir] = time.time()
+    project_path = get_project_path(view)
+    build_dirs = get_build_dir(view)
+    additional_options = get_setting(view, "additional_options", [])
+    exclude_options = get_setting(view, "exclude_options", [])
+    default_options = get_setting(view, "default_options", ["-std=c++11"])
+    db = get_compile_database(build_dir)
+    db.refresh()
+    index_path = get_index_path(build_dir)
+    for filename in sorted(db.files.keys()):
+        index_file(index_path, filename, get_options(project_path, filename, additional_options, exclude_options, build_dirs, default_options))
+
+def update_index(view):
+    build_dir = get_index_build_dir(view)
+    if build_dir is None: return
+    filename = view.file_name()
+    if get_compile_database(build_dir).has_file(filename): index_file(get_index_path(build_dir), filename, get_args(view))
+    # Headers are indexed through the source files that include them
+    else: index_project(view, 0)
 
 #
 #
@@ -274,6 +703,7 @@ class ClangErrorPanel(object):
         self.data = ""
 
     def set_data(self, data):
+        if data == self.data: return
         self.data = data
         if self.is_visible(): self.flush()
 
@@ -309,6 +739,88 @@ class ClangErrorPanel(object):
 
 clang_error_panel = ClangErrorPanel()
 
+#
+#
+# Diagnostics
+#
+#
+
+diagnostic_regex = re.compile(r"^(.*?):(\d+):(\d+): (fatal error|error|warning):")
+
+# The last diagnostics of each view, so the panel and the gutter are only
+# updated when they change, and the panel can show the diagnostics of the
+# active view
+view_diagnostics = {}
+# Bumped on every edit, so only the last of a burst of edits reparses
+diagnostics_generations = {}
+
+class DiagnosticsWorker(object):
+    """Gets diagnostics on a thread of its own, since a reparse can take
+    seconds, which would hold up Sublime's async thread for every plugin.
+    Only the last request of each view is kept."""
+    def __init__(self):
+        self.condition = Condition()
+        self.requests = collections.OrderedDict()
+        self.thread = None
+
+    def submit(self, view, request):
+        with self.condition:
+            self.requests.pop(view.id(), None)
+            self.requests[view.id()] = request
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.requests: self.condition.wait()
+                view_id, request = self.requests.popitem(last=False)
+            try:
+                request()
+            except Exception as e:
+                print('ClangComplete: diagnostics failed:', e)
+
+diagnostics_worker = DiagnosticsWorker()
+
+def is_active_view(view):
+    window = view.window()
+    active = window.active_view() if window is not None else None
+    return active is not None and active.id() == view.id()
+
+def get_diagnostics_regions(view, diagnostics):
+    errors = []
+    warnings = []
+    filename = view.file_name()
+    for diag in diagnostics:
+        m = diagnostic_regex.match(diag)
+        if m is None or m.group(1) != filename: continue
+        point = view.text_point(int(m.group(2))-1, int(m.group(3))-1)
+        region = view.word(point)
+        if m.group(4) == 'warning': warnings.append(region)
+        else: errors.append(region)
+    return errors, warnings
+
+def update_diagnostics(view, diagnostics):
+    old = view_diagnostics.get(view.id(), [])
+    if diagnostics == old: return False
+    debug_print("diagnostics:", len(set(diagnostics) - set(old)), "added", len(set(old) - set(diagnostics)), "removed")
+    view_diagnostics[view.id()] = diagnostics
+    errors, warnings = get_diagnostics_regions(view, diagnostics)
+    flags = sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE | sublime.DRAW_SQUIGGLY_UNDERLINE
+    view.add_regions("clangcomplete_errors", errors, "invalid", "circle", flags)
+    view.add_regions("clangcomplete_warnings", warnings, "invalid.deprecated", "dot", flags)
+    if is_active_view(view): update_diagnostics_panel(view)
+    return True
+
+def update_diagnostics_panel(view):
+    if view.id() in view_diagnostics: clang_error_panel.set_data('\n'.join(view_diagnostics[view.id()]))
+
+def clear_diagnostics(view):
+    view_diagnostics.pop(view.id(), None)
+    diagnostics_generations.pop(view.id(), None)
+
 #
 #
 # Get language from sublime 
@@ -374,7 +886,13 @@ class ClangCompleteFindUses(sublime_plugin.TextCommand):
         if (filename is None): return
 
         row, col = self.view.rowcol(self.view.sel()[0].begin())
-        uses = find_uses(filename, get_args(self.view), row+1, col+1, None)
+        args = get_args(self.view)
+        uses = find_uses(filename, args, row+1, col+1, None)
+        index_path = get_project_index(self.view)
+        if index_path is not None:
+            usr = get_usr(filename, args, row+1, col+1)
+            # The uses in this file come from its tu, which also sees unsaved changes
+            if len(usr) > 0: uses.extend(use for use in find_indexed_uses(index_path, usr) if use.rsplit(':', 2)[0] != filename)
         self.view.window().show_quick_panel(uses, self.on_done, sublime.MONOSPACE_FONT, 0, lambda index:self.quick_open(uses, index))
 
     def quick_open(self, uses, index):
@@ -389,33 +907,89 @@ class ClangCompleteGotoDef(sublime_plugin.TextCommand):
         # The view hasnt finsished loading yet
         if (filename is None): return
 
-        reparse(filename, get_args(self.view), get_unsaved_buffer(self.view))
+        sync_unsaved_buffer(self.view)
+        reparse(filename, get_args(self.view), None)
 
         pos = self.view.sel()[0].begin()
         row, col = self.view.rowcol(pos)
-        target = get_definition(filename, get_args(self.view), row+1, col+1)
+        args = get_args(self.view)
+        target = get_definition(filename, args, row+1, col+1)
+        index_path = get_project_index(self.view)
+        if index_path is not None:
+            # The tu only knows about definitions in this file and its headers
+            usr = get_usr(filename, args, row+1, col+1)
+            definition = ""
+            if len(usr) > 0: definition = find_indexed_definition(index_path, usr)
+            if len(definition) > 0 and definition.rsplit(':', 2)[0] != filename: target = definition
 
         if (len(target) is 0): sublime.status_message("Cant find definition")
         else: self.view.window().open_file(target, sublime.ENCODED_POSITION)
 
+class ClangCompleteFindSymbol(sublime_plugin.TextCommand):
+    def run(self, edit):
+        self.index_path = get_project_index(self.view)
+        if self.index_path is None:
+            sublime.status_message("No project index")
+            return
+        index_project(self.view)
+        word = self.view.substr(self.view.word(self.view.sel()[0].begin())).strip()
+        if not re.match(r'^\w+$', word): word = ""
+        self.view.window().show_input_panel("Find symbol:", word, self.on_query, None, None)
+
+    def on_query(self, query):
+        symbols = find_indexed_symbols(self.index_path, query, 1000)
+        if len(symbols) == 0:
+            sublime.status_message("No symbols found")
+            return
+        self.view.window().show_quick_panel([list(symbol) for symbol in symbols], lambda index:self.on_done(symbols, index), sublime.MONOSPACE_FONT)
+
+    def on_done(self, symbols, index):
+        if index >= 0: self.view.window().open_file(symbols[index][1], sublime.ENCODED_POSITION)
+
+class ClangCompleteDumpMetrics(sublime_plugin.WindowCommand):
+    def run(self):
+        view = self.window.new_file()
+        view.set_name("ClangComplete Metrics")
+        view.set_scratch(True)
+        view.assign_syntax("Packages/JavaScript/JSON.sublime-syntax")
+        view.run_command("clang_error_panel_flush", {"data": json.dumps(get_metrics(), indent=4, sort_keys=True)})
+
+# The tokens of the visible lines are annotated all at once, and kept until
+# the file is reparsed, so looking up another position doesn't ask clang again
+def get_annotation_at(view, pos):
+    row, col = view.rowcol(pos)
+    visible = view.visible_region()
+    begin, end = view.rowcol(visible.begin())[0], view.rowcol(visible.end())[0]
+    if row < begin or row > end: begin, end = row, row
+    sync_unsaved_buffer(view)
+    # A position right after an identifier still belongs to it
+    tokens = [t for t in get_annotations(view.file_name(), get_args(view), begin+1, end+1) if t[0] == row+1 and t[1] <= col+1 <= t[1] + t[2]]
+    tokens.sort(key=lambda t: t[5] == '')
+    if len(tokens) == 0: return None
+    return tokens[0]
+
 class ClangCompleteShowType(sublime_plugin.TextCommand):
     def run(self, edit):
         filename = self.view.file_name()
         # The view hasnt finsished loading yet
         if (filename is None): return
 
-        reparse(filename, get_args(self.view), get_unsaved_buffer(self.view))
-
         pos = self.view.sel()[0].begin()
-        row, col = self.view.rowcol(pos)
-        type = get_type(filename, get_args(self.view), row+1, col+1)
+        token = get_annotation_at(self.view, pos)
+        if token is not None and token[5] != '': type = token[5]
+        else:
+            row, col = self.view.rowcol(pos)
+            type = get_type(filename, get_args(self.view), row+1, col+1)
 
         sublime.status_message(type)
 
+def show_completions(view):
+    view.run_command("hide_auto_complete")
+    sublime.set_timeout(lambda: view.run_command("auto_complete"), 1)
+
 class ClangCompleteComplete(sublime_plugin.TextCommand):
     def show_complete(self):
-        self.view.run_command("hide_auto_complete")
-        sublime.set_timeout(lambda: self.view.run_command("auto_complete"), 1)
+        show_completions(self.view)
 
     def run(self, edit, characters):
         debug_print("ClangCompleteComplete")
@@ -440,13 +1014,123 @@ class ClangCompleteComplete(sublime_plugin.TextCommand):
             debug_print("Popup completions")
             self.show_complete()
 
+# Only the best completions are sent when sublime asks again as more is
+# typed, otherwise it filters the first list it got on its own
+completion_flags = getattr(sublime, 'DYNAMIC_COMPLETIONS', 0)
+
+def get_completion_limit(view):
+    if completion_flags == 0: return 0
+    return get_setting(view, "max_completions", 200)
+
+def is_completing_at(view, point):
+    pos = view.sel()[0].begin()
+    if pos < point or view.rowcol(pos)[0] != view.rowcol(point)[0]: return False
+    return re.match(r'^\W?\w*$', view.substr(sublime.Region(point, pos))) is not None
+
+# Completions are asked for in the background, so sublime never waits on
+# clang. The last completions of each view are kept, and are given to sublime
+# right away while the cursor completes at the same position. When newer
+# completions come in, the popup is shown again with them, unless a newer
+# request replaced them, or the cursor moved on.
+class CompletionRequest(object):
+    def __init__(self, key, prefix, change_count, show):
+        self.key = key
+        self.prefix = prefix
+        self.change_count = change_count
+        # Only a request sublime asked for shows the popup, the others just
+        # get clang started
+        self.show = show
+
+    def matches(self, other):
+        return self.key == other.key and self.prefix == other.prefix and self.change_count == other.change_count
+
+# The completions last received for each view, with the request they are
+# for, and the last request made for each view
+completion_results = {}
+completion_requests = {}
+
+# Only the change count of the buffer is taken here, on the UI thread. The
+# buffer is synced up to it, and the args are computed, on the worker thread,
+# since both can wait on the server.
+def request_completions(view, request, point):
+    completion_requests[view.id()] = request
+    snapshot = BufferSnapshot(view)
+    def get_request_args():
+        sync_unsaved_buffer(view, snapshot)
+        return get_args(view)
+    filename, row, col = request.key
+    def receive(completions, fresh):
+        completions = convert_completions(completions)
+        def show():
+            if completion_requests.get(view.id()) is not request or not view.is_valid(): return
+            old = completion_results.get(view.id())
+            completion_results[view.id()] = (request, completions)
+            if old is not None and old[0].key == request.key and old[1] == completions: return
+            if request.show and is_completing_at(view, point): show_completions(view)
+        sublime.set_timeout(show, 0)
+    refresh_timeout = 0
+    if get_setting(view, "refresh_completions", True): refresh_timeout = get_setting(view, "refresh_completions_timeout", 10000)
+    get_completions_async(receive, filename, get_request_args, row+1, col+1, request.prefix, get_setting(view, "timeout", 200), None, get_completion_limit(view), refresh_timeout)
+
+def clear_completions(view):
+    completion_results.pop(view.id(), None)
+    completion_requests.pop(view.id(), None)
+
+#
+#
+# Prefetch
+#
+#
+
+# Once the editor is idle, the files that are likely to be opened next are
+# parsed ahead of time, at a lower priority than anything else: the header or
+# source that goes with the file, the project files it includes, and the
+# other open files. Any activity drops the files that haven't started parsing.
+prefetch_generation = 0
+prefetching = False
+
+def find_counterpart(filename):
+    stem, ext = os.path.splitext(filename)
+    exts = header_extensions if ext in source_extensions else source_extensions
+    return next((stem + e for e in exts if os.path.exists(stem + e)), None)
+
+def get_prefetch_files(view):
+    filename = view.file_name()
+    files = [find_counterpart(filename)]
+    project_path = get_project_path(view)
+    if project_path: files.extend(f for f in get_included_files(filename) if f.startswith(os.path.join(project_path, '')))
+    window = view.window()
+    if window is not None: files.extend(v.file_name() for v in window.views() if v.id() != view.id() and is_supported_language(v))
+    result = []
+    for f in files:
+        if f is not None and f != filename and f not in result: result.append(f)
+    return result
+
+def prefetch_files(view, generation):
+    global prefetching
+    if generation != prefetch_generation or not view.is_valid() or view.file_name() is None: return
+    for f in get_prefetch_files(view)[:get_setting(view, "prefetch_max_files", 4)]:
+        other = view.window().find_open_file(f) if view.window() is not None else None
+        prefetch(f, get_args(other or view, f))
+    prefetching = True
+
+def on_activity(view):
+    global prefetch_generation, prefetching
+    prefetch_generation += 1
+    if prefetching:
+        prefetching = False
+        cancel_prefetch()
+    if not get_setting(view, "prefetch", True) or not is_supported_language(view): return
+    generation = prefetch_generation
+    sublime.set_timeout_async(lambda: prefetch_files(view, generation), get_setting(view, "prefetch_delay", 1000))
+
 build_panel_window_id = None
 
 def is_build_panel_visible(window):
     return build_panel_window_id != None and window != None and window.id() == build_panel_window_id
 
 class ClangCompleteAutoComplete(sublime_plugin.EventListener):
-    def complete_at(self, view, prefix, location, timeout):
+    def complete_at(self, view, prefix, location, show=False):
         debug_print("complete_at", prefix)
         filename = view.file_name()
         # The view hasnt finsished loading yet
@@ -473,7 +1157,14 @@ class ClangCompleteAutoComplete(sublime_plugin.EventListener):
             else: p = r.end() - 1
             row, col = view.rowcol(p)
             # debug_print("complete: ", row, col, word)
-            completions = convert_completions(get_completions(filename, get_args(view), row+1, col+1, "", timeout, get_unsaved_buffer(view)))
+            request = CompletionRequest((filename, row, col), prefix, view.change_count(), show)
+            result = completion_results.get(view.id())
+            # Sublime filters completions for a shorter prefix on its own
+            if result is not None and result[0].key == request.key: completions = result[1]
+            # The same request is only made again once the buffer changed
+            last = completion_requests.get(view.id())
+            if last is not None and last.matches(request): last.show = last.show or show
+            else: request_completions(view, request, p)
 
         return completions
 
@@ -482,22 +1173,41 @@ class ClangCompleteAutoComplete(sublime_plugin.EventListener):
         filename = view.file_name()  
         # The view hasnt finsished loading yet
         if (filename is None): return []
+        sync_unsaved_buffer(view)
+        # The tu is parsed again from scratch when one of its headers changed,
+        # so there are no errors about a stale precompiled preamble
         diagnostics = get_diagnostics(filename, get_args(view))
-        # If there are errors in the precompiled headers, then we will free
-        # the tu, and reload the diagnostics
-        for diag in diagnostics:
-            if "has been modified since the precompiled header" in diag or "modified since it was first processed" in diag:
-                free_tu(filename)
-                diagnostics = get_diagnostics(filename, get_args(view))
-                break
         return [diag for diag in diagnostics if "#pragma once in main file" not in diag]
 
     def show_diagnostics(self, view):
-        output = '\n'.join(self.diagnostics(view))
-        clang_error_panel.set_data(output)
-        window = view.window()
-        if not window is None and len(output) > 1:
-            window.run_command("clang_toggle_panel", {"show": True})
+        diagnostics = self.diagnostics(view)
+        def show():
+            if not view.is_valid(): return
+            update_diagnostics(view, diagnostics)
+            update_diagnostics_panel(view)
+            window = view.window()
+            if not window is None and len(diagnostics) > 0:
+                window.run_command("clang_toggle_panel", {"show": True})
+        sublime.set_timeout(show, 0)
+
+    def live_diagnostics(self, view, generation):
+        if diagnostics_generations.get(view.id()) != generation or not view.is_valid(): return
+        diagnostics = self.diagnostics(view)
+        def update():
+            # Further edits were made while reparsing, so these are already
+            # stale
+            if diagnostics_generations.get(view.id()) != generation or not view.is_valid(): return
+            update_diagnostics(view, diagnostics)
+        sublime.set_timeout(update, 0)
+
+    def on_modified_async(self, view):
+        on_activity(view)
+        if not get_setting(view, "live_diagnostics", True) or not is_supported_language(view): return
+        if get_setting(view, "show_diagnostics_on_save", "no_build") == 'never': return
+        generation = diagnostics_generations.get(view.id(), 0) + 1
+        diagnostics_generations[view.id()] = generation
+        delay = get_setting(view, "live_diagnostics_delay", 500)
+        sublime.set_timeout_async(lambda: diagnostics_worker.submit(view, lambda: self.live_diagnostics(view, generation)), delay)
 
     def on_window_command(self, window, command_name, args):
         global build_panel_window_id
@@ -511,23 +1221,33 @@ class ClangCompleteAutoComplete(sublime_plugin.EventListener):
         return None
 
 
+    def on_hover(self, view, point, hover_zone):
+        if hover_zone != sublime.HOVER_TEXT or view.file_name() is None: return
+        if not is_supported_language(view) or not get_setting(view, "show_type_on_hover", False): return
+        def show_type():
+            token = get_annotation_at(view, point)
+            if token is not None and token[5] != '': view.show_popup(html.escape(token[5]), sublime.HIDE_ON_MOUSE_MOVE_AWAY, point)
+        sublime.set_timeout_async(show_type, 0)
+
     def on_post_text_command(self, view, name, args):
         if not is_supported_language(view): return
         
         if 'delete' in name: return
         
         pos = view.sel()[0].begin()
-        self.complete_at(view, "", pos, 0)
+        self.complete_at(view, "", pos)
         
 
     def on_query_completions(self, view, prefix, locations):
         if not is_supported_language(view):
             return []
             
-        completions = self.complete_at(view, prefix, locations[0], get_setting(view, "timeout", 200))
+        completions = self.complete_at(view, prefix, locations[0], True)
         debug_print("on_query_completions:", prefix, len(completions))
         if (get_setting(view, "inhibit_sublime_completions", True)):
-            return (completions, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
+            return (completions, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS | completion_flags)
+        elif completion_flags != 0:
+            return (completions, completion_flags)
         else:
             return (completions)
 
@@ -537,8 +1257,14 @@ class ClangCompleteAutoComplete(sublime_plugin.EventListener):
         
         debug_print("on_activated_async: get_includes")
         get_includes(view)
+        index_project(view)
+        sublime.set_timeout(lambda: update_diagnostics_panel(view), 0)
         debug_print("on_activated_async: complete_at")
-        self.complete_at(view, "", view.sel()[0].begin(), 0)
+        self.complete_at(view, "", view.sel()[0].begin())
+        on_activity(view)
+
+    def on_selection_modified_async(self, view):
+        on_activity(view)
 
 
     def on_post_save_async(self, view):
@@ -550,12 +1276,16 @@ class ClangCompleteAutoComplete(sublime_plugin.EventListener):
         elif show_diagnostics_on_save == 'never': show_panel = False
         else: show_panel = not is_build_panel_visible(view.window())
         
-        if show_panel: self.show_diagnostics(view)
+        if show_panel: diagnostics_worker.submit(view, lambda: self.show_diagnostics(view))
+        update_index(view)
         
         pos = view.sel()[0].begin()
-        self.complete_at(view, "", pos, 0)
+        self.complete_at(view, "", pos)
 
     def on_close(self, view):
+        clear_buffer_edits(view)
+        clear_diagnostics(view)
+        clear_completions(view)
         if is_supported_language(view):
             free_tu(view.file_name())
 
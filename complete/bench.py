@@ -0,0 +1,233 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2013, Paul Fultz II
+
+# Replays editing sessions against libcomplete without sublime, and reports
+# the latency of each operation. A session is a json object with the
+# compiler args and a list of events, each naming a file relative to the
+# corpus and an op:
+#
+#   {"file": "a.cpp", "op": "buffer", "text": "..."}
+#   {"file": "a.cpp", "op": "save"}
+#   {"file": "a.cpp", "op": "complete", "line": 3, "col": 7, "prefix": "me"}
+#   {"file": "a.cpp", "op": "definition", "line": 3, "col": 5}
+#   {"file": "a.cpp", "op": "type", "line": 3, "col": 5}
+#   {"file": "a.cpp", "op": "diagnostics"}
+#
+# A buffer event replaces the unsaved contents of the file, and a save drops
+# them. Lines and columns are one based, like the rest of the api.
+#
+# Usage:
+#
+#   python bench.py --files 20                  # generate a corpus and replay
+#   python bench.py --files 200 --threads 8     # replay the files concurrently
+#   python bench.py --corpus dir --session s.json
+#   python bench.py --server /tmp/clangcomplete.sock
+
+import argparse, json, os, random, shutil, sys, tempfile, threading, time
+
+from complete import get_completions, get_definition, get_type, get_diagnostics, get_metrics, get_memory_usage, reparse, set_buffer, clear_buffer, free_all, set_server
+
+#
+#
+# Synthetic corpus
+#
+#
+
+header_template = '''#ifndef COMMON_{i}_H
+#define COMMON_{i}_H
+{includes}
+struct widget_{i}
+{{
+{members}
+{methods}
+}};
+
+int use_widget_{i}(const widget_{i}& w);
+
+#endif
+'''
+
+source_template = '''#include "common_{h}.h"
+
+int use_widget_{h}_{i}(const widget_{h}& w)
+{{
+    widget_{h} local = w;
+    int total = 0;
+{body}
+    return total;
+}}
+'''
+
+def generate_header(i, members, std_headers):
+    includes = ''.join('#include <%s>\n' % h for h in std_headers)
+    fields = '\n'.join('    int member_%d;' % j for j in range(members))
+    methods = '\n'.join('    int method_%d(int x) const { return member_%d + x; }' % (j, j) for j in range(members))
+    return header_template.format(i=i, includes=includes, members=fields, methods=methods)
+
+def generate_source(i, h, members, lines):
+    body = '\n'.join('    total += local.method_%d(%d);' % (j % members, j) for j in range(lines))
+    return source_template.format(i=i, h=h, body=body)
+
+# Each file gets typed into at the end of its function, as if a new call is
+# written character by character, and then navigated and saved
+def generate_session(sources, members, lines, rng):
+    events = []
+    for f, text in sources:
+        source_lines = text.split('\n')
+        # The line of `return total;`
+        row = next(i for i, l in enumerate(source_lines) if 'return total;' in l)
+        name = 'method_%d' % rng.randrange(members)
+        for n in range(0, len(name) + 1, 3):
+            typed = '    total += local.' + name[:n]
+            edited = source_lines[:row] + [typed] + source_lines[row:]
+            events.append({'file': f, 'op': 'buffer', 'text': '\n'.join(edited)})
+            events.append({'file': f, 'op': 'complete', 'line': row + 1, 'col': len('    total += local.') + 1, 'prefix': name[:n]})
+        use = row - rng.randrange(1, lines + 1)
+        events.append({'file': f, 'op': 'definition', 'line': use + 1, 'col': len('    total += local.') + 1})
+        events.append({'file': f, 'op': 'type', 'line': use + 1, 'col': len('    total += ') + 1})
+        events.append({'file': f, 'op': 'diagnostics'})
+        events.append({'file': f, 'op': 'save'})
+    return events
+
+def generate_corpus(directory, files, headers, members, lines, std_headers, seed):
+    rng = random.Random(seed)
+    for h in range(headers):
+        with open(os.path.join(directory, 'common_%d.h' % h), 'w') as f: f.write(generate_header(h, members, std_headers))
+    sources = []
+    for i in range(files):
+        name = 'source_%d.cpp' % i
+        text = generate_source(i, rng.randrange(headers), members, lines)
+        with open(os.path.join(directory, name), 'w') as f: f.write(text)
+        sources.append((name, text))
+    return {'args': ['-x', 'c++', '-std=c++11', '-I' + directory], 'events': generate_session(sources, members, lines, rng)}
+
+#
+#
+# Replay
+#
+#
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.empty = {}
+        self.rss = {}
+
+    def record(self, op, latency, empty):
+        # The memory of the server, when the calls are sent to one
+        rss = get_memory_usage()[0]
+        with self.lock:
+            self.latencies.setdefault(op, []).append(latency)
+            self.empty[op] = self.empty.get(op, 0) + (1 if empty else 0)
+            self.rss[op] = max(self.rss.get(op, 0), rss)
+
+def run_event(corpus, args, event, change_counts, timeout, limit):
+    filename = os.path.join(corpus, event['file'])
+    op = event['op']
+    if op == 'buffer':
+        change_counts[filename] = change_counts.get(filename, 0) + 1
+        set_buffer(filename, change_counts[filename], event['text'])
+        return None
+    elif op == 'save':
+        clear_buffer(filename)
+        return None
+    elif op == 'complete':
+        # Typing keeps asking until clang answers, like sublime does
+        for i in range(max(1, 10000 // max(timeout, 1))):
+            result = get_completions(filename, args, event['line'], event['col'], event.get('prefix', ''), timeout, None, limit)
+            if len(result) > 0 or timeout == 0: break
+        return result
+    elif op == 'definition':
+        reparse(filename, args, None)
+        return get_definition(filename, args, event['line'], event['col'])
+    elif op == 'type':
+        reparse(filename, args, None)
+        return get_type(filename, args, event['line'], event['col'])
+    elif op == 'diagnostics':
+        return get_diagnostics(filename, args)
+    raise ValueError('Unknown op: %s' % op)
+
+def replay(corpus, session, stats, timeout, limit):
+    change_counts = {}
+    for event in session['events']:
+        start = time.time()
+        result = run_event(corpus, session['args'], event, change_counts, timeout, limit)
+        if result is not None: stats.record(event['op'], time.time() - start, len(result) == 0)
+
+# The events of each file stay in order, while the files are spread over the
+# threads
+def replay_concurrently(corpus, session, stats, threads, timeout, limit):
+    by_file = {}
+    for event in session['events']: by_file.setdefault(event['file'], []).append(event)
+    groups = [[] for i in range(threads)]
+    for i, f in enumerate(sorted(by_file)): groups[i % threads].extend(by_file[f])
+    workers = [threading.Thread(target=replay, args=(corpus, {'args': session['args'], 'events': g}, stats, timeout, limit)) for g in groups]
+    for w in workers: w.start()
+    for w in workers: w.join()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def report(stats, elapsed, out=sys.stdout):
+    out.write('%-12s %8s %10s %10s %10s %8s %10s\n' % ('op', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'empty', 'rss MB'))
+    for op in sorted(stats.latencies):
+        l = stats.latencies[op]
+        out.write('%-12s %8d %10.1f %10.1f %10.1f %7.1f%% %10.1f\n' % (op, len(l),
+            percentile(l, 0.5) * 1000, percentile(l, 0.95) * 1000, percentile(l, 0.99) * 1000,
+            100.0 * stats.empty[op] / len(l), stats.rss[op] / 1048576.0))
+    out.write('total %.1fs, peak rss %.1f MB\n' % (elapsed, get_memory_usage()[1] / 1048576.0))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay editing sessions against libcomplete')
+    parser.add_argument('--corpus', help='The directory of the files in the session, a synthetic corpus is generated when missing')
+    parser.add_argument('--session', help='The session to replay, generated along with the corpus when missing')
+    parser.add_argument('--save-session', help='Save the session that was replayed, to replay it again later')
+    parser.add_argument('--files', type=int, default=20, help='The number of source files to generate')
+    parser.add_argument('--headers', type=int, default=4, help='The number of headers the generated sources share')
+    parser.add_argument('--members', type=int, default=50, help='The number of members of each generated struct')
+    parser.add_argument('--lines', type=int, default=50, help='The number of lines in each generated function')
+    parser.add_argument('--std-headers', default='vector,string,map', help='The standard headers each generated header includes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--args', default='', help='Extra compiler args for the session, separated by spaces')
+    parser.add_argument('--threads', type=int, default=1, help='Replay the files on this many threads')
+    parser.add_argument('--timeout', type=int, default=200, help='The completion timeout in milliseconds')
+    parser.add_argument('--limit', type=int, default=200, help='The maximum number of completions')
+    parser.add_argument('--metrics', help='Save the metrics of libcomplete to this file')
+    parser.add_argument('--server', help='Send the calls to the server at this socket, which is started if needed')
+    args = parser.parse_args()
+    if args.server is not None: set_server(args.server, sys.executable)
+
+    corpus = args.corpus
+    generated = None
+    if corpus is None:
+        corpus = generated = tempfile.mkdtemp(prefix='clangcomplete-bench-')
+    try:
+        if args.session is not None:
+            with open(args.session) as f: session = json.load(f)
+        elif generated is not None or not os.listdir(corpus):
+            std_headers = [h for h in args.std_headers.split(',') if h]
+            session = generate_corpus(corpus, args.files, args.headers, args.members, args.lines, std_headers, args.seed)
+        else:
+            parser.error('A session is needed to replay an existing corpus')
+        session['args'] = session['args'] + args.args.split()
+        if args.save_session is not None:
+            with open(args.save_session, 'w') as f: json.dump(session, f)
+
+        stats = Stats()
+        start = time.time()
+        if args.threads > 1: replay_concurrently(corpus, session, stats, args.threads, args.timeout, args.limit)
+        else: replay(corpus, session, stats, args.timeout, args.limit)
+        report(stats, time.time() - start)
+        if args.metrics is not None:
+            with open(args.metrics, 'w') as f: json.dump(get_metrics(), f, indent=4, sort_keys=True)
+        free_all()
+    finally:
+        if generated is not None: shutil.rmtree(generated, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -20,9 +20,26 @@
 #include <iterator>
 #include <algorithm>
 #include <unordered_map>
+#include <unordered_set>
+#include <map>
+#include <chrono>
 #include <cstring>
+#include <cctype>
 #include <cassert>
+#include <cstdint>
 #include <vector>
+#include <atomic>
+#include <thread>
+#include <queue>
+#include <list>
+#include <functional>
+#include <condition_variable>
+#include <ctime>
+#include <cstdio>
+#include <cstdlib>
+#include <sys/stat.h>
+#include <dirent.h>
+#include <utime.h>
 
 #include "complete.h"
 
@@ -32,24 +49,12 @@ std::ofstream dump_log("clang_log", std::ios_base::app);
 
 #define DUMP_FUNCTION dump_log << "Called: " << std::string(__PRETTY_FUNCTION__) << std::endl;
 
-#define TIMER() timer dump_log_timer(true);
-
-#define DUMP_TIMER() DUMP(dump_log_timer)
-
-#define DUMP_LOG_TIME(x) dump_log << x << ": " << dump_log_timer.reset().count() << std::endl
-
 #else
 
 #define DUMP(x)
 
 #define DUMP_FUNCTION
 
-#define TIMER()
-
-#define DUMP_TIMER()
-
-#define DUMP_LOG_TIME(x)
-
 #endif
 
 
@@ -67,46 +72,335 @@ const string& to_string(const string& s)
 
 }
 
-class timer 
+// Metrics are always collected. They only take relaxed atomic updates, so
+// they are cheap enough to leave on in the hot paths, and are read back as
+// json with `clang_complete_get_metrics`.
+class counter
 {
-    typedef typename std::conditional<std::chrono::high_resolution_clock::is_steady,
-            std::chrono::high_resolution_clock,
-            std::chrono::steady_clock>::type clock_type;
-    typedef std::chrono::milliseconds milliseconds;
+    const char * name;
+    std::atomic<std::uint64_t> value;
 public:
-    explicit timer(bool run = false)
+    explicit counter(const char * name);
+
+    void add(std::uint64_t n=1)
     {
-        if (run) this->reset();
+        this->value.fetch_add(n, std::memory_order_relaxed);
     }
-    milliseconds reset()
+
+    template<class Stream>
+    void write_json(Stream& out) const
     {
-        milliseconds x = this->elapsed();
-        this->start = clock_type::now();
-        return x;
+        out << "\"" << this->name << "\": " << this->value.load(std::memory_order_relaxed);
     }
-    milliseconds elapsed() const
+};
+
+// Latencies in microseconds, where bucket `i` counts the ones below `2^i`
+class histogram
+{
+    static const std::size_t bucket_count = 32;
+    const char * name;
+    std::atomic<std::uint64_t> count;
+    std::atomic<std::uint64_t> total;
+    std::atomic<std::uint64_t> max;
+    std::atomic<std::uint64_t> buckets[bucket_count];
+
+    // An upper bound of the percentile, from the bucket it falls in
+    std::uint64_t percentile(std::uint64_t n, double p) const
     {
-        return std::chrono::duration_cast<milliseconds>(clock_type::now() - this->start);
+        std::uint64_t max = this->max.load(std::memory_order_relaxed);
+        std::uint64_t seen = 0;
+        for(std::size_t i=0;i<bucket_count;i++)
+        {
+            seen += this->buckets[i].load(std::memory_order_relaxed);
+            if (seen > 0 and seen >= p * n) return std::min(std::uint64_t(1) << i, max);
+        }
+        return max;
     }
-    template <typename Stream>
-    friend Stream& operator<<(Stream& out, const timer& self)
+public:
+    explicit histogram(const char * name);
+
+    template<class Duration>
+    void record(Duration d)
     {
-        return out << self.elapsed().count();
+        std::uint64_t us = std::max<std::int64_t>(std::chrono::duration_cast<std::chrono::microseconds>(d).count(), 0);
+        std::size_t i = 0;
+        while (i + 1 < bucket_count and (std::uint64_t(1) << i) <= us) i++;
+        this->buckets[i].fetch_add(1, std::memory_order_relaxed);
+        this->count.fetch_add(1, std::memory_order_relaxed);
+        this->total.fetch_add(us, std::memory_order_relaxed);
+        std::uint64_t m = this->max.load(std::memory_order_relaxed);
+        while (m < us and !this->max.compare_exchange_weak(m, us, std::memory_order_relaxed));
+    }
+
+    template<class Stream>
+    void write_json(Stream& out) const
+    {
+        std::uint64_t n = this->count.load(std::memory_order_relaxed);
+        out << "\"" << this->name << "\": {\"count\": " << n 
+            << ", \"total_us\": " << this->total.load(std::memory_order_relaxed)
+            << ", \"max_us\": " << this->max.load(std::memory_order_relaxed)
+            << ", \"p50_us\": " << this->percentile(n, 0.5)
+            << ", \"p90_us\": " << this->percentile(n, 0.9)
+            << ", \"p99_us\": " << this->percentile(n, 0.99)
+            << ", \"buckets\": [";
+        for(std::size_t i=0;i<bucket_count;i++) out << (i > 0 ? ", " : "") << this->buckets[i].load(std::memory_order_relaxed);
+        out << "]}";
+    }
+};
+
+std::vector<counter*>& get_counters()
+{
+    static std::vector<counter*> counters;
+    return counters;
+}
+
+std::vector<histogram*>& get_histograms()
+{
+    static std::vector<histogram*> histograms;
+    return histograms;
+}
+
+// Metrics are globals, so they register themselves before main runs
+counter::counter(const char * name) : name(name), value(0)
+{
+    get_counters().push_back(this);
+}
+
+histogram::histogram(const char * name) : name(name), count(0), total(0), max(0)
+{
+    for(auto& b:this->buckets) b = 0;
+    get_histograms().push_back(this);
+}
+
+histogram parse_latency("parse");
+histogram fast_parse_latency("fast_parse");
+histogram ast_cache_load_latency("ast_cache_load");
+histogram reparse_latency("reparse");
+histogram code_complete_latency("code_complete");
+histogram format_completions_latency("format_completions");
+histogram annotate_latency("annotate");
+histogram build_pch_latency("build_pch");
+histogram export_latency("export");
+histogram tus_lock_wait("tus_lock_wait");
+histogram tu_lock_wait("tu_lock_wait");
+counter completion_requests("completion_requests");
+counter completion_timeouts("completion_timeouts");
+counter completion_cache_hits("completion_cache_hits");
+counter stale_completions("stale_completions");
+counter reparses_skipped("reparses_skipped");
+counter parse_timeouts("parse_timeouts");
+counter diagnostics_timeouts("diagnostics_timeouts");
+counter prefetches("prefetches");
+counter lock_timeouts("lock_timeouts");
+counter exceptions("exceptions");
+
+// Records how long it is alive in the histogram
+class scoped_latency
+{
+    histogram& h;
+    std::chrono::steady_clock::time_point start;
+public:
+    explicit scoped_latency(histogram& h) : h(h), start(std::chrono::steady_clock::now())
+    {}
+
+    ~scoped_latency()
+    {
+        this->h.record(std::chrono::steady_clock::now() - this->start);
     }
-private:
-    clock_type::time_point start;
 };
+
+// Locks the mutex, and records how long that waited. An uncontended lock is
+// recorded without reading the clock.
+template<class Mutex>
+std::unique_lock<Mutex> lock_timed(Mutex& m, histogram& h)
+{
+    std::unique_lock<Mutex> lock(m, std::try_to_lock);
+    if (lock.owns_lock()) h.record(std::chrono::microseconds(0));
+    else
+    {
+        auto start = std::chrono::steady_clock::now();
+        lock.lock();
+        h.record(std::chrono::steady_clock::now() - start);
+    }
+    return lock;
+}
+
+// Like `try_lock_for`, but records the wait, and counts the timeouts
+template<class Mutex>
+bool try_lock_timed(std::unique_lock<Mutex>& lock, int timeout, histogram& h)
+{
+    if (lock.try_lock()) 
+    {
+        h.record(std::chrono::microseconds(0));
+        return true;
+    }
+    auto start = std::chrono::steady_clock::now();
+    bool locked = lock.try_lock_for(std::chrono::milliseconds(timeout));
+    h.record(std::chrono::steady_clock::now() - start);
+    if (!locked) lock_timeouts.add();
+    return locked;
+}
+
+template<class Stream>
+void write_json_string(Stream& out, const std::string& s)
+{
+    char buf[8];
+    out << '"';
+    for(char c:s)
+    {
+        if (c == '"' or c == '\\') out << '\\' << c;
+        else if (static_cast<unsigned char>(c) < 0x20)
+        {
+            std::snprintf(buf, sizeof(buf), "\\u%04x", c);
+            out << buf;
+        }
+        else out << c;
+    }
+    out << '"';
+}
  
-// An improved async, that doesn't block
-template< class Function, class... Args>
-std::future<typename std::result_of<Function(Args...)>::type>
-detach_async( Function&& f, Args&&... args )
+template<class F, class Result=typename std::decay<decltype(std::declval<F>()())>::type>
+Result try_(F f)
+{
+    try
+    {
+        return f();
+    }
+    catch(const std::exception& e)
+    {
+        exceptions.add();
+        DUMP(e.what());
+        return Result{};
+    }
+    catch(...)
+    {
+        exceptions.add();
+        DUMP("Unknown exception");
+        return Result{};
+    }
+}
+
+template<class F>
+void try_void(F f)
+{
+    try
+    {
+        return f();
+    }
+    catch(const std::exception& e)
+    {
+        exceptions.add();
+        DUMP(e.what());
+    }
+    catch(...)
+    {
+        exceptions.add();
+        DUMP("Unknown exception");
+    }
+}
+
+// Tasks run in order of priority, and in the order they were queued within
+// the same priority
+enum class task_priority
+{
+    completion,
+    query,
+    background,
+    // Work nobody asked for yet, such as prefetching
+    idle
+};
+
+// A fixed number of threads shared by all tus. When threads are reserved, the
+// first thread only runs completions and the second one only runs completions
+// and queries, so neither ever has to wait for a long reparse to finish.
+// Every other thread runs anything.
+class worker_pool
+{
+    struct task
+    {
+        task_priority priority;
+        unsigned long order;
+        std::function<void()> f;
+
+        bool operator<(const task& rhs) const
+        {
+            // std::priority_queue puts the largest element on top
+            return std::make_pair(this->priority, this->order) > std::make_pair(rhs.priority, rhs.order);
+        }
+    };
+    std::mutex m;
+    std::condition_variable cv;
+    std::priority_queue<task> tasks;
+    unsigned long order;
+    std::vector<std::thread> threads;
+
+    // Runs the tasks with a priority up to `lowest`
+    void run(task_priority lowest)
+    {
+        while(true)
+        {
+            std::function<void()> f;
+            {
+                std::unique_lock<std::mutex> lock(this->m);
+                this->cv.wait(lock, [&]
+                {
+                    return !this->tasks.empty() and this->tasks.top().priority <= lowest;
+                });
+                f = std::move(const_cast<task&>(this->tasks.top()).f);
+                this->tasks.pop();
+            }
+            try_void(f);
+        }
+    }
+public:
+    // Reserving needs at least three threads, or nothing runs background tasks
+    worker_pool(std::size_t n, bool reserve=true) : order(0)
+    {
+        for(std::size_t i=0;i<n;i++)
+        {
+            task_priority lowest = task_priority::idle;
+            if (reserve and i == 0) lowest = task_priority::completion;
+            if (reserve and i == 1) lowest = task_priority::query;
+            this->threads.emplace_back([this, lowest] { this->run(lowest); });
+            this->threads.back().detach();
+        }
+    }
+
+    worker_pool(const worker_pool&) = delete;
+
+    template<class F>
+    std::future<typename std::result_of<F()>::type> async(task_priority priority, F f)
+    {
+        typedef typename std::result_of<F()>::type result_type;
+        auto t = std::make_shared<std::packaged_task<result_type()>>(std::move(f));
+        auto fut = t->get_future();
+        {
+            std::lock_guard<std::mutex> lock(this->m);
+            this->tasks.push(task{priority, this->order++, [t] { (*t)(); }});
+        }
+        this->cv.notify_all();
+        return fut;
+    }
+};
+
+// The number of threads for the pools, which is only read when they are
+// first used. Zero picks a number that leaves cores free for the editor.
+std::atomic<unsigned> worker_threads{0};
+
+worker_pool& get_pool()
+{
+    // Never destroyed, since the threads can still be running while the
+    // process exits
+    static worker_pool* pool = new worker_pool(worker_threads > 0 ? std::max(worker_threads.load(), 3u) : std::min(std::max(std::thread::hardware_concurrency(), 3u), 4u));
+    return *pool;
+}
+
+// Project indexing gets its own threads, so it never holds up the threads
+// that serve the editor
+worker_pool& get_index_pool()
 {
-    typedef typename std::result_of<Function(Args...)>::type result_type;
-    std::packaged_task<result_type(Args...)> task(std::forward<Function>(f));
-    auto fut = task.get_future(); 
-    std::thread(std::move(task)).detach();
-    return std::move(fut);
+    static worker_pool* pool = new worker_pool(worker_threads > 0 ? worker_threads.load() : std::max(std::thread::hardware_concurrency() / 2, 1u), false);
+    return *pool;
 }
 
 inline bool starts_with(const char *str, const char *pre)
@@ -116,42 +410,302 @@ inline bool starts_with(const char *str, const char *pre)
     return lenstr < lenpre ? false : strncmp(pre, str, lenpre) == 0;
 }
 
-inline bool istarts_with(const std::string& str, const std::string& pre)
+inline bool is_word_start(const char * str, std::size_t i)
+{
+    if (i == 0) return true;
+    char prev = str[i-1];
+    char c = str[i];
+    if (!std::isalnum(prev)) return std::isalnum(c);
+    return std::islower(prev) and std::isupper(c);
+}
+
+// Scores how well the pattern matches the string as a case insensitive
+// subsequence, or returns -1 if it doesn't match. Matches at the start of a
+// word, whether after an underscore or at a camelCase hump, score higher, as
+// do consecutive matches, and shorter strings win ties.
+int fuzzy_score(const std::string& pattern, const char * str, std::size_t size)
+{
+    if (pattern.size() > size) return -1;
+    int score = 0;
+    std::size_t last = std::string::npos;
+    std::size_t i = 0;
+    for(char p:pattern)
+    {
+        char lp = std::tolower(p);
+        while (i < size and std::tolower(str[i]) != lp) i++;
+        if (i == size) return -1;
+        score += 1;
+        if (is_word_start(str, i)) score += 8;
+        if (last != std::string::npos and last + 1 == i) score += 4;
+        if (str[i] == p) score += 1;
+        last = i++;
+    }
+    score -= std::min<std::size_t>(size - pattern.size(), 16) / 2;
+    return score;
+}
+
+int fuzzy_score(const std::string& pattern, const std::string& str)
 {
-    return str.length() < pre.length() ? false : 
-        std::equal(pre.begin(), pre.end(), str.begin(), [](char a, char b) { return std::tolower(a) == std::tolower(b); });
+    return fuzzy_score(pattern, str.c_str(), str.size());
 }
 
-std::string get_line_at(const std::string& str, unsigned int line)
+// The text before a position, where the line and column start at one
+std::string get_text_before(const std::string& str, unsigned int line, unsigned int col)
 {
-    int n = 1;
     std::string::size_type pos = 0;
-    std::string::size_type prev = 0;
-    while ((pos = str.find('\n', prev)) != std::string::npos)
+    for(unsigned int n = 1; n < line; n++)
     {
-        if (n == line) return str.substr(prev, pos - prev);
-        prev = pos + 1;
-        n++;
+        pos = str.find('\n', pos);
+        if (pos == std::string::npos) return str;
+        pos++;
     }
+    std::string::size_type end = std::min(str.find('\n', pos), str.size());
+    return str.substr(0, std::min<std::string::size_type>(pos + (col > 0 ? col - 1 : 0), end));
+}
+
+std::string to_std_string(CXString str)
+{
+    std::string result;
+    const char * s = clang_getCString(str);
+    if (s != nullptr) result = s;
+    clang_disposeString(str);
+    return result;
+}
 
-    // To get the last line
-    if (n == line) return str.substr(prev);
-    else return "";
+// The mtime of a file, or zero if it doesn't exist
+std::time_t get_mtime(const std::string& path)
+{
+    struct stat st;
+    if (stat(path.c_str(), &st) != 0) return 0;
+    return st.st_mtime;
 }
 
-CXIndex get_index(bool clear=false)
+// clang_suspendTranslationUnit first appeared in libclang 0.43
+#if defined(CINDEX_VERSION_MINOR) && (CINDEX_VERSION_MAJOR > 0 || CINDEX_VERSION_MINOR >= 43)
+#define CLANG_COMPLETE_HAS_SUSPEND 1
+#else
+#define CLANG_COMPLETE_HAS_SUSPEND 0
+#endif
+
+// CXTranslationUnit_LimitSkipFunctionBodiesToPreamble first appeared in
+// libclang 0.49, and CXTranslationUnit_CreatePreambleOnFirstParse before it
+#if defined(CINDEX_VERSION_MINOR) && (CINDEX_VERSION_MAJOR > 0 || CINDEX_VERSION_MINOR >= 49)
+#define CLANG_COMPLETE_HAS_FAST_PARSE 1
+#else
+#define CLANG_COMPLETE_HAS_FAST_PARSE 0
+#endif
+
+// Whether new tus are parsed fast first, see `translation_unit::parse`
+std::atomic<bool> fast_parse{true};
+
+// Each tu keeps a reference to the index it was parsed with, so clearing the
+// index doesn't pull it out from under tus that are still in use
+std::shared_ptr<void> get_index(bool clear=false)
 {
     static std::shared_ptr<void> index = std::shared_ptr<void>(clang_createIndex(1, 1), &clang_disposeIndex);
     if (clear) index = std::shared_ptr<void>(clang_createIndex(1, 1), &clang_disposeIndex);
-    return index.get();
+    return index;
+}
+
+// Parsed tus are saved to disk, so a file that is opened again after a
+// restart can load its AST instead of being parsed. An entry is only used
+// when the file is parsed with the same arguments, and none of the files it
+// was parsed from changed since.
+std::mutex ast_cache_mutex{};
+std::string ast_cache_dir;
+std::size_t ast_cache_max_size = 0;
+
+// The path of the cache entry without its extension, which is empty when the
+// cache is off
+std::string get_ast_cache_path(const std::string& filename, const std::vector<std::string>& args)
+{
+    std::lock_guard<std::mutex> lock(ast_cache_mutex);
+    if (ast_cache_dir.empty()) return {};
+    std::string key = filename;
+    for(const auto& arg:args) key.append(1, '\0').append(arg);
+    char buf[32];
+    std::snprintf(buf, sizeof(buf), "%016llx", static_cast<unsigned long long>(std::hash<std::string>()(key)));
+    return ast_cache_dir + "/" + buf;
+}
+
+bool is_ast_cache_current(const std::string& path, const std::string& filename, const std::vector<std::string>& args)
+{
+    std::ifstream in(path + ".deps");
+    std::string line;
+    if (!std::getline(in, line) or line != "clangcomplete-ast 1") return false;
+    if (!std::getline(in, line) or line != filename) return false;
+    if (!std::getline(in, line) or std::strtoul(line.c_str(), nullptr, 10) != args.size()) return false;
+    for(const auto& arg:args)
+    {
+        if (!std::getline(in, line) or line != arg) return false;
+    }
+    while(std::getline(in, line))
+    {
+        char * p = &line[0];
+        std::time_t mtime = std::strtoll(p, &p, 10);
+        if (*p != '\t' or get_mtime(p + 1) != mtime) return false;
+    }
+    return true;
+}
+
+// The precompiled header the args include, if any
+std::string get_pch_arg(const std::vector<std::string>& args)
+{
+    auto it = std::find(args.begin(), args.end(), "-include-pch");
+    if (it == args.end() or ++it == args.end()) return {};
+    return *it;
+}
+
+typedef std::vector<std::pair<std::string, std::time_t>> dependency_list;
+
+// Every file the tu was parsed from, with the mtime clang saw for each, and
+// the precompiled header the args include
+dependency_list get_dependencies(CXTranslationUnit tu, const std::vector<std::string>& args, bool main_file=true)
+{
+    struct visitor_data
+    {
+        bool main_file;
+        dependency_list result;
+    } data{main_file, {}};
+    clang_getInclusions(tu, [](CXFile f, CXSourceLocation *, unsigned n, CXClientData d)
+    {
+        auto& data = *static_cast<visitor_data*>(d);
+        if (n > 0 or data.main_file) data.result.emplace_back(to_std_string(clang_getFileName(f)), clang_getFileTime(f));
+    }, &data);
+    std::string pch = get_pch_arg(args);
+    if (!pch.empty()) data.result.emplace_back(pch, get_mtime(pch));
+    return data.result;
+}
+
+bool save_ast_cache(const std::string& path, const std::string& filename, const std::vector<std::string>& args, 
+    CXTranslationUnit tu, const dependency_list& dependencies)
+{
+    std::string ast = path + ".ast";
+    if (clang_saveTranslationUnit(tu, (ast + ".tmp").c_str(), clang_defaultSaveOptions(tu)) != CXSaveError_None) return false;
+    if (std::rename((ast + ".tmp").c_str(), ast.c_str()) != 0) return false;
+    std::string deps = path + ".deps";
+    {
+        std::ofstream out(deps + ".tmp", std::ios_base::binary);
+        out << "clangcomplete-ast 1\n" << filename << "\n" << args.size() << "\n";
+        for(const auto& arg:args) out << arg << "\n";
+        for(const auto& d:dependencies) out << d.second << "\t" << d.first << "\n";
+        if (!out) return false;
+    }
+    return std::rename((deps + ".tmp").c_str(), deps.c_str()) == 0;
+}
+
+// Removes the least recently used entries until the cache fits in its size.
+// Loading an entry touches it.
+void evict_ast_cache()
+{
+    std::string dir;
+    std::size_t max_size;
+    {
+        std::lock_guard<std::mutex> lock(ast_cache_mutex);
+        dir = ast_cache_dir;
+        max_size = ast_cache_max_size;
+    }
+    if (dir.empty()) return;
+    DIR * d = opendir(dir.c_str());
+    if (d == nullptr) return;
+    std::vector<std::tuple<std::time_t, std::string, std::size_t>> entries;
+    std::size_t total = 0;
+    while (dirent * e = readdir(d))
+    {
+        std::string name = e->d_name;
+        if (name.size() < 4 or name.compare(name.size() - 4, 4, ".ast") != 0) continue;
+        struct stat st;
+        std::string path = dir + "/" + name.substr(0, name.size() - 4);
+        if (stat((path + ".ast").c_str(), &st) != 0) continue;
+        entries.emplace_back(st.st_mtime, path, st.st_size);
+        total += st.st_size;
+    }
+    closedir(d);
+    std::sort(entries.begin(), entries.end());
+    for(const auto& e:entries)
+    {
+        if (total <= max_size) break;
+        std::remove((std::get<1>(e) + ".ast").c_str());
+        std::remove((std::get<1>(e) + ".deps").c_str());
+        total -= std::get<2>(e);
+    }
+}
+
+// A token of the main file, with the kind of cursor clang annotated it
+// with, and for identifiers, their type and where what they refer to is
+// declared. The strings are indexes into the table of the set.
+struct annotation
+{
+    unsigned line;
+    unsigned col;
+    unsigned length;
+    unsigned kind;
+    unsigned cursor;
+    unsigned type;
+    unsigned reference;
+};
+
+// The tokens of a range of lines, from one tokenize and annotate pass,
+// which stay valid until the tu is reparsed. What the tu was parsed from is
+// kept along, see `translation_unit::get_current_annotations`.
+struct annotation_set
+{
+    unsigned long reparses;
+    bool from_buffer;
+    std::size_t hash;
+    std::time_t mtime;
+    unsigned begin_line;
+    unsigned end_line;
+    std::vector<annotation> tokens;
+    std::vector<std::string> strings;
+};
+
+const char * get_token_kind_name(CXTokenKind kind)
+{
+    switch (kind)
+    {
+    case CXToken_Punctuation: return "punctuation";
+    case CXToken_Keyword: return "keyword";
+    case CXToken_Identifier: return "identifier";
+    case CXToken_Literal: return "literal";
+    case CXToken_Comment: return "comment";
+    }
+    return "";
 }
 
 class translation_unit
 {
-    // CXIndex index;
+    std::shared_ptr<void> index;
     CXTranslationUnit tu;
     std::string filename;
+    std::vector<std::string> args;
     std::timed_mutex m;
+    std::promise<void> parsed_promise;
+    std::shared_future<void> parsed;
+    std::atomic<bool> suspended;
+    std::atomic<std::size_t> memory;
+    std::atomic<unsigned long> last_used;
+    std::atomic<unsigned long> reparses;
+    // Set while the tu is an AST loaded from the cache
+    std::atomic<bool> from_cache;
+    // Set while the function bodies of the headers are skipped
+    std::atomic<bool> fast;
+    // Set once the AST can depend on the precompiled preamble, which is
+    // built by the first reparse or completion, or by a fast parse
+    bool preamble;
+    std::mutex upgrade_mutex;
+    // The mtime of the file when it was last parsed
+    std::atomic<std::time_t> parsed_mtime;
+    // A hash of the unsaved buffer the tu was last parsed with, unless it was
+    // parsed from the file on disk
+    std::size_t parsed_hash;
+    bool parsed_from_buffer;
+    // The headers the tu was last parsed from, with the mtime clang saw for
+    // each, so a reparse can be skipped while none of them changed
+    dependency_list dependencies;
+    // The tokens annotated last, see `get_annotations`
+    std::mutex annotations_mutex;
+    std::shared_ptr<const annotation_set> annotations;
 
     CXUnsavedFile unsaved_buffer(const char * buffer, unsigned len)
     {
@@ -162,15 +716,6 @@ class translation_unit
         return result;
     }
 
-    static std::string to_std_string(CXString str)
-    {
-        std::string result;
-        const char * s = clang_getCString(str);
-        if (s != nullptr) result = s;
-        clang_disposeString(str);
-        return result;
-    }
-
     struct completion_results
     {
         std::shared_ptr<CXCodeCompleteResults> results;
@@ -200,34 +745,18 @@ class translation_unit
         }
     };
 
+    // The text is only valid during the call
     template<class F>
-    static void for_each_completion_string(CXCompletionResult& c, F f)
-    {
-        if ( clang_getCompletionAvailability( c.CompletionString ) == CXAvailability_Available )
-        {
-            int num = clang_getNumCompletionChunks(c.CompletionString);
-            for(int i=0;i<num;i++)
-            {
-                auto str = clang_getCompletionChunkText(c.CompletionString, i);
-                auto kind = clang_getCompletionChunkKind(c.CompletionString, i);
-                f(to_std_string(str), kind);
-            }
-        }
-    }
-
-    static std::string get_typed_text(CXCompletionResult& c)
+    static void for_each_completion_string(CXCompletionString cs, F f)
     {
-        if ( clang_getCompletionAvailability( c.CompletionString ) == CXAvailability_Available )
+        int num = clang_getNumCompletionChunks(cs);
+        for(int i=0;i<num;i++)
         {
-            int num = clang_getNumCompletionChunks(c.CompletionString);
-            for(int i=0;i<num;i++)
-            {
-                auto str = clang_getCompletionChunkText(c.CompletionString, i);
-                auto kind = clang_getCompletionChunkKind(c.CompletionString, i);
-                if (kind == CXCompletionChunk_TypedText) return to_std_string(str);
-            }
+            CXString str = clang_getCompletionChunkText(cs, i);
+            const char * text = clang_getCString(str);
+            f(text == nullptr ? "" : text, clang_getCompletionChunkKind(cs, i));
+            clang_disposeString(str);
         }
-        return {};
     }
 
     static unsigned code_complete_options()
@@ -258,14 +787,85 @@ class translation_unit
             CXTranslationUnit_CacheCompletionResults;
     }
 
-    void unsafe_reparse(const char * buffer=nullptr, unsigned len=0)
+#if CLANG_COMPLETE_HAS_FAST_PARSE
+    // The preamble is built by the parse, instead of by the first reparse,
+    // and the function bodies in the headers are skipped, which is most of
+    // the work of building it. The main file is parsed in full, so
+    // everything in it can still be navigated and completed.
+    static unsigned fast_parse_options()
+    {
+        return parse_options() | CXTranslationUnit_CreatePreambleOnFirstParse | 
+            CXTranslationUnit_SkipFunctionBodies | CXTranslationUnit_LimitSkipFunctionBodiesToPreamble;
+    }
+
+    static unsigned full_parse_options()
     {
+        return parse_options() | CXTranslationUnit_CreatePreambleOnFirstParse;
+    }
+#endif
+
+    CXTranslationUnit parse_file(unsigned options=parse_options(), histogram& h=parse_latency)
+    {
+        scoped_latency latency(h);
+        std::vector<const char *> argv;
+        for(const auto& arg:this->args) argv.push_back(arg.c_str());
+        return clang_parseTranslationUnit(this->index.get(), this->filename.c_str(), argv.data(), argv.size(), NULL, 0, options);
+    }
+
+    bool unsafe_load_cache()
+    {
+        std::string path = get_ast_cache_path(this->filename, this->args);
+        if (path.empty() or !is_ast_cache_current(path, this->filename, this->args)) return false;
+        std::string ast = path + ".ast";
+        {
+            scoped_latency latency(ast_cache_load_latency);
+            this->tu = clang_createTranslationUnit(this->index.get(), ast.c_str());
+        }
+        if (this->tu == nullptr) return false;
+        utime(ast.c_str(), nullptr);
+        this->from_cache = true;
+        return true;
+    }
+
+    void unsafe_reparse(std::shared_ptr<const std::string> buffer=nullptr)
+    {
+        scoped_latency latency(reparse_latency);
+        this->parsed_mtime = get_mtime(this->filename);
         if (buffer == nullptr) clang_reparseTranslationUnit(this->tu, 0, nullptr, parse_options());
         else
         {
-            auto unsaved = this->unsaved_buffer(buffer, len);
+            auto unsaved = this->unsaved_buffer(buffer->data(), buffer->size());
             clang_reparseTranslationUnit(this->tu, 1, &unsaved, parse_options());
         }
+        this->unsafe_set_parsed(buffer.get());
+        this->suspended = false;
+        this->preamble = true;
+        this->memory = this->unsafe_memory_usage();
+        this->reparses++;
+    }
+
+    void unsafe_set_parsed(const std::string * buffer)
+    {
+        this->parsed_from_buffer = buffer != nullptr;
+        this->parsed_hash = buffer == nullptr ? 0 : std::hash<std::string>()(*buffer);
+        this->dependencies.clear();
+        if (this->tu != nullptr) this->dependencies = get_dependencies(this->tu, this->args, false);
+    }
+
+    // A suspended tu only supports being reparsed, so this needs to be
+    // called before anything else touches the tu
+    void unsafe_resume()
+    {
+        if (this->suspended) this->unsafe_reparse();
+    }
+
+    std::size_t unsafe_memory_usage()
+    {
+        std::size_t result = 0;
+        if (this->tu == nullptr) return result;
+        usage u(clang_getCXTUResourceUsage(this->tu));
+        for(CXTUResourceUsageEntry e:u) result += e.amount;
+        return result;
     }
 public:
     struct cursor
@@ -306,6 +906,11 @@ public:
             return to_std_string(clang_getCursorSpelling(this->c));
         }
 
+        std::string get_usr()
+        {
+            return to_std_string(clang_getCursorUSR(this->c));
+        }
+
         std::string get_type_name()
         {
             return to_std_string(clang_getTypeSpelling(clang_getCanonicalType(clang_getCursorType(this->c))));
@@ -377,34 +982,301 @@ public:
             return clang_Cursor_isNull(this->c);
         }
     };
-    translation_unit(const char * filename, const char ** args, int argv) : filename(filename)
+    translation_unit(const char * filename, const char ** args, int argv) 
+    : index(get_index()), tu(nullptr), filename(filename), args(args, args+argv), suspended(false), memory(0), last_used(0), reparses(0), from_cache(false), fast(false), preamble(false), parsed_mtime(0), parsed_hash(0), parsed_from_buffer(false)
     {
-        // this->index = clang_createIndex(1, 1);
-        this->tu = clang_parseTranslationUnit(get_index(), filename, args, argv, NULL, 0, parse_options());
-        detach_async([=]() { this->reparse(); });
+        this->parsed = this->parsed_promise.get_future().share();
     }
 
-    translation_unit(const translation_unit&) = delete;
+    // The tu is parsed outside of the constructor, so it can be shared with
+    // other threads, which can wait on the parse with `wait_parsed`. Unless
+    // it is loaded from the cache or `fast_first` is unset, the first parse
+    // is a fast one, which is upgraded to a full parse later.
+    void parse(bool fast_first=true)
+    {
+        try_void([&]
+        {
+            auto lock = lock_timed(this->m, tu_lock_wait);
+            this->parsed_mtime = get_mtime(this->filename);
+            if (!this->unsafe_load_cache())
+            {
+#if CLANG_COMPLETE_HAS_FAST_PARSE
+                this->fast = fast_first and fast_parse.load();
+                this->preamble = this->fast;
+                if (this->fast) this->tu = this->parse_file(fast_parse_options(), fast_parse_latency);
+                else this->tu = this->parse_file();
+#else
+                this->tu = this->parse_file();
+#endif
+            }
+            this->unsafe_set_parsed(nullptr);
+            this->memory = this->unsafe_memory_usage();
+        });
+        this->parsed_promise.set_value();
+    }
 
-    cursor get_cursor_at(unsigned long line, unsigned long col, const char * name=nullptr)
+    bool is_from_cache() const
     {
-        if (name == nullptr) name = this->filename.c_str();
-        CXFile f = clang_getFile(this->tu, name);
-        CXSourceLocation loc = clang_getLocation(this->tu, f, line, col);
-        return cursor(clang_getCursor(this->tu, loc), this->tu);
+        return this->from_cache;
     }
 
-    void reparse(const char * buffer=nullptr, unsigned len=0)
+    bool is_fast() const
     {
-        std::lock_guard<std::timed_mutex> lock(this->m);
-        this->unsafe_reparse(buffer, len);
+        return this->fast;
     }
 
-    struct usage
+    // An AST loaded from the cache is enough to navigate, but it can't be
+    // reparsed or complete code, and a fast parse misses what is in the
+    // function bodies of the headers. This parses the file in full without
+    // holding the lock, so the old tu keeps answering queries until it is
+    // swapped out. Unless `wait` is set, nothing is done while another
+    // upgrade is running. With `force`, a full tu is parsed again from
+    // scratch.
+    void upgrade(bool wait=true, bool force=false)
     {
-        CXTUResourceUsage u;
+        std::unique_lock<std::mutex> guard(this->upgrade_mutex, std::defer_lock);
+        if (wait) guard.lock();
+        else if (!guard.try_lock()) return;
+        if (!force and !this->from_cache and !this->fast) return;
+        std::time_t mtime = get_mtime(this->filename);
+#if CLANG_COMPLETE_HAS_FAST_PARSE
+        CXTranslationUnit tu = this->parse_file(full_parse_options());
+        if (tu == nullptr) return;
+#else
+        CXTranslationUnit tu = this->parse_file();
+        if (tu == nullptr) return;
+        // Reparse right away to build the preamble
+        clang_reparseTranslationUnit(tu, 0, nullptr, parse_options());
+#endif
+        {
+            auto lock = lock_timed(this->m, tu_lock_wait);
+            std::swap(this->tu, tu);
+            this->from_cache = false;
+            this->fast = false;
+            this->suspended = false;
+            this->preamble = true;
+            this->unsafe_set_parsed(nullptr);
+            this->parsed_mtime = mtime;
+            this->memory = this->unsafe_memory_usage();
+            this->reparses++;
+        }
+        clang_disposeTranslationUnit(tu);
+    }
 
-        typedef CXTUResourceUsageEntry* iterator;
+    // The AST is saved from the tu until it has a preamble. After that, it
+    // depends on the precompiled preamble, which doesn't outlive the tu, so
+    // unless `parse` is unset, the AST is saved from a parse of its own. The
+    // parse runs without the lock, so it doesn't hold up queries.
+    void save_cache(bool parse=true)
+    {
+        std::string path = get_ast_cache_path(this->filename, this->args);
+        if (path.empty() or is_ast_cache_current(path, this->filename, this->args)) return;
+        {
+            auto lock = lock_timed(this->m, tu_lock_wait);
+            if (this->tu != nullptr and !this->preamble and !this->from_cache and !this->suspended)
+            {
+                // Only save an AST that matches the file on disk
+                if (get_mtime(this->filename) != this->parsed_mtime) return;
+                if (save_ast_cache(path, this->filename, this->args, this->tu, get_dependencies(this->tu, this->args))) evict_ast_cache();
+                return;
+            }
+        }
+        if (!parse) return;
+        std::time_t mtime = get_mtime(this->filename);
+        std::vector<const char *> argv;
+        for(const auto& arg:this->args) argv.push_back(arg.c_str());
+        std::shared_ptr<CXTranslationUnitImpl> tu(clang_parseTranslationUnit(this->index.get(), this->filename.c_str(), 
+            argv.data(), argv.size(), NULL, 0, CXTranslationUnit_DetailedPreprocessingRecord | CXTranslationUnit_Incomplete), 
+            &clang_disposeTranslationUnit);
+        // Only save an AST that matches the file on disk
+        if (tu == nullptr or get_mtime(this->filename) != mtime) return;
+        if (save_ast_cache(path, this->filename, this->args, tu.get(), get_dependencies(tu.get(), this->args))) evict_ast_cache();
+    }
+
+    bool wait_parsed(int timeout=-1)
+    {
+        if (timeout < 0) this->parsed.wait();
+        else if (this->parsed.wait_for(std::chrono::milliseconds(timeout)) != std::future_status::ready) return false;
+        return true;
+    }
+
+    translation_unit(const translation_unit&) = delete;
+
+    cursor get_cursor_at(unsigned long line, unsigned long col, const char * name=nullptr)
+    {
+        if (name == nullptr) name = this->filename.c_str();
+        CXFile f = clang_getFile(this->tu, name);
+        CXSourceLocation loc = clang_getLocation(this->tu, f, line, col);
+        return cursor(clang_getCursor(this->tu, loc), this->tu);
+    }
+
+    void reparse(std::shared_ptr<const std::string> buffer=nullptr)
+    {
+        if (this->from_cache)
+        {
+            // The AST is still current while the file is unchanged
+            if (buffer == nullptr and get_mtime(this->filename) == this->parsed_mtime) return;
+            this->upgrade();
+            if (this->from_cache) return;
+        }
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        this->unsafe_reparse(std::move(buffer));
+    }
+
+    // Whether the tu was last parsed with the contents of the unsaved buffer,
+    // or with the file on disk as it is now when the buffer is null. The
+    // headers aren't checked, see `dependencies_changed`.
+    bool is_parsed_with(const std::shared_ptr<const std::string>& buffer)
+    {
+        std::size_t hash = buffer == nullptr ? 0 : std::hash<std::string>()(*buffer);
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        if (this->suspended or this->parsed_from_buffer != (buffer != nullptr)) return false;
+        if (buffer != nullptr) return hash == this->parsed_hash;
+        return get_mtime(this->filename) == this->parsed_mtime;
+    }
+
+    // Whether a header changed on disk since the tu was last parsed. The
+    // files are checked without holding the lock.
+    bool dependencies_changed()
+    {
+        dependency_list dependencies;
+        {
+            auto lock = lock_timed(this->m, tu_lock_wait);
+            dependencies = this->dependencies;
+        }
+        return std::any_of(dependencies.begin(), dependencies.end(), [](const dependency_list::value_type& d)
+        {
+            return get_mtime(d.first) != d.second;
+        });
+    }
+
+    // Brings the tu up to date with the unsaved buffer, or the file on disk
+    // when it is null. Nothing is done while neither they nor the headers
+    // changed. A changed header forces a fresh parse, since the preamble
+    // built from it can't be trusted. Returns whether the tu was parsed.
+    bool update(std::shared_ptr<const std::string> buffer=nullptr)
+    {
+        bool changed = this->dependencies_changed();
+        if (!changed and this->is_parsed_with(buffer))
+        {
+            reparses_skipped.add();
+            return false;
+        }
+        if (changed)
+        {
+            this->upgrade(true, true);
+            // The fresh parse already read the file on disk
+            if (buffer == nullptr and !this->from_cache) return true;
+        }
+        this->reparse(std::move(buffer));
+        return true;
+    }
+
+    // Drop the preamble and AST to free memory. The tu is transparently
+    // reparsed the next time it is used. Returns false if the tu is busy or
+    // suspending isn't supported, in which case the tu should be freed instead.
+    bool suspend()
+    {
+#if CLANG_COMPLETE_HAS_SUSPEND
+        std::unique_lock<std::timed_mutex> lock(this->m, std::try_to_lock);
+        if (!lock.owns_lock() or this->from_cache) return false;
+        if (!this->suspended and this->tu != nullptr and clang_suspendTranslationUnit(this->tu))
+        {
+            this->suspended = true;
+            this->memory = 0;
+        }
+        return this->suspended;
+#else
+        return false;
+#endif
+    }
+
+    void resume()
+    {
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        this->unsafe_resume();
+    }
+
+    bool is_suspended() const
+    {
+        return this->suspended;
+    }
+
+    std::size_t get_memory() const
+    {
+        return this->memory;
+    }
+
+    void touch()
+    {
+        static std::atomic<unsigned long> ticks{0};
+        this->last_used = ++ticks;
+    }
+
+    unsigned long get_last_used() const
+    {
+        return this->last_used;
+    }
+
+    // Counts how many times the tu was parsed, so results from an older
+    // parse can be told apart
+    unsigned long get_reparses() const
+    {
+        return this->reparses;
+    }
+
+    const std::string& get_filename() const
+    {
+        return this->filename;
+    }
+
+    const std::vector<std::string>& get_args() const
+    {
+        return this->args;
+    }
+
+    struct include
+    {
+        std::string filename;
+        // The line of the include in the main file the file comes through,
+        // and whether the main file includes it itself
+        unsigned line;
+        bool direct;
+        // Whether the file has include guards or `#pragma once`
+        bool guarded;
+    };
+
+    // The files the main file includes. Files included from the command line
+    // are skipped.
+    std::vector<include> get_includes()
+    {
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        std::vector<include> result;
+        if (this->tu == nullptr or this->suspended) return result;
+        struct visitor_data
+        {
+            CXTranslationUnit tu;
+            CXFile main_file;
+            std::vector<include>& result;
+        } data{this->tu, clang_getFile(this->tu, this->filename.c_str()), result};
+        clang_getInclusions(this->tu, [](CXFile f, CXSourceLocation * stack, unsigned n, CXClientData d)
+        {
+            if (n == 0) return;
+            auto& data = *static_cast<visitor_data*>(d);
+            CXFile file;
+            unsigned line;
+            clang_getSpellingLocation(stack[n-1], &file, &line, nullptr, nullptr);
+            if (clang_File_isEqual(file, data.main_file)) 
+                data.result.push_back(include{to_std_string(clang_getFileName(f)), line, n == 1, clang_isFileMultipleIncludeGuarded(data.tu, f) != 0});
+        }, &data);
+        return result;
+    }
+
+    struct usage
+    {
+        CXTUResourceUsage u;
+
+        typedef CXTUResourceUsageEntry* iterator;
 
         usage(CXTUResourceUsage u) : u(u)
         {}
@@ -428,10 +1300,13 @@ public:
         }
     };
 
-    std::unordered_map<std::string, unsigned long> get_usage()
+    std::unordered_map<std::string, unsigned long> get_usage(int timeout=-1)
     {
-        std::lock_guard<std::timed_mutex> lock(this->m);
+        std::unique_lock<std::timed_mutex> lock(this->m, std::defer_lock);
+        if (timeout < 0) lock.lock();
+        else if (!lock.try_lock_for(std::chrono::milliseconds(timeout))) return {};
         std::unordered_map<std::string, unsigned long> result;
+        if (this->suspended or this->tu == nullptr) return result;
         auto u = std::make_shared<usage>(clang_getCXTUResourceUsage(this->tu));
         for(CXTUResourceUsageEntry e:*u)
         {
@@ -442,33 +1317,101 @@ public:
     }
 
 
-    typedef std::tuple<std::size_t, std::string, std::string> completion;
+    // The priority, display text, replacement and typed text of a completion
+    typedef std::tuple<std::size_t, std::string, std::string, std::string> completion;
 
-    std::vector<completion> complete_at(unsigned line, unsigned col, const char * prefix, const char * buffer=nullptr, unsigned len=0)
+    // What filtering and ranking need to know about a completion, with its
+    // typed text stored in the string table of its set
+    struct completion_candidate
     {
-        std::lock_guard<std::timed_mutex> lock(this->m);
-        TIMER();
-        std::vector<completion> results;
+        unsigned index;
+        unsigned priority;
+        unsigned typed;
+        unsigned typed_size;
+    };
+
+    // The results of one call to clang. Only the priority and typed text of
+    // each are read up front, since most of them are filtered out, and
+    // `format` builds the rest for the ones that are returned. The typed
+    // text is interned, so overloads share it.
+    class completion_set
+    {
+        completion_results results;
+        std::vector<completion_candidate> candidates;
+        std::string strings;
+
+        unsigned intern(const std::string& text, std::unordered_map<std::string, unsigned>& ids)
+        {
+            auto it = ids.find(text);
+            if (it != ids.end()) return it->second;
+            unsigned id = this->strings.size();
+            this->strings.append(text).push_back('\0');
+            ids.emplace(text, id);
+            return id;
+        }
+    public:
+        completion_set(completion_results r) : results(std::move(r))
+        {
+            std::unordered_map<std::string, unsigned> ids;
+            this->candidates.reserve(this->results.size());
+            unsigned index = 0;
+            for(auto& c:this->results)
+            {
+                unsigned i = index++;
+                if (clang_getCompletionAvailability(c.CompletionString) != CXAvailability_Available) continue;
+                // A completion without anything to insert is skipped
+                bool insertable = false;
+                int typed_chunk = -1;
+                int num = clang_getNumCompletionChunks(c.CompletionString);
+                for(int j=0;j<num;j++)
+                {
+                    switch (clang_getCompletionChunkKind(c.CompletionString, j))
+                    {
+                    case CXCompletionChunk_ResultType:
+                    case CXCompletionChunk_Text:
+                    case CXCompletionChunk_Informative:
+                    case CXCompletionChunk_Equal:
+                    case CXCompletionChunk_Optional:
+                    case CXCompletionChunk_SemiColon:
+                        break;
+                    case CXCompletionChunk_TypedText:
+                        if (typed_chunk < 0) typed_chunk = j;
+                        insertable = true;
+                        break;
+                    default:
+                        insertable = true;
+                        break;
+                    }
+                }
+                if (!insertable) continue;
+                unsigned priority = clang_getCompletionPriority(c.CompletionString);
+                std::string typed;
+                if (typed_chunk >= 0) typed = to_std_string(clang_getCompletionChunkText(c.CompletionString, typed_chunk));
+                // Lower priority for completions that start with `operator` and `~`
+                if (starts_with(typed.c_str(), "operator") or starts_with(typed.c_str(), "~")) priority = std::numeric_limits<unsigned>::max();
+                this->candidates.push_back(completion_candidate{i, priority, this->intern(typed, ids), unsigned(typed.size())});
+            }
+        }
 
-        std::string display;
-        std::string replacement;
-        std::string description;
-        char buf[1024];
-        auto completions = this->completions_at(line, col, buffer, len);
-        DUMP_LOG_TIME("Clang to complete");
-        results.reserve(completions.size());
-        for(auto& c:completions)
+        const std::vector<completion_candidate>& get_candidates() const
         {
-            auto priority = clang_getCompletionPriority(c.CompletionString);
-            auto ck = c.CursorKind;
-            auto num = clang_getNumCompletionChunks(c.CompletionString);
+            return this->candidates;
+        }
 
-            display.reserve(num*8);
-            replacement.reserve(num*8);
-            description.clear();
+        const char * get_typed_text(const completion_candidate& c) const
+        {
+            return this->strings.c_str() + c.typed;
+        }
 
+        completion format(const completion_candidate& c) const
+        {
+            CXCompletionResult& r = this->results.results->Results[c.index];
+            std::string display;
+            std::string replacement;
+            std::string description;
+            char buf[32];
             std::size_t idx = 1;
-            for_each_completion_string(c, [&](const std::string& text, CXCompletionChunkKind kind)
+            for_each_completion_string(r.CompletionString, [&](const char * text, CXCompletionChunkKind kind)
             {
                 switch (kind) 
                 {
@@ -491,15 +1434,15 @@ public:
                 case CXCompletionChunk_TypedText:
                     display += text;
                     replacement += text;
-                    if (ck == CXCursor_Constructor)
+                    if (r.CursorKind == CXCursor_Constructor)
                     {
-                        std::snprintf(buf, 1024, "%lu", idx++);
+                        std::snprintf(buf, sizeof(buf), "%lu", idx++);
                         replacement.append(" ${").append(buf).append(":v}");
                     }
                     break;
                 case CXCompletionChunk_Placeholder:
                     display += text;
-                    std::snprintf(buf, 1024, "%lu", idx++);
+                    std::snprintf(buf, sizeof(buf), "%lu", idx++);
                     replacement.append("${").append(buf).append(":").append(text).append("}");
                     break;
                 case CXCompletionChunk_ResultType:
@@ -514,16 +1457,18 @@ public:
                 }
             });
             display.append("\t").append(description);
-            // Lower priority for completions that start with `operator` and `~`
-            if (starts_with(display.c_str(), "operator") or starts_with(display.c_str(), "~")) priority = std::numeric_limits<decltype(priority)>::max();
-            if (not display.empty() and not replacement.empty() and starts_with(display.c_str(), prefix)) 
-                results.emplace_back(priority, std::move(display), std::move(replacement));
-        }
-        std::sort(results.begin(), results.end());
-        // Perhaps a reparse can help rejuvenate clang?
-        // if (results.size() == 0) this->unsafe_reparse(buffer, len);
-        DUMP_LOG_TIME("Process completions");
-        DUMP(results.size());
+            return completion(c.priority, std::move(display), std::move(replacement), this->get_typed_text(c));
+        }
+    };
+
+    std::shared_ptr<const completion_set> complete_at(unsigned line, unsigned col, const char * buffer=nullptr, unsigned len=0)
+    {
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        this->unsafe_resume();
+        this->preamble = true;
+        scoped_latency latency(code_complete_latency);
+        auto results = std::make_shared<const completion_set>(this->completions_at(line, col, buffer, len));
+        DUMP(results->get_candidates().size());
         return results;
     }
 
@@ -536,8 +1481,9 @@ public:
         }
         else
         {
-            if (!lock.try_lock_for(std::chrono::milliseconds(timeout))) return {};
+            if (!try_lock_timed(lock, timeout, tu_lock_wait)) return {};
         }
+        this->unsafe_resume();
         std::vector<std::string> result;
         auto n = clang_getNumDiagnostics(this->tu);
         for(int i=0;i<n;i++)
@@ -552,11 +1498,14 @@ public:
         return result;
     }
 
-    std::string get_definition(unsigned line, unsigned col)
+    // The position can be in any file the tu includes, and is in the main
+    // file when the name is null
+    std::string get_definition(unsigned line, unsigned col, const char * name=nullptr)
     {
-        std::lock_guard<std::timed_mutex> lock(this->m);
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        this->unsafe_resume();
         std::string result;
-        cursor c = this->get_cursor_at(line, col);
+        cursor c = this->get_cursor_at(line, col, name);
         DUMP(c.get_display_name());
         cursor ref = c.get_reference();
         DUMP(ref.is_null());
@@ -572,20 +1521,34 @@ public:
         return result;
     }
 
-    std::string get_type(unsigned line, unsigned col)
+    std::string get_type(unsigned line, unsigned col, const char * name=nullptr)
     {
-        std::lock_guard<std::timed_mutex> lock(this->m);
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        this->unsafe_resume();
 
-        return this->get_cursor_at(line, col).get_type_name();
+        return this->get_cursor_at(line, col, name).get_type_name();
 
     }
 
-    std::set<std::string> find_uses_in(unsigned line, unsigned col, const char * name=nullptr)
+    // The usr of the symbol at the position, which identifies it across tus
+    std::string get_usr(unsigned line, unsigned col, const char * name=nullptr)
     {
-        std::lock_guard<std::timed_mutex> lock(this->m);
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        this->unsafe_resume();
+        cursor ref = this->get_cursor_at(line, col, name).get_reference();
+        if (ref.is_null()) return {};
+        return ref.get_usr();
+    }
+
+    // Searches the file with the name for uses, and the position is in the
+    // file `at`, both of which default to the main file
+    std::set<std::string> find_uses_in(unsigned line, unsigned col, const char * name=nullptr, const char * at=nullptr)
+    {
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        this->unsafe_resume();
         std::set<std::string> result;
         if (name == nullptr) name = this->filename.c_str();
-        auto c = this->get_cursor_at(line, col);
+        auto c = this->get_cursor_at(line, col, at);
         for(auto oc:c.get_overloaded_cursors())
         {
             oc.find_references(name, [&](cursor ref, CXSourceRange r)
@@ -596,10 +1559,127 @@ public:
         return result;
     }
     
+    // The tokens annotated last, if they cover the lines and the tu wasn't
+    // reparsed since, and was parsed with the unsaved buffer, or the file on
+    // disk as it is now when the buffer is null. Otherwise null. This neither
+    // takes the lock of the tu nor calls clang, and the headers aren't
+    // checked, so it can be asked on every hover.
+    std::shared_ptr<const annotation_set> get_current_annotations(const std::shared_ptr<const std::string>& buffer, unsigned begin_line, unsigned end_line)
+    {
+        std::shared_ptr<const annotation_set> a;
+        {
+            std::lock_guard<std::mutex> lock(this->annotations_mutex);
+            a = this->annotations;
+        }
+        if (a == nullptr or a->reparses != this->reparses or begin_line < a->begin_line or a->end_line < end_line) return nullptr;
+        if (a->from_buffer != (buffer != nullptr)) return nullptr;
+        if (buffer != nullptr) return a->hash == std::hash<std::string>()(*buffer) ? a : nullptr;
+        return a->mtime == get_mtime(this->filename) ? a : nullptr;
+    }
+
+    // The lines are one based and inclusive. The last tokens annotated are
+    // kept, so asking again for the same lines, or fewer of them, doesn't
+    // ask clang again until the tu is reparsed.
+    std::shared_ptr<const annotation_set> get_annotations(unsigned begin_line, unsigned end_line)
+    {
+        {
+            std::lock_guard<std::mutex> lock(this->annotations_mutex);
+            auto a = this->annotations;
+            if (a != nullptr and a->reparses == this->reparses and a->begin_line <= begin_line and end_line <= a->end_line) return a;
+        }
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        this->unsafe_resume();
+        scoped_latency latency(annotate_latency);
+        auto result = std::make_shared<annotation_set>();
+        result->reparses = this->reparses;
+        result->from_buffer = this->parsed_from_buffer;
+        result->hash = this->parsed_hash;
+        result->mtime = this->parsed_mtime;
+        result->begin_line = begin_line;
+        result->end_line = end_line;
+        result->strings.push_back("");
+        std::unordered_map<std::string, unsigned> ids;
+        auto intern = [&](std::string str) -> unsigned
+        {
+            if (str.empty()) return 0;
+            auto it = ids.find(str);
+            if (it != ids.end()) return it->second;
+            result->strings.push_back(str);
+            return ids.emplace(std::move(str), result->strings.size() - 1).first->second;
+        };
+        CXFile file = clang_getFile(this->tu, this->filename.c_str());
+        // Lines past the end of the file are clamped to it
+        CXSourceRange range = clang_getRange(clang_getLocation(this->tu, file, begin_line, 1), clang_getLocation(this->tu, file, end_line + 1, 1));
+        CXToken * tokens = nullptr;
+        unsigned n = 0;
+        clang_tokenize(this->tu, range, &tokens, &n);
+        std::vector<CXCursor> cursors(n);
+        if (n > 0) clang_annotateTokens(this->tu, tokens, n, cursors.data());
+        result->tokens.reserve(n);
+        for(unsigned i=0;i<n;i++)
+        {
+            unsigned line, col;
+            clang_getSpellingLocation(clang_getTokenLocation(this->tu, tokens[i]), nullptr, &line, &col, nullptr);
+            if (line < begin_line or line > end_line) continue;
+            CXTokenKind kind = clang_getTokenKind(tokens[i]);
+            cursor c(cursors[i], this->tu);
+            annotation a{line, col, unsigned(to_std_string(clang_getTokenSpelling(this->tu, tokens[i])).size()), intern(get_token_kind_name(kind)), 0, 0, 0};
+            if (!clang_isInvalid(c.get_kind())) a.cursor = intern(to_std_string(clang_getCursorKindSpelling(c.get_kind())));
+            if (kind == CXToken_Identifier and a.cursor != 0)
+            {
+                a.type = intern(c.get_type_name());
+                cursor ref = c.get_reference();
+                if (!ref.is_null()) a.reference = intern(ref.get_location_path());
+            }
+            result->tokens.push_back(a);
+        }
+        if (tokens != nullptr) clang_disposeTokens(this->tu, tokens, n);
+        {
+            std::lock_guard<std::mutex> lock(this->annotations_mutex);
+            this->annotations = result;
+        }
+        return result;
+    }
+
+    // Keeps the completions whose typed text fuzzy matches the prefix, and
+    // orders them by how well they match, with clang's priority breaking near
+    // ties. Only the best `limit` are sorted and formatted, zero means all.
+    static std::vector<completion> rank_completions(const completion_set& completions, const std::string& prefix, std::size_t limit)
+    {
+        typedef std::pair<long, const completion_candidate*> ranked_completion;
+        std::vector<ranked_completion> ranked;
+        ranked.reserve(completions.get_candidates().size());
+        for(const auto& c:completions.get_candidates())
+        {
+            long rank = std::min<std::size_t>(c.priority, 100);
+            if (!prefix.empty())
+            {
+                int score = fuzzy_score(prefix, completions.get_typed_text(c), c.typed_size);
+                if (score < 0) continue;
+                rank -= score * 8;
+            }
+            ranked.emplace_back(rank, &c);
+        }
+        if (limit == 0 or limit > ranked.size()) limit = ranked.size();
+        std::partial_sort(ranked.begin(), ranked.begin() + limit, ranked.end(), [&](const ranked_completion& x, const ranked_completion& y)
+        {
+            if (x.first != y.first) return x.first < y.first;
+            int order = std::strcmp(completions.get_typed_text(*x.second), completions.get_typed_text(*y.second));
+            // Overloads stay in the order clang returned them
+            if (order != 0) return order < 0;
+            return x.second->index < y.second->index;
+        });
+        scoped_latency latency(format_completions_latency);
+        std::vector<completion> results;
+        results.reserve(limit);
+        for(std::size_t i=0;i<limit;i++) results.push_back(completions.format(*ranked[i].second));
+        return results;
+    }
+
     ~translation_unit()
     {
-        std::lock_guard<std::timed_mutex> lock(this->m);
-        clang_disposeTranslationUnit(this->tu);
+        auto lock = lock_timed(this->m, tu_lock_wait);
+        if (this->tu != nullptr) clang_disposeTranslationUnit(this->tu);
     }
 };
 
@@ -608,103 +1688,259 @@ class async_translation_unit : public translation_unit, public std::enable_share
 
     struct query
     {
-        std::future<std::vector<completion>> results_future;
-        std::vector<completion> results;
+        // Shared, so it can be waited on without holding the lock
+        std::shared_future<std::shared_ptr<const completion_set>> results_future;
+        std::shared_ptr<const completion_set> results;
         unsigned line;
         unsigned col;
+        // A hash of the buffer before the position, and the reparse the
+        // results came from
+        std::size_t context;
+        unsigned long reparses;
 
-        query() : line(0), col(0)
+        query(std::future<std::shared_ptr<const completion_set>> && results_future, unsigned line, unsigned col, std::size_t context, unsigned long reparses)
+        : results_future(results_future.share()), line(line), col(col), context(context), reparses(reparses)
         {}
 
-        std::pair<unsigned, unsigned> get_loc()
-        {
-            return std::make_pair(this->line, this->col);
-        }
-
-        void set(std::future<std::vector<completion>> && results_future, unsigned line, unsigned col)
+        bool matches(unsigned line, unsigned col, std::size_t context) const
         {
-            this->results = {};
-            this->results_future = std::move(results_future);
-            this->line = line;
-            this->col = col;
+            return this->line == line and this->col == col and this->context == context;
         }
 
-        std::vector<completion> get(int timeout)
+        std::shared_ptr<const completion_set> get(int timeout)
         {
-            if (results_future.valid() and this->ready(timeout))
+            if (results_future.valid())
             {
-                this->results = this->results_future.get();
-                // Force another query if completion results are empty
-                if (this->results.size() == 0) std::tie(line, col) = std::make_pair(0, 0);
+                if (this->ready(timeout))
+                {
+                    this->results = this->results_future.get();
+                    this->results_future = {};
+                }
+                else if (timeout > 0) completion_timeouts.add();
             }
             return this->results;
         }
 
         bool ready(int timeout = 10)
         {
-            if (results_future.valid()) return (timeout > 0 and results_future.wait_for(std::chrono::milliseconds(timeout)) == std::future_status::ready);
+            if (results_future.valid()) return results_future.wait_for(std::chrono::milliseconds(std::max(timeout, 0))) == std::future_status::ready;
             else return true;
         }
 
+        bool pending()
+        {
+            return results_future.valid() and results_future.wait_for(std::chrono::seconds(0)) != std::future_status::ready;
+        }
     };
     std::timed_mutex async_mutex;
-    query q;
+    // The most recently used positions come first
+    std::list<query> queries;
+    static const std::size_t max_queries = 8;
+    // Incremented for every new completion position, so queued completions
+    // for older positions can be dropped
+    std::atomic<unsigned long> generation;
 
 public:
-    async_translation_unit(const char * filename, const char ** args, int argv) : translation_unit(filename, args, argv)
+    async_translation_unit(const char * filename, const char ** args, int argv) : translation_unit(filename, args, argv), generation(0)
     {}
 
 
-    std::vector<completion> async_complete_at(unsigned line, unsigned col, const char * prefix, int timeout, const char * buffer=nullptr, unsigned len=0)
+    // The results for the last few positions are kept, so narrowing them down
+    // as more of the prefix is typed, or coming back to a position, doesn't
+    // ask clang again. Once the tu is reparsed, clang is asked again, but
+    // until it answers, the results from before are returned instead of
+    // nothing. The buffer is shared with the query instead of copied, and
+    // null means the file is read from disk.
+    std::vector<completion> async_complete_at(unsigned line, unsigned col, const char * prefix, int timeout, std::size_t limit, std::shared_ptr<const std::string> buffer=nullptr)
     {
         DUMP_FUNCTION
+        completion_requests.add();
         std::unique_lock<std::timed_mutex> lock(this->async_mutex, std::defer_lock);
-        if (!lock.try_lock_for(std::chrono::milliseconds(20))) return {};
-        
-        if (std::make_pair(line, col) != q.get_loc())
+        if (!try_lock_timed(lock, 20, tu_lock_wait)) return {};
+        if (this->is_from_cache())
+        {
+            auto self = this->shared_from_this();
+            get_pool().async(task_priority::query, [self] { self->upgrade(false); });
+            return {};
+        }
+
+        std::size_t context = 0;
+        // Edits after the position are left out, so typing the prefix
+        // still finds the results
+        if (buffer != nullptr) context = std::hash<std::string>()(get_text_before(*buffer, line, col));
+        unsigned long reparses = this->get_reparses();
+        auto it = std::find_if(this->queries.begin(), this->queries.end(), [&](const query& x) 
+        { 
+            return x.reparses == reparses and x.matches(line, col, context); 
+        });
+        if (it != this->queries.end())
+        {
+            completion_cache_hits.add();
+            this->queries.splice(this->queries.begin(), this->queries, it);
+        }
+        else
         {
-            // If we are busy with a query, lets avoid making lots of new queries
-            if (not this->q.ready()) return {};
-            
+            // Queries that haven't run yet are skipped once they are
+            // superseded, so they never get results to keep
+            this->queries.remove_if([](query& x) { return x.pending(); });
+            unsigned long current = ++this->generation;
             std::weak_ptr<async_translation_unit> self = this->shared_from_this();
-            std::string buffer_as_string(buffer, buffer+len);
-            this->q.set(detach_async([=]
+            this->queries.emplace_front(get_pool().async(task_priority::completion, [=]
             {
-                auto b = buffer_as_string.c_str();
-                if (buffer == nullptr) b = nullptr;
+                const char * b = nullptr;
+                unsigned len = 0;
+                if (buffer != nullptr)
+                {
+                    b = buffer->data();
+                    len = buffer->size();
+                }
                 // TODO: Should we always reparse?
                 // else this->reparse(b, len);
-                if (auto s = self.lock())
+                auto s = self.lock();
+                // Skip the query if the tu is gone or a newer position was
+                // requested while it was queued
+                if (s and s->generation == current)
                 {
-                    return s->complete_at(line, col, "", b, buffer_as_string.length());
+                    return s->complete_at(line, col, b, len);
                 }
                 else
                 {
-                    return std::vector<completion>();
+                    return std::shared_ptr<const completion_set>();
                 }
-            }), line, col);
+            }), line, col, context, reparses);
+            if (this->queries.size() > max_queries) this->queries.pop_back();
         }
-        auto completions = q.get(timeout);
-        if (prefix != nullptr and *prefix != 0)
+        auto results = this->queries.front().get(timeout);
+        auto stale = std::find_if(std::next(this->queries.begin()), this->queries.end(), [&](const query& x) 
+        { 
+            return x.matches(line, col, context); 
+        });
+        if (results != nullptr) 
         {
-            std::string pre = prefix;
-            std::vector<completion> results;
-            std::copy_if(completions.begin(), completions.end(), inserter(results, results.begin()), [&](const completion& x)
-            { 
-                return istarts_with(std::get<2>(x), pre); 
-            });
-            return std::move(results);
+            if (stale != this->queries.end()) this->queries.erase(stale);
         }
-        else
+        else if (stale != this->queries.end()) 
+        {
+            stale_completions.add();
+            results = stale->get(0);
+        }
+        if (results == nullptr) return {};
+        return rank_completions(*results, prefix == nullptr ? "" : prefix, limit);
+    }
+
+    // Waits until the completions at the position are done, or returns false
+    // after the timeout. A tu loaded from the cache can't complete until it
+    // is upgraded, so that is waited for as well.
+    bool wait_completions(unsigned line, unsigned col, int timeout)
+    {
+        auto deadline = std::chrono::steady_clock::now() + std::chrono::milliseconds(timeout);
+        while (this->is_from_cache())
+        {
+            if (timeout >= 0 and std::chrono::steady_clock::now() >= deadline) return false;
+            std::this_thread::sleep_for(std::chrono::milliseconds(20));
+        }
+        std::shared_future<std::shared_ptr<const completion_set>> results;
         {
-            return std::move(completions);
+            auto lock = lock_timed(this->async_mutex, tu_lock_wait);
+            auto it = std::find_if(this->queries.begin(), this->queries.end(), [&](const query& x) { return x.line == line and x.col == col; });
+            if (it == this->queries.end() or !it->results_future.valid()) return true;
+            results = it->results_future;
         }
+        if (timeout < 0) results.wait();
+        else if (results.wait_until(deadline) != std::future_status::ready) return false;
+        return true;
+    }
+
+    // Drops the results for positions below the row, which is zero based, or
+    // all of them when the row is negative. An edit on the row of a position
+    // keeps its results, so typing the prefix narrows them down, and an edit
+    // before the position on that row changes its context hash instead.
+    void invalidate_completions(long row=-1)
+    {
+        std::lock_guard<std::timed_mutex> lock(this->async_mutex);
+        this->queries.remove_if([&](const query& x) { return row < 0 or long(x.line) - 1 > row; });
     }
 };
 
 std::timed_mutex tus_mutex{};
 std::unordered_map<std::string, std::shared_ptr<async_translation_unit>> tus;
 
+// The last unsaved contents of each file, along with the editor's change
+// count for it. This lets the editor send only what changed since then,
+// instead of the whole buffer on every request.
+struct unsaved_buffer
+{
+    unsigned change_count;
+    std::shared_ptr<std::string> contents;
+};
+
+std::mutex buffers_mutex{};
+std::unordered_map<std::string, unsaved_buffer> buffers;
+
+std::shared_ptr<const std::string> get_unsaved_buffer(const std::string& filename)
+{
+    std::lock_guard<std::mutex> lock(buffers_mutex);
+    auto it = buffers.find(filename);
+    if (it == buffers.end()) return nullptr;
+    return it->second.contents;
+}
+
+// The byte offset of a column in the line `row`, both zero based, where the
+// column is counted in bytes
+std::size_t get_offset(const std::string& s, unsigned row, unsigned col)
+{
+    std::size_t pos = 0;
+    for(unsigned i=0;i<row;i++)
+    {
+        pos = s.find('\n', pos);
+        if (pos == std::string::npos) return pos;
+        pos++;
+    }
+    if (pos + col > s.size()) return std::string::npos;
+    return pos + col;
+}
+
+std::size_t count_code_points(const std::string& s)
+{
+    return std::count_if(s.begin(), s.end(), [](char c) { return (c & 0xC0) != 0x80; });
+}
+
+// Apply one edit to the buffer if it is at `change_count`, and move it to
+// `new_change_count`. When `size` isn't negative, the buffer must have that
+// many code points after the edit. If the edit can't be applied, the buffer is
+// dropped, so the editor has to send the whole buffer again.
+bool edit_unsaved_buffer(const std::string& filename, unsigned change_count, unsigned new_change_count, 
+    unsigned begin_row, unsigned begin_col, unsigned end_row, unsigned end_col, const char * text, unsigned len, int size)
+{
+    std::lock_guard<std::mutex> lock(buffers_mutex);
+    auto it = buffers.find(filename);
+    if (it == buffers.end()) return false;
+    if (it->second.change_count != change_count)
+    {
+        // A newer buffer is kept
+        if (it->second.change_count < change_count) buffers.erase(it);
+        return false;
+    }
+    auto& contents = it->second.contents;
+    std::size_t first = get_offset(*contents, begin_row, begin_col);
+    std::size_t last = get_offset(*contents, end_row, end_col);
+    if (first == std::string::npos or last == std::string::npos or last < first)
+    {
+        buffers.erase(it);
+        return false;
+    }
+    // Queries still using the old contents keep their own copy
+    if (!contents.unique()) contents = std::make_shared<std::string>(*contents);
+    contents->replace(first, last - first, text, len);
+    if (size >= 0 and count_code_points(*contents) != std::size_t(size))
+    {
+        buffers.erase(it);
+        return false;
+    }
+    it->second.change_count = new_change_count;
+    return true;
+}
+
 
 
 // #ifdef __MACH__
@@ -731,73 +1967,1205 @@ std::unordered_map<std::string, std::shared_ptr<async_translation_unit>> tus;
 //     return std::chrono::steady_clock::time_point(std::chrono::seconds(tp.tv_sec) + std::chrono::nanoseconds(tp.tv_nsec));
 // }
 
-std::shared_ptr<async_translation_unit> get_tu(const char * filename, const char ** args, int argv, int timeout=-1)
+// Limits on how many tus are kept fully parsed and how much memory they can
+// use, zero means unlimited
+std::atomic<std::size_t> max_tus{0};
+std::atomic<std::size_t> max_memory{0};
+
+// Walk the tus from most to least recently used. Once the budget is used up,
+// the remaining tus get suspended, and suspended tus beyond the count budget
+// are freed. The most recently used tu is always kept.
+void enforce_cache_budget()
 {
     DUMP_FUNCTION
-    std::unique_lock<std::timed_mutex> lock(tus_mutex, std::defer_lock);
-    DUMP(timeout);
-    if (timeout < 0) lock.lock();
-    else if (!lock.try_lock_until(std::chrono::system_clock::now() + std::chrono::milliseconds(timeout))) return {};
-    if (tus.find(filename) == tus.end())
+    typedef std::pair<std::string, std::shared_ptr<async_translation_unit>> entry;
+    std::vector<entry> entries;
     {
-        tus[filename] = std::make_shared<async_translation_unit>(filename, args, argv);
+        auto lock = lock_timed(tus_mutex, tus_lock_wait);
+        entries.assign(tus.begin(), tus.end());
     }
-    return tus[filename];
-}
+    std::sort(entries.begin(), entries.end(), [](const entry& x, const entry& y)
+    {
+        return x.second->get_last_used() > y.second->get_last_used();
+    });
 
-template<class T>
-std::mutex& get_allocations_mutex()
-{
-    DUMP_FUNCTION
-    static std::mutex m;
-    return m;
+    std::size_t active = 0;
+    std::size_t memory = 0;
+    std::size_t suspended = 0;
+    std::vector<entry> evict;
+    for(auto& e:entries)
+    {
+        auto& tu = e.second;
+        if (!tu->is_suspended())
+        {
+            bool fits = (max_tus == 0 or active < max_tus) and (max_memory == 0 or memory + tu->get_memory() <= max_memory);
+            if (fits or active == 0)
+            {
+                active++;
+                memory += tu->get_memory();
+                continue;
+            }
+            if (!tu->suspend())
+            {
+                // Suspending only fails on a busy tu, which will be
+                // revisited the next time the budget is enforced
+                if (CLANG_COMPLETE_HAS_SUSPEND and !tu->is_from_cache()) continue;
+                evict.push_back(e);
+                continue;
+            }
+        }
+        if (max_tus == 0 or suspended < max_tus) suspended++;
+        else evict.push_back(e);
+    }
+    DUMP(active);
+    DUMP(memory);
+    DUMP(evict.size());
+
+    // Since `evict` outlives the lock, the evicted tus are disposed after the
+    // lock is released
+    auto lock = lock_timed(tus_mutex, tus_lock_wait);
+    for(auto& e:evict)
+    {
+        auto it = tus.find(e.first);
+        if (it != tus.end() and it->second == e.second) tus.erase(it);
+    }
 }
 
-template<class T>
-std::unordered_map<unsigned int, T>& get_allocations()
+// Which file each header is included from, so a header can be parsed like it
+// is in that file, with its flags and after the files it includes first. The
+// graph is built from the includes of the parsed tus and of the project
+// indexes. Each header keeps the file it was first seen in, unless a tu
+// shows it in a file the index already knew, or finds what that file
+// includes before it.
+struct includer
 {
-    DUMP_FUNCTION
-    static std::mutex m;
-    static std::unordered_map<unsigned int, T> allocations;
-    return allocations;
+    std::string source;
+    // The files the source includes itself, of which the first `context`
+    // come before the header
+    std::shared_ptr<const std::vector<std::string>> direct;
+    std::size_t context;
+    bool from_tu;
 };
 
-template<class T>
-unsigned int new_wrapper()
-{
-    DUMP_FUNCTION
-    std::unique_lock<std::mutex> lock(get_allocations_mutex<T>());
-    unsigned int id = (get_allocations<T>().size() * 8 + sizeof(T)) % std::numeric_limits<unsigned int>::max();
-    while (get_allocations<T>().count(id) > 0 and id < (std::numeric_limits<unsigned int>::max() - 1)) id++;
-    assert(get_allocations<T>().count(id) == 0);
-    get_allocations<T>().emplace(id, T());
-    return id;
-} 
+std::mutex include_graph_mutex{};
+std::unordered_map<std::string, includer> include_graph;
 
-template<class T>
-T& unwrap(unsigned int i)
+std::string get_stem(const std::string& filename)
 {
-    DUMP_FUNCTION
-    assert(i > 0);
-    std::unique_lock<std::mutex> lock(get_allocations_mutex<T>());
-    return get_allocations<T>().at(i);
+    std::size_t slash = filename.find_last_of('/');
+    std::size_t dot = filename.find_last_of('.');
+    if (dot == std::string::npos or (slash != std::string::npos and dot < slash)) return filename;
+    return filename.substr(0, dot);
 }
 
-template<class T>
-void free_wrapper(unsigned int i)
+void add_includer(const std::string& header, includer i)
 {
-    DUMP_FUNCTION
-    std::unique_lock<std::mutex> lock(get_allocations_mutex<T>());
-    get_allocations<T>().erase(i);
-} 
+    auto it = include_graph.find(header);
+    if (it == include_graph.end()) include_graph.emplace(header, std::move(i));
+    else if (it->second.source == i.source or (i.from_tu and !it->second.from_tu)) it->second = std::move(i);
+    // A source with the same name as the header is the best example of it
+    else if (!i.from_tu and !it->second.from_tu and get_stem(i.source) == get_stem(header) and get_stem(it->second.source) != get_stem(header)) 
+        it->second = std::move(i);
+}
 
-std::string& get_string(clang_complete_string s)
+void update_include_graph(const std::string& source, std::vector<translation_unit::include> includes)
 {
-    DUMP_FUNCTION
-    return unwrap<std::string>(s);
+    // Inclusions aren't visited in the order of the source
+    std::stable_sort(includes.begin(), includes.end(), [](const translation_unit::include& x, const translation_unit::include& y)
+    {
+        return x.line < y.line;
+    });
+    auto direct = std::make_shared<std::vector<std::string>>();
+    std::vector<unsigned> lines;
+    for(const auto& i:includes)
+    {
+        if (!i.direct) continue;
+        direct->push_back(i.filename);
+        lines.push_back(i.line);
+    }
+    std::lock_guard<std::mutex> lock(include_graph_mutex);
+    // A header that comes through another one is included after the same
+    // files
+    for(const auto& i:includes) 
+        add_includer(i.filename, includer{source, direct, std::size_t(std::lower_bound(lines.begin(), lines.end(), i.line) - lines.begin()), true});
 }
 
-unsigned int new_string(const std::string& s)
+// The file the header is included from, followed by the files that are
+// included before it, or nothing when the header hasn't been seen
+std::vector<std::string> get_includer(const std::string& header)
+{
+    std::lock_guard<std::mutex> lock(include_graph_mutex);
+    auto it = include_graph.find(header);
+    if (it == include_graph.end()) return {};
+    std::vector<std::string> result = { it->second.source };
+    if (it->second.direct != nullptr) result.insert(result.end(), it->second.direct->begin(), it->second.direct->begin() + it->second.context);
+    return result;
+}
+
+// Files parsed with the same args often start with the same headers, which
+// every tu otherwise precompiles into a preamble of its own. Once a few
+// sources start with the same headers, they are precompiled once, as an
+// entry of the AST cache, and the files that start with them are parsed
+// with `-include-pch`. Like any entry of the cache, the pch is only built
+// again once one of its headers changes, and other args get one of their
+// own. The entry also keeps the headers each source starts with, so the pch
+// is used right away after a restart.
+struct shared_pch
+{
+    bool loaded = false;
+    bool building = false;
+    // The headers the pch was built from, and whether it was still current
+    // when it was last checked
+    std::vector<std::string> headers;
+    bool current = false;
+    std::chrono::steady_clock::time_point checked;
+    // Headers that failed to build, so they aren't tried again
+    std::vector<std::string> failed;
+    // The headers each source includes first, in order
+    std::map<std::string, std::vector<std::string>> sources;
+};
+
+std::atomic<bool> shared_pch_enabled{false};
+// How many sources have to start with the same headers to share them
+const std::size_t shared_pch_min_sources = 2;
+std::mutex shared_pch_mutex{};
+// By the path of their entry in the cache
+std::unordered_map<std::string, shared_pch> shared_pchs;
+
+// The args without the shared pch, which is the only pch that can be in the
+// AST cache. The pch is built with these args.
+std::vector<std::string> strip_shared_pch(std::vector<std::string> args)
+{
+    std::string dir;
+    {
+        std::lock_guard<std::mutex> lock(ast_cache_mutex);
+        if (ast_cache_dir.empty()) return args;
+        dir = ast_cache_dir + "/";
+    }
+    for(auto it = args.begin(); it != args.end();)
+    {
+        if (*it == "-include-pch" and std::next(it) != args.end() and std::next(it)->compare(0, dir.size(), dir) == 0) it = args.erase(it, it + 2);
+        else it++;
+    }
+    return args;
+}
+
+// The files a source includes itself, in order, up to the first one without
+// include guards, which can't be included again after the pch. A header with
+// the same name as the source often comes first, and is skipped, since the
+// headers it includes are the ones other sources share.
+std::vector<std::string> get_leading_includes(const std::string& source, std::vector<translation_unit::include> includes)
+{
+    std::stable_sort(includes.begin(), includes.end(), [](const translation_unit::include& x, const translation_unit::include& y)
+    {
+        return x.line < y.line;
+    });
+    std::vector<std::string> result;
+    for(const auto& i:includes)
+    {
+        if (!i.direct) continue;
+        if (result.empty() and get_stem(i.filename) == get_stem(source)) continue;
+        if (!i.guarded) break;
+        result.push_back(i.filename);
+    }
+    return result;
+}
+
+void load_shared_pch(const std::string& path, shared_pch& p)
+{
+    p.loaded = true;
+    std::ifstream header(path + ".h");
+    std::string line;
+    while(std::getline(header, line))
+    {
+        // Each line is `#include "file"`
+        std::size_t first = line.find('"');
+        std::size_t last = line.rfind('"');
+        if (first != std::string::npos and last > first) p.headers.push_back(line.substr(first + 1, last - first - 1));
+    }
+    std::ifstream sources(path + ".sources");
+    while(std::getline(sources, line))
+    {
+        std::istringstream ss(line);
+        std::string source, include;
+        if (!std::getline(ss, source, '\t')) continue;
+        auto& includes = p.sources[source];
+        while(std::getline(ss, include, '\t')) includes.push_back(include);
+    }
+}
+
+void save_shared_pch_sources(const std::string& path, const shared_pch& p)
+{
+    {
+        std::ofstream out(path + ".sources.tmp", std::ios_base::binary);
+        for(const auto& s:p.sources)
+        {
+            out << s.first;
+            for(const auto& include:s.second) out << "\t" << include;
+            out << "\n";
+        }
+        if (!out) return;
+    }
+    std::rename((path + ".sources.tmp").c_str(), (path + ".sources").c_str());
+}
+
+// The leading headers shared by enough sources, where sharing more headers
+// is worth as much as sharing them with more sources. A tie keeps the
+// headers the pch already has.
+std::vector<std::string> find_shared_headers(const shared_pch& p)
+{
+    std::map<std::vector<std::string>, std::size_t> counts;
+    for(const auto& s:p.sources)
+    {
+        for(std::size_t n = 1; n <= s.second.size(); n++) counts[std::vector<std::string>(s.second.begin(), s.second.begin() + n)]++;
+    }
+    std::vector<std::string> result;
+    std::size_t best = 0;
+    for(const auto& c:counts)
+    {
+        if (c.second < shared_pch_min_sources or c.first == p.failed) continue;
+        std::size_t score = c.first.size() * c.second;
+        if (score > best or (score == best and c.first == p.headers))
+        {
+            best = score;
+            result = c.first;
+        }
+    }
+    return result;
+}
+
+bool build_shared_pch(const std::string& path, std::vector<std::string> args, const std::vector<std::string>& headers)
+{
+    scoped_latency latency(build_pch_latency);
+    std::string header = path + ".h";
+    {
+        std::ofstream out(header, std::ios_base::binary);
+        for(const auto& h:headers) out << "#include \"" << h << "\"\n";
+        if (!out) return false;
+    }
+    // The header is parsed as a header of the language of the sources
+    std::string language = "c++";
+    auto x = std::find(args.rbegin(), args.rend(), "-x");
+    if (x != args.rend() and x != args.rbegin()) language = *std::prev(x);
+    if (language.size() < 7 or language.compare(language.size() - 7, 7, "-header") != 0) language += "-header";
+    std::vector<std::string> pch_args = args;
+    pch_args.push_back("-x");
+    pch_args.push_back(language);
+    std::vector<const char *> argv;
+    for(const auto& arg:pch_args) argv.push_back(arg.c_str());
+    std::shared_ptr<CXTranslationUnitImpl> tu(clang_parseTranslationUnit(get_index().get(), header.c_str(), 
+        argv.data(), argv.size(), NULL, 0, CXTranslationUnit_Incomplete | CXTranslationUnit_ForSerialization), 
+        &clang_disposeTranslationUnit);
+    if (tu == nullptr) return false;
+    // A pch with errors would show them in every file that uses it
+    for(unsigned i = 0; i < clang_getNumDiagnostics(tu.get()); i++)
+    {
+        std::shared_ptr<void> d(clang_getDiagnostic(tu.get(), i), &clang_disposeDiagnostic);
+        if (clang_getDiagnosticSeverity(d.get()) >= CXDiagnostic_Error) return false;
+    }
+    std::string ast = path + ".ast";
+    std::time_t previous = get_mtime(ast);
+    if (!save_ast_cache(path, header, args, tu.get(), get_dependencies(tu.get(), args))) return false;
+    // Tus and cached ASTs notice the pch was built again by its mtime, so it
+    // has to change even when the pch is built twice in the same second
+    if (previous != 0 and get_mtime(ast) <= previous)
+    {
+        utimbuf times{previous + 1, previous + 1};
+        utime(ast.c_str(), &times);
+    }
+    evict_ast_cache();
+    return true;
+}
+
+// Starts building the pch in the background, unless it is already current
+// or being built
+void unsafe_update_shared_pch(const std::string& path, shared_pch& p, const std::vector<std::string>& args)
+{
+    if (p.building) return;
+    auto headers = find_shared_headers(p);
+    if (headers.empty()) return;
+    if (headers == p.headers)
+    {
+        p.checked = std::chrono::steady_clock::now();
+        p.current = is_ast_cache_current(path, path + ".h", args);
+        if (p.current) return;
+    }
+    p.building = true;
+    get_pool().async(task_priority::background, [path, args, headers]
+    {
+        bool built = try_([&] { return build_shared_pch(path, args, headers); });
+        std::lock_guard<std::mutex> lock(shared_pch_mutex);
+        auto& p = shared_pchs[path];
+        p.building = false;
+        if (built)
+        {
+            p.headers = headers;
+            p.current = true;
+            p.checked = std::chrono::steady_clock::now();
+        }
+        else p.failed = headers;
+    });
+}
+
+// The path of the cache entry for the pch of the args, which is empty when
+// the pch isn't shared
+std::string get_shared_pch_path(const std::vector<std::string>& args)
+{
+    if (!shared_pch_enabled or !get_pch_arg(args).empty()) return {};
+    return get_ast_cache_path("", args);
+}
+
+// Records the headers a parsed tu starts with
+void update_shared_pch(const std::string& source, const std::vector<std::string>& tu_args, const std::vector<translation_unit::include>& includes)
+{
+    auto args = strip_shared_pch(tu_args);
+    std::string path = get_shared_pch_path(args);
+    if (path.empty()) return;
+    auto leading = get_leading_includes(source, includes);
+    std::lock_guard<std::mutex> lock(shared_pch_mutex);
+    auto& p = shared_pchs[path];
+    if (!p.loaded) load_shared_pch(path, p);
+    // The headers that come from the pch are seen as included by the pch
+    if (tu_args != args)
+    {
+        leading.erase(std::remove_if(leading.begin(), leading.end(), [&](const std::string& x)
+        {
+            return std::find(p.headers.begin(), p.headers.end(), x) != p.headers.end();
+        }), leading.end());
+        leading.insert(leading.begin(), p.headers.begin(), p.headers.end());
+    }
+    auto& recorded = p.sources[source];
+    if (recorded != leading)
+    {
+        recorded = leading;
+        save_shared_pch_sources(path, p);
+    }
+    unsafe_update_shared_pch(path, p, args);
+}
+
+// The pch for the file, if it starts with the headers of a pch that is
+// current. Whether the pch is still current is only checked every few
+// seconds, and a stale pch is built again in the background.
+std::string get_shared_pch(const std::string& filename, const std::vector<std::string>& args)
+{
+    std::string path = get_shared_pch_path(args);
+    if (path.empty()) return {};
+    std::lock_guard<std::mutex> lock(shared_pch_mutex);
+    auto& p = shared_pchs[path];
+    if (!p.loaded) load_shared_pch(path, p);
+    auto it = p.sources.find(filename);
+    if (p.headers.empty() or it == p.sources.end() or it->second.size() < p.headers.size() or 
+        !std::equal(p.headers.begin(), p.headers.end(), it->second.begin())) return {};
+    if (std::chrono::steady_clock::now() - p.checked > std::chrono::seconds(2))
+    {
+        unsafe_update_shared_pch(path, p, args);
+        // Loading the pch touches its entry
+        if (p.current) utime((path + ".ast").c_str(), nullptr);
+    }
+    if (!p.current) return {};
+    return path + ".ast";
+}
+
+// Bumped to cancel the prefetches that haven't started yet
+std::atomic<unsigned long> prefetch_generation{0};
+
+// After the first parse, the rest of the work on a new tu is done in the
+// background: a fast parse is replaced by a full one, or else the tu is
+// reparsed right away to build its preamble. A prefetched tu is parsed in
+// full right away, and the rest of its work is queued at idle priority and
+// dropped if prefetching is cancelled before it starts.
+void parse_new_tu(std::shared_ptr<async_translation_unit> tu, bool prefetch=false)
+{
+    tu->parse(!prefetch);
+    unsigned long generation = prefetch_generation;
+    auto priority = prefetch ? task_priority::idle : task_priority::background;
+    auto cancelled = [prefetch, generation] { return prefetch and generation != prefetch_generation; };
+    if (tu->is_from_cache()) get_pool().async(priority, [tu, cancelled]
+    {
+        if (cancelled()) return;
+        auto includes = tu->get_includes();
+        update_include_graph(tu->get_filename(), includes);
+        update_shared_pch(tu->get_filename(), tu->get_args(), includes);
+        enforce_cache_budget();
+    });
+    // Replace a fast parse, or else reparse right away to build the
+    // preamble
+    else get_pool().async(priority, [tu, cancelled]
+    {
+        if (cancelled()) return;
+        if (tu->is_fast()) tu->upgrade();
+        else
+        {
+            // Saving the parse as it is costs less than parsing again
+            tu->save_cache(false);
+            // The buffer may have been edited since the first parse, and a
+            // query may already have reparsed the tu with it
+            tu->reparse(get_unsaved_buffer(tu->get_filename()));
+        }
+        auto includes = tu->get_includes();
+        update_include_graph(tu->get_filename(), includes);
+        update_shared_pch(tu->get_filename(), tu->get_args(), includes);
+        enforce_cache_budget();
+        // Otherwise the AST needs a parse of its own, which waits until
+        // nothing else is queued, and is skipped once the tu is freed
+        std::weak_ptr<async_translation_unit> weak = tu;
+        get_pool().async(task_priority::idle, [weak, cancelled]
+        {
+            auto tu = weak.lock();
+            if (tu and !cancelled()) tu->save_cache();
+        });
+    });
+}
+
+// The lock only covers the lookup, new tus are parsed in the background. All
+// callers share the same in-flight parse, and either wait for it or give up
+// after the timeout. A tu is parsed again when its args change, except for
+// the shared pch, which only the tus created after it is built use, so the
+// others aren't parsed again from scratch.
+std::shared_ptr<async_translation_unit> get_tu(const char * filename, const char ** args, int argv, int timeout=-1)
+{
+    DUMP_FUNCTION
+    DUMP(timeout);
+    std::shared_ptr<async_translation_unit> tu;
+    bool created = false;
+    bool resumed = false;
+    auto stripped = strip_shared_pch(std::vector<std::string>(args, args+argv));
+    {
+        auto lock = lock_timed(tus_mutex, tus_lock_wait);
+        auto it = tus.find(filename);
+        if (it == tus.end() or strip_shared_pch(it->second->get_args()) != stripped)
+        {
+            tus[filename] = std::make_shared<async_translation_unit>(filename, args, argv);
+            it = tus.find(filename);
+            created = true;
+        }
+        tu = it->second;
+        resumed = tu->is_suspended();
+        tu->touch();
+    }
+    // Creating or resuming a tu can push the cache over budget, which is only
+    // known once its memory is measured after the parse
+    if (created) get_pool().async(task_priority::query, [tu] { parse_new_tu(tu); });
+    else if (resumed) get_pool().async(task_priority::query, [tu]
+    {
+        tu->resume();
+        enforce_cache_budget();
+    });
+    if (!tu->wait_parsed(timeout))
+    {
+        parse_timeouts.add();
+        return {};
+    }
+    return tu;
+}
+
+// A header can be navigated with the tu of the file that includes it, while
+// the header itself is still being parsed
+std::shared_ptr<async_translation_unit> get_navigation_tu(const char * filename, const char ** args, int argv)
+{
+    auto tu = get_tu(filename, args, argv, 0);
+    if (tu != nullptr) return tu;
+    auto i = get_includer(filename);
+    if (!i.empty())
+    {
+        std::shared_ptr<async_translation_unit> source;
+        {
+            auto lock = lock_timed(tus_mutex, tus_lock_wait);
+            auto it = tus.find(i.front());
+            if (it != tus.end()) source = it->second;
+        }
+        if (source != nullptr and source->wait_parsed(0) and !source->is_suspended() and !source->is_from_cache()) return source;
+    }
+    return get_tu(filename, args, argv);
+}
+
+// Files are parsed ahead of time at the lowest priority, as long as the
+// cache has room for them. A prefetched tu hasn't been used, so it is the
+// first to be suspended once the cache is over budget.
+void prefetch_tu(const char * filename, const char ** args, int argv)
+{
+    std::string f = filename;
+    std::vector<std::string> a(args, args+argv);
+    unsigned long generation = prefetch_generation;
+    get_pool().async(task_priority::idle, [f, a, generation]
+    {
+        if (generation != prefetch_generation) return;
+        std::shared_ptr<async_translation_unit> tu;
+        {
+            auto lock = lock_timed(tus_mutex, tus_lock_wait);
+            if (tus.count(f) > 0) return;
+            std::size_t active = 0;
+            std::size_t memory = 0;
+            for(const auto& p:tus)
+            {
+                if (p.second->is_suspended()) continue;
+                active++;
+                memory += p.second->get_memory();
+            }
+            if ((max_tus > 0 and active >= max_tus) or (max_memory > 0 and memory >= max_memory)) return;
+            std::vector<const char *> argv;
+            for(const auto& arg:a) argv.push_back(arg.c_str());
+            tu = std::make_shared<async_translation_unit>(f.c_str(), argv.data(), argv.size());
+            tus[f] = tu;
+        }
+        prefetches.add();
+        parse_new_tu(tu, true);
+    });
+}
+
+// Completion results for positions below an edit can't be reused, and when
+// the row is negative none of them can
+void invalidate_completions(const std::string& filename, long row=-1)
+{
+    std::shared_ptr<async_translation_unit> tu;
+    {
+        auto lock = lock_timed(tus_mutex, tus_lock_wait);
+        auto it = tus.find(filename);
+        if (it != tus.end()) tu = it->second;
+    }
+    if (tu != nullptr) tu->invalidate_completions(row);
+}
+
+// The metrics as json, along with the memory of each tu. A busy tu only
+// reports the memory from its last parse.
+std::string get_metrics()
+{
+    std::vector<std::pair<std::string, std::shared_ptr<async_translation_unit>>> entries;
+    {
+        auto lock = lock_timed(tus_mutex, tus_lock_wait);
+        entries.assign(tus.begin(), tus.end());
+    }
+    std::ostringstream out;
+    out << "{\"counters\": {";
+    for(std::size_t i=0;i<get_counters().size();i++)
+    {
+        if (i > 0) out << ", ";
+        get_counters()[i]->write_json(out);
+    }
+    out << "}, \"histograms\": {";
+    for(std::size_t i=0;i<get_histograms().size();i++)
+    {
+        if (i > 0) out << ", ";
+        get_histograms()[i]->write_json(out);
+    }
+    out << "}, \"translation_units\": {";
+    for(std::size_t i=0;i<entries.size();i++)
+    {
+        auto& tu = entries[i].second;
+        if (i > 0) out << ", ";
+        write_json_string(out, entries[i].first);
+        out << ": {\"memory\": " << tu->get_memory()
+            << ", \"suspended\": " << (tu->is_suspended() ? "true" : "false")
+            << ", \"from_cache\": " << (tu->is_from_cache() ? "true" : "false")
+            << ", \"fast\": " << (tu->is_fast() ? "true" : "false")
+            << ", \"reparses\": " << tu->get_reparses()
+            << ", \"usage\": {";
+        bool first = true;
+        for(const auto& u:tu->get_usage(10))
+        {
+            if (!first) out << ", ";
+            first = false;
+            write_json_string(out, u.first);
+            out << ": " << u.second;
+        }
+        out << "}}";
+    }
+    out << "}}";
+    return out.str();
+}
+
+// A cross reference of the symbols in a project, built with libclang's
+// indexer. Symbols are kept with the file they are located in, so a file is
+// updated by replacing just its own symbols. A header is indexed along with
+// the first source file that includes it, and again once it changes.
+class symbol_index : public std::enable_shared_from_this<symbol_index>
+{
+public:
+    enum symbol_kind
+    {
+        reference,
+        declaration,
+        definition
+    };
+
+    struct symbol
+    {
+        unsigned usr;
+        unsigned line;
+        unsigned col;
+        symbol_kind kind;
+    };
+private:
+    struct file_symbols
+    {
+        std::time_t mtime;
+        // The headers a source file was indexed with
+        std::vector<std::string> includes;
+        std::vector<symbol> symbols;
+    };
+
+    // What one run of the indexer found, before it is merged into the index
+    struct indexer
+    {
+        struct found_symbol
+        {
+            std::string usr;
+            std::string name;
+            unsigned line;
+            unsigned col;
+            symbol_kind kind;
+        };
+        struct found_file
+        {
+            std::string name;
+            std::vector<found_symbol> symbols;
+        };
+        std::string filename;
+        CXFile main_file;
+        std::vector<found_file> found;
+        // System headers map to npos, since they aren't indexed
+        std::unordered_map<CXFile, std::size_t> file_ids;
+
+        indexer(const std::string& filename) : filename(filename), main_file(nullptr)
+        {}
+
+        void add(CXIdxLoc loc, const CXIdxEntityInfo * entity, symbol_kind kind)
+        {
+            if (entity == nullptr or entity->USR == nullptr or *entity->USR == 0) return;
+            CXFile file = nullptr;
+            unsigned line, col;
+            clang_indexLoc_getFileLocation(loc, nullptr, &file, &line, &col, nullptr);
+            if (file == nullptr) return;
+            auto it = this->file_ids.find(file);
+            if (it == this->file_ids.end())
+            {
+                std::size_t id = std::string::npos;
+                if (!clang_Location_isInSystemHeader(clang_indexLoc_getCXSourceLocation(loc)))
+                {
+                    id = this->found.size();
+                    std::string name = file == this->main_file ? this->filename : to_std_string(clang_getFileName(file));
+                    this->found.push_back(found_file{name, {}});
+                }
+                it = this->file_ids.emplace(file, id).first;
+            }
+            if (it->second != std::string::npos) this->found[it->second].symbols.push_back(found_symbol{entity->USR, entity->name == nullptr ? "" : entity->name, line, col, kind});
+        }
+    };
+
+    typedef std::unordered_map<std::string, file_symbols>::value_type file_entry;
+
+    std::mutex m;
+    // Only one save writes the file at a time
+    std::mutex save_mutex;
+    std::string path;
+    // Each usr is stored once, and symbols refer to it by its position here
+    std::vector<std::string> usrs;
+    std::vector<std::string> names;
+    // How many declarations and definitions each usr has, since only those
+    // with at least one are found by name
+    std::vector<unsigned> declarations;
+    // The files each usr has symbols in, so finding its sites doesn't scan
+    // the whole project. The entries of `files` stay put until they are
+    // erased.
+    std::vector<std::unordered_set<const file_entry*>> usr_files;
+    // The usrs whose names have each character, ignoring case, so finding
+    // symbols by name only scores the names that can match
+    std::unordered_map<char, std::vector<unsigned>> name_chars;
+    std::unordered_map<std::string, unsigned> usr_ids;
+    std::unordered_map<std::string, file_symbols> files;
+    std::set<std::string> queued;
+    bool dirty;
+
+    unsigned intern(const std::string& usr, const std::string& name)
+    {
+        auto it = this->usr_ids.find(usr);
+        if (it != this->usr_ids.end()) return it->second;
+        this->usrs.push_back(usr);
+        this->names.push_back(name);
+        this->declarations.push_back(0);
+        this->usr_files.emplace_back();
+        this->add_name_chars(this->usrs.size() - 1);
+        return this->usr_ids.emplace(usr, this->usrs.size() - 1).first->second;
+    }
+
+    void add_name_chars(unsigned id)
+    {
+        std::string chars;
+        for(char c:this->names[id])
+        {
+            c = std::tolower(c);
+            if (chars.find(c) != std::string::npos) continue;
+            chars.push_back(c);
+            this->name_chars[c].push_back(id);
+        }
+    }
+
+    // Adds the symbols of the file to the declarations and the files of
+    // their usrs, or removes them when `n` is negative
+    void unsafe_count_file(const file_entry& file, int n)
+    {
+        for(const auto& x:file.second.symbols)
+        {
+            if (x.kind != reference) this->declarations[x.usr] += n;
+            if (n > 0) this->usr_files[x.usr].insert(&file);
+            else this->usr_files[x.usr].erase(&file);
+        }
+    }
+
+    void unsafe_set_file(const std::string& filename, file_symbols f)
+    {
+        auto it = this->files.find(filename);
+        if (it != this->files.end()) this->unsafe_count_file(*it, -1);
+        else it = this->files.emplace(filename, file_symbols()).first;
+        it->second = std::move(f);
+        this->unsafe_count_file(*it, 1);
+    }
+
+    // The index only knows which headers a file includes, not in what order
+    static void add_includers(const std::string& filename, const std::vector<std::string>& includes)
+    {
+        std::lock_guard<std::mutex> lock(include_graph_mutex);
+        for(const auto& include:includes) add_includer(include, includer{filename, nullptr, 0, false});
+    }
+
+    // Calls `f` with every symbol of the usr, and the file it is in
+    template<class F>
+    void unsafe_for_each_symbol(unsigned usr, F f)
+    {
+        for(const file_entry * file:this->usr_files[usr])
+        {
+            for(const auto& x:file->second.symbols)
+            {
+                if (x.usr == usr) f(file->first, x);
+            }
+        }
+    }
+
+    // Like `unsafe_for_each_symbol`, but only the declarations and
+    // definitions
+    template<class F>
+    void unsafe_for_each_site(unsigned usr, F f)
+    {
+        this->unsafe_for_each_symbol(usr, [&](const std::string& filename, const symbol& x)
+        {
+            if (x.kind != reference) f(filename, x);
+        });
+    }
+
+    static std::string format_location(const std::string& filename, const symbol& x)
+    {
+        return filename + ":" + std::to_string(x.line) + ":" + std::to_string(x.col);
+    }
+
+    // Whether the file and the headers it was indexed with haven't changed
+    // since it was indexed
+    bool is_current(const std::string& filename)
+    {
+        std::vector<std::pair<std::string, std::time_t>> mtimes;
+        {
+            std::lock_guard<std::mutex> lock(this->m);
+            auto it = this->files.find(filename);
+            if (it == this->files.end()) return false;
+            mtimes.emplace_back(filename, it->second.mtime);
+            for(const auto& include:it->second.includes)
+            {
+                auto header = this->files.find(include);
+                mtimes.emplace_back(include, header == this->files.end() ? 0 : header->second.mtime);
+            }
+        }
+        return std::all_of(mtimes.begin(), mtimes.end(), [](const std::pair<std::string, std::time_t>& p)
+        {
+            return get_mtime(p.first) == p.second;
+        });
+    }
+
+    void index_file(const std::string& filename, const std::vector<std::string>& args)
+    {
+        DUMP(filename);
+        if (this->is_current(filename)) return;
+        indexer data(filename);
+        IndexerCallbacks callbacks = {};
+        callbacks.enteredMainFile = [](CXClientData d, CXFile file, void *) -> CXIdxClientFile
+        {
+            static_cast<indexer*>(d)->main_file = file;
+            return nullptr;
+        };
+        callbacks.indexDeclaration = [](CXClientData d, const CXIdxDeclInfo * info)
+        {
+            static_cast<indexer*>(d)->add(info->loc, info->entityInfo, info->isDefinition ? definition : declaration);
+        };
+        callbacks.indexEntityReference = [](CXClientData d, const CXIdxEntityRefInfo * info)
+        {
+            if (info->kind == CXIdxEntityRef_Direct) static_cast<indexer*>(d)->add(info->loc, info->referencedEntity, reference);
+        };
+        std::vector<const char *> argv;
+        for(const auto& arg:args) argv.push_back(arg.c_str());
+        {
+            // Every file gets its own index, so files can be indexed in parallel
+            std::shared_ptr<void> index(clang_createIndex(0, 0), &clang_disposeIndex);
+            std::shared_ptr<void> action(clang_IndexAction_create(index.get()), &clang_IndexAction_dispose);
+            clang_indexSourceFile(action.get(), &data, &callbacks, sizeof(callbacks), CXIndexOpt_SuppressWarnings, 
+                filename.c_str(), argv.data(), argv.size(), nullptr, 0, nullptr, CXTranslationUnit_KeepGoing);
+        }
+
+        std::vector<std::time_t> mtimes;
+        for(const auto& f:data.found) mtimes.push_back(get_mtime(f.name));
+        std::lock_guard<std::mutex> lock(this->m);
+        file_symbols main{get_mtime(filename), {}, {}};
+        for(std::size_t i=0;i<data.found.size();i++)
+        {
+            const auto& f = data.found[i];
+            std::vector<symbol> symbols;
+            symbols.reserve(f.symbols.size());
+            for(const auto& x:f.symbols) symbols.push_back(symbol{this->intern(x.usr, x.name), x.line, x.col, x.kind});
+            if (f.name == filename)
+            {
+                main.symbols = std::move(symbols);
+                continue;
+            }
+            main.includes.push_back(f.name);
+            auto it = this->files.find(f.name);
+            if (it == this->files.end() or it->second.mtime != mtimes[i]) this->unsafe_set_file(f.name, file_symbols{mtimes[i], {}, std::move(symbols)});
+        }
+        add_includers(filename, main.includes);
+        this->unsafe_set_file(filename, std::move(main));
+        this->dirty = true;
+    }
+
+    // The usrs are listed first with their names, and each symbol refers to
+    // its usr by its position in that list
+    void unsafe_load()
+    {
+        std::ifstream in(this->path);
+        std::string line;
+        if (!std::getline(in, line) or line != "clangcomplete-index 2") return;
+        file_symbols * current = nullptr;
+        std::vector<unsigned> ids;
+        while(std::getline(in, line))
+        {
+            if (line.size() < 2 or line[1] != '\t') continue;
+            char * p = &line[2];
+            if (line[0] == 'u')
+            {
+                char * name = std::strchr(p, '\t');
+                if (name == nullptr) continue;
+                *name++ = 0;
+                ids.push_back(this->intern(p, name));
+            }
+            else if (line[0] == 'f')
+            {
+                std::time_t mtime = std::strtoll(p, &p, 10);
+                if (*p != '\t') continue;
+                current = &this->files[p + 1];
+                current->mtime = mtime;
+            }
+            else if (line[0] == 'i' and current != nullptr)
+            {
+                current->includes.push_back(p);
+            }
+            else if (line[0] == 's' and current != nullptr)
+            {
+                unsigned kind = std::strtoul(p, &p, 10);
+                unsigned l = std::strtoul(p, &p, 10);
+                unsigned c = std::strtoul(p, &p, 10);
+                unsigned usr = std::strtoul(p, &p, 10);
+                if (*p != 0 or kind > definition or usr >= ids.size()) continue;
+                current->symbols.push_back(symbol{ids[usr], l, c, symbol_kind(kind)});
+            }
+        }
+        for(const auto& f:this->files) this->unsafe_count_file(f, 1);
+    }
+
+    // Drops the usrs no symbol refers to anymore, and numbers the rest in
+    // the order they are first used
+    void unsafe_compact()
+    {
+        const unsigned unused = -1;
+        std::vector<unsigned> ids(this->usrs.size(), unused);
+        std::vector<std::string> usrs;
+        std::vector<std::string> names;
+        std::vector<unsigned> declarations;
+        std::vector<std::unordered_set<const file_entry*>> usr_files;
+        for(auto& f:this->files)
+        {
+            for(auto& x:f.second.symbols)
+            {
+                if (ids[x.usr] == unused)
+                {
+                    ids[x.usr] = usrs.size();
+                    usrs.push_back(std::move(this->usrs[x.usr]));
+                    names.push_back(std::move(this->names[x.usr]));
+                    declarations.push_back(this->declarations[x.usr]);
+                    usr_files.push_back(std::move(this->usr_files[x.usr]));
+                }
+                x.usr = ids[x.usr];
+            }
+        }
+        this->usrs = std::move(usrs);
+        this->names = std::move(names);
+        this->declarations = std::move(declarations);
+        this->usr_files = std::move(usr_files);
+        this->usr_ids.clear();
+        this->name_chars.clear();
+        for(unsigned i=0;i<this->usrs.size();i++)
+        {
+            this->usr_ids.emplace(this->usrs[i], i);
+            this->add_name_chars(i);
+        }
+    }
+
+    // The usrs are listed first with their names, and each symbol refers to
+    // its usr by its position in that list, which is its id once the index
+    // is compacted
+    std::string unsafe_serialize()
+    {
+        std::ostringstream out;
+        out << "clangcomplete-index 2\n";
+        for(unsigned i=0;i<this->usrs.size();i++) out << "u\t" << this->usrs[i] << "\t" << this->names[i] << "\n";
+        for(const auto& f:this->files)
+        {
+            out << "f\t" << f.second.mtime << "\t" << f.first << "\n";
+            for(const auto& include:f.second.includes) out << "i\t" << include << "\n";
+            for(const auto& x:f.second.symbols) 
+                out << "s\t" << x.kind << "\t" << x.line << "\t" << x.col << "\t" << x.usr << "\n";
+        }
+        return out.str();
+    }
+
+    // Files that no longer exist are dropped when the index is saved, and so
+    // are the usrs no symbol refers to anymore. The files are checked, and
+    // the index is written, without holding the lock, so lookups never wait
+    // on the disk.
+    void save()
+    {
+        DUMP_FUNCTION
+        std::lock_guard<std::mutex> save_lock(this->save_mutex);
+        std::vector<std::string> filenames;
+        {
+            std::lock_guard<std::mutex> lock(this->m);
+            if (!this->dirty) return;
+            for(const auto& f:this->files) filenames.push_back(f.first);
+        }
+        std::vector<std::string> missing;
+        for(const auto& filename:filenames)
+        {
+            if (get_mtime(filename) == 0) missing.push_back(filename);
+        }
+        std::string contents;
+        {
+            std::lock_guard<std::mutex> lock(this->m);
+            for(const auto& filename:missing)
+            {
+                auto it = this->files.find(filename);
+                if (it == this->files.end()) continue;
+                this->unsafe_count_file(*it, -1);
+                this->files.erase(it);
+            }
+            this->unsafe_compact();
+            contents = this->unsafe_serialize();
+            this->dirty = false;
+        }
+        std::string temp = this->path + ".tmp";
+        bool saved;
+        {
+            std::ofstream out(temp, std::ios_base::binary);
+            out << contents;
+            saved = bool(out);
+        }
+        if (saved) saved = std::rename(temp.c_str(), this->path.c_str()) == 0;
+        if (!saved)
+        {
+            std::lock_guard<std::mutex> lock(this->m);
+            this->dirty = true;
+        }
+    }
+public:
+    symbol_index(const std::string& path) : path(path), dirty(false)
+    {
+        this->unsafe_load();
+        for(const auto& f:this->files) add_includers(f.first, f.second.includes);
+    }
+
+    symbol_index(const symbol_index&) = delete;
+
+    // Files are indexed in the background, unless they are already queued,
+    // and the index is saved once the queue runs empty
+    void queue(const std::string& filename, const std::vector<std::string>& args)
+    {
+        {
+            std::lock_guard<std::mutex> lock(this->m);
+            if (!this->queued.insert(filename).second) return;
+        }
+        auto self = this->shared_from_this();
+        get_index_pool().async(task_priority::background, [self, filename, args]
+        {
+            try_void([&] { self->index_file(filename, args); });
+            bool save;
+            {
+                std::lock_guard<std::mutex> lock(self->m);
+                self->queued.erase(filename);
+                save = self->queued.empty() and self->dirty;
+            }
+            if (save) try_void([&] { self->save(); });
+        });
+    }
+
+    // Every declaration, definition and reference of the symbol, as
+    // file:line:col
+    std::vector<std::string> find_uses(const std::string& usr)
+    {
+        std::vector<std::pair<const std::string*, symbol>> uses;
+        std::vector<std::string> result;
+        std::lock_guard<std::mutex> lock(this->m);
+        auto id = this->usr_ids.find(usr);
+        if (id == this->usr_ids.end()) return result;
+        this->unsafe_for_each_symbol(id->second, [&](const std::string& filename, const symbol& x)
+        {
+            uses.emplace_back(&filename, x);
+        });
+        std::sort(uses.begin(), uses.end(), [](const std::pair<const std::string*, symbol>& x, const std::pair<const std::string*, symbol>& y)
+        {
+            return std::tie(*x.first, x.second.line, x.second.col) < std::tie(*y.first, y.second.line, y.second.col);
+        });
+        for(const auto& u:uses) result.push_back(format_location(*u.first, u.second));
+        return result;
+    }
+
+    // Where the symbol is defined, or declared if it has no definition
+    std::string find_definition(const std::string& usr)
+    {
+        std::string result;
+        bool defined = false;
+        std::lock_guard<std::mutex> lock(this->m);
+        auto id = this->usr_ids.find(usr);
+        if (id == this->usr_ids.end() or this->declarations[id->second] == 0) return result;
+        this->unsafe_for_each_site(id->second, [&](const std::string& filename, const symbol& x)
+        {
+            if (defined or (x.kind == declaration and not result.empty())) return;
+            result = format_location(filename, x);
+            defined = x.kind == definition;
+        });
+        return result;
+    }
+
+    // The symbols whose names best match the query, each as its name and the
+    // location of its definition, or its declaration if it has none,
+    // separated by a newline
+    std::vector<std::string> find_symbols(const std::string& query, std::size_t limit)
+    {
+        std::vector<std::pair<int, unsigned>> matches;
+        std::vector<std::string> result;
+        std::lock_guard<std::mutex> lock(this->m);
+        auto add_match = [&](unsigned i)
+        {
+            if (this->declarations[i] == 0) return;
+            int score = fuzzy_score(query, this->names[i]);
+            if (score >= 0) matches.emplace_back(-score, i);
+        };
+        if (query.empty())
+        {
+            for(unsigned i=0;i<this->usrs.size();i++) add_match(i);
+        }
+        else
+        {
+            // A name can only match if it has every character of the query,
+            // so only the names with the rarest one are scored
+            const std::vector<unsigned> * candidates = nullptr;
+            for(char c:query)
+            {
+                auto it = this->name_chars.find(std::tolower(c));
+                if (it == this->name_chars.end()) return result;
+                if (candidates == nullptr or it->second.size() < candidates->size()) candidates = &it->second;
+            }
+            for(unsigned i:*candidates) add_match(i);
+        }
+        limit = std::min(limit, matches.size());
+        std::partial_sort(matches.begin(), matches.begin() + limit, matches.end());
+        matches.resize(limit);
+
+        std::unordered_map<unsigned, std::pair<const std::string*, symbol>> sites;
+        for(const auto& match:matches) this->unsafe_for_each_site(match.second, [&](const std::string& filename, const symbol& x)
+        {
+            auto it = sites.find(x.usr);
+            if (it == sites.end()) sites.emplace(x.usr, std::make_pair(&filename, x));
+            else if (it->second.second.kind == declaration and x.kind == definition) it->second = std::make_pair(&filename, x);
+        });
+        for(const auto& match:matches)
+        {
+            const auto& site = sites.at(match.second);
+            result.push_back(this->names[match.second] + "\n" + format_location(*site.first, site.second));
+        }
+        return result;
+    }
+};
+
+std::mutex symbol_indexes_mutex{};
+std::unordered_map<std::string, std::shared_ptr<symbol_index>> symbol_indexes;
+
+// Each project has its own index, named by the file it is saved to
+std::shared_ptr<symbol_index> get_symbol_index(const std::string& path)
+{
+    std::lock_guard<std::mutex> lock(symbol_indexes_mutex);
+    auto it = symbol_indexes.find(path);
+    if (it == symbol_indexes.end()) it = symbol_indexes.emplace(path, std::make_shared<symbol_index>(path)).first;
+    return it->second;
+}
+
+template<class T>
+std::mutex& get_allocations_mutex()
+{
+    DUMP_FUNCTION
+    static std::mutex m;
+    return m;
+}
+
+template<class T>
+std::unordered_map<unsigned int, T>& get_allocations()
+{
+    DUMP_FUNCTION
+    static std::mutex m;
+    static std::unordered_map<unsigned int, T> allocations;
+    return allocations;
+};
+
+template<class T>
+unsigned int new_wrapper()
+{
+    DUMP_FUNCTION
+    // Ids are handed out in sequence, so finding a free one only has to skip
+    // ids that are still alive after the counter wraps around
+    static unsigned int next_id = 0;
+    std::unique_lock<std::mutex> lock(get_allocations_mutex<T>());
+    unsigned int id = ++next_id;
+    while (id == 0 or get_allocations<T>().count(id) > 0) id = ++next_id;
+    get_allocations<T>().emplace(id, T());
+    return id;
+} 
+
+template<class T>
+T& unwrap(unsigned int i)
+{
+    DUMP_FUNCTION
+    assert(i > 0);
+    std::unique_lock<std::mutex> lock(get_allocations_mutex<T>());
+    return get_allocations<T>().at(i);
+}
+
+template<class T>
+void free_wrapper(unsigned int i)
+{
+    DUMP_FUNCTION
+    std::unique_lock<std::mutex> lock(get_allocations_mutex<T>());
+    get_allocations<T>().erase(i);
+} 
+
+std::string& get_string(clang_complete_string s)
+{
+    DUMP_FUNCTION
+    return unwrap<std::string>(s);
+}
+
+unsigned int new_string(const std::string& s)
 {
     DUMP_FUNCTION
     auto i = new_wrapper<std::string>();
@@ -805,7 +3173,74 @@ unsigned int new_string(const std::string& s)
     return i;
 }
 
-typedef std::vector<std::string> slist;
+// The strings are stored back to back, each followed by a null terminator, so
+// they can be read one c string at a time with `at`. For copying the whole
+// list at once, `data` prefixes them with the 32-bit count and the 32-bit
+// length of each string.
+class slist
+{
+    std::string strings;
+    std::vector<std::size_t> offsets;
+    std::string packed;
+public:
+    void push_back(const std::string& s)
+    {
+        this->start();
+        this->append(s);
+        this->finish();
+    }
+
+    // A string can also be built from several parts with `start`, `append`
+    // and `finish`, without concatenating them first
+    void start()
+    {
+        this->offsets.push_back(this->strings.size());
+    }
+
+    void append(const std::string& s)
+    {
+        this->strings.append(s);
+    }
+
+    void finish()
+    {
+        this->strings.push_back('\0');
+    }
+
+    std::size_t size() const
+    {
+        return this->offsets.size();
+    }
+
+    bool empty() const
+    {
+        return this->offsets.empty();
+    }
+
+    const char * at(std::size_t i) const
+    {
+        return this->strings.c_str() + this->offsets.at(i);
+    }
+
+    const std::string& data()
+    {
+        if (this->packed.empty())
+        {
+            std::vector<std::uint32_t> header;
+            header.reserve(this->size() + 1);
+            header.push_back(this->size());
+            for(std::size_t i=0;i<this->size();i++)
+            {
+                std::size_t end = (i + 1 < this->size()) ? this->offsets[i+1] : this->strings.size();
+                header.push_back(end - this->offsets[i] - 1);
+            }
+            this->packed.reserve(header.size() * sizeof(std::uint32_t) + this->strings.size());
+            this->packed.append(reinterpret_cast<const char *>(header.data()), header.size() * sizeof(std::uint32_t));
+            this->packed.append(this->strings);
+        }
+        return this->packed;
+    }
+};
 
 slist& get_slist(clang_complete_string_list list)
 {
@@ -832,6 +3267,7 @@ template<class Range>
 clang_complete_string_list export_slist(const Range& r)
 {
     DUMP_FUNCTION
+    scoped_latency latency(export_latency);
     auto id = new_slist();
     auto& list = get_slist(id);
 
@@ -847,51 +3283,40 @@ template<class Range>
 clang_complete_string_list export_slist_completion(const Range& r)
 {
     DUMP_FUNCTION
+    scoped_latency latency(export_latency);
     auto id = new_slist();
     auto& list = get_slist(id);
 
     for (const auto& s:r)
     {
-        list.push_back(std::get<1>(s) + "\n" + std::get<2>(s));
+        list.start();
+        list.append(std::get<1>(s));
+        list.append("\n");
+        list.append(std::get<2>(s));
+        list.finish();
     }
 
     return id;
 }
 
-template<class F, class Result=typename std::decay<decltype(std::declval<F>()())>::type>
-Result try_(F f)
-{
-    try
-    {
-        return f();
-    }
-    catch(const std::exception& e)
-    {
-        DUMP(e.what());
-        return Result{};
-    }
-    catch(...)
-    {
-        DUMP("Unknown exception");
-        return Result{};
-    }
-}
-
-template<class F>
-void try_void(F f)
+// Each token in the lines as `line\tcol\tlength\tkind\tcursor\ttype\treference`
+clang_complete_string_list export_slist_annotations(const annotation_set& a, unsigned begin_line, unsigned end_line)
 {
-    try
-    {
-        return f();
-    }
-    catch(const std::exception& e)
-    {
-        DUMP(e.what());
-    }
-    catch(...)
+    DUMP_FUNCTION
+    scoped_latency latency(export_latency);
+    auto id = new_slist();
+    auto& list = get_slist(id);
+    for (const auto& t:a.tokens)
     {
-        DUMP("Unknown exception");
+        if (t.line < begin_line or t.line > end_line) continue;
+        // Each field is a string of its own, so a type or a path can hold
+        // any character
+        list.push_back(std::to_string(t.line));
+        list.push_back(std::to_string(t.col));
+        list.push_back(std::to_string(t.length));
+        for(unsigned i:{t.kind, t.cursor, t.type, t.reference}) list.push_back(a.strings[i]);
     }
+    return id;
 }
 
 extern "C" {
@@ -928,7 +3353,19 @@ const char * clang_complete_string_list_at(clang_complete_string_list list, int
     return try_([&]() -> const char *
     {
         if (list == 0) return nullptr;
-        else return get_slist(list).at(index).c_str();
+        else return get_slist(list).at(index);
+    });
+}
+const char * clang_complete_string_list_data(clang_complete_string_list list, unsigned * size)
+{
+    DUMP_FUNCTION
+    return try_([&]() -> const char *
+    {
+        *size = 0;
+        if (list == 0) return nullptr;
+        auto& data = get_slist(list).data();
+        *size = data.size();
+        return data.data();
     });
 }
 
@@ -940,6 +3377,7 @@ clang_complete_string_list clang_complete_get_completions(
         unsigned col, 
         const char * prefix, 
         int timeout,
+        unsigned limit,
         const char * buffer, 
         unsigned len)
 {
@@ -948,7 +3386,33 @@ clang_complete_string_list clang_complete_get_completions(
     {
         auto tu = get_tu(filename, args, argv, 200);
         if (tu == nullptr) return empty_slist();
-        else return export_slist_completion(tu->async_complete_at(line, col, prefix, timeout, buffer, len));
+        std::shared_ptr<const std::string> unsaved;
+        if (buffer != nullptr) unsaved = std::make_shared<std::string>(buffer, len);
+        else unsaved = get_unsaved_buffer(filename);
+        return export_slist_completion(tu->async_complete_at(line, col, prefix, timeout, limit, unsaved));
+    });
+}
+
+int clang_complete_wait_completions(const char * filename, unsigned line, unsigned col, int timeout)
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        std::shared_ptr<async_translation_unit> tu;
+        {
+            auto lock = lock_timed(tus_mutex, tus_lock_wait);
+            auto it = tus.find(filename);
+            if (it != tus.end()) tu = it->second;
+        }
+        if (tu == nullptr) return 1;
+        auto start = std::chrono::steady_clock::now();
+        if (!tu->wait_parsed(timeout)) return 0;
+        if (timeout >= 0)
+        {
+            auto elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(std::chrono::steady_clock::now() - start).count();
+            timeout = std::max<int>(timeout - elapsed, 0);
+        }
+        return tu->wait_completions(line, col, timeout) ? 1 : 0;
     });
 }
 
@@ -957,9 +3421,9 @@ clang_complete_string_list clang_complete_find_uses(const char * filename, const
     DUMP_FUNCTION
     return try_([&]
     {
-        auto tu = get_tu(filename, args, argv);
+        auto tu = get_navigation_tu(filename, args, argv);
 
-        return export_slist(tu->find_uses_in(line, col, search));
+        return export_slist(tu->find_uses_in(line, col, search == nullptr ? filename : search, filename));
     });    
 }
 
@@ -972,7 +3436,26 @@ clang_complete_string_list clang_complete_get_diagnostics(const char * filename,
         if (tu == nullptr) return empty_slist();
         else
         {
-            tu->reparse(nullptr, 0);
+            // Reparse at a low priority, so this waits behind the queries,
+            // and take the buffer once the reparse starts, so a burst of
+            // edits queued up meanwhile is only parsed once
+            std::string f = filename;
+            auto started = std::make_shared<std::promise<void>>();
+            auto started_future = started->get_future();
+            auto reparsed = get_pool().async(task_priority::background, [tu, f, started]
+            {
+                started->set_value();
+                auto unsaved = get_unsaved_buffer(f);
+                // Diagnostics aren't saved with the AST, and the tu is
+                // only reparsed if the file or its headers changed
+                if (tu->is_from_cache()) tu->upgrade();
+                tu->update(unsaved);
+            });
+            // Only waiting in the queue is bounded, since a reparse that
+            // started is worth its result. When the threads are busy, the
+            // diagnostics of the last parse are used instead.
+            if (started_future.wait_for(std::chrono::milliseconds(1000)) == std::future_status::ready) reparsed.get();
+            else diagnostics_timeouts.add();
             return export_slist(tu->get_diagnostics(250));
         }
     });
@@ -983,9 +3466,9 @@ clang_complete_string clang_complete_get_definition(const char * filename, const
     DUMP_FUNCTION
     return try_([&]
     {
-        auto tu = get_tu(filename, args, argv);
+        auto tu = get_navigation_tu(filename, args, argv);
 
-        return new_string(tu->get_definition(line, col));
+        return new_string(tu->get_definition(line, col, filename));
     });
 }
 
@@ -993,10 +3476,110 @@ clang_complete_string clang_complete_get_type(const char * filename, const char
 {
     DUMP_FUNCTION
     return try_([&] 
+    {
+        auto tu = get_navigation_tu(filename, args, argv);
+
+        return new_string(tu->get_type(line, col, filename));
+    });
+}
+
+clang_complete_string_list clang_complete_get_annotations(const char * filename, const char ** args, int argv, unsigned begin_line, unsigned end_line)
+{
+    DUMP_FUNCTION
+    return try_([&]
     {
         auto tu = get_tu(filename, args, argv);
+        if (tu == nullptr) return empty_slist();
+        // The annotations are reused while the tu is still parsed with the
+        // unsaved buffer. Otherwise the tu is brought up to date with it
+        // first, which also checks the headers.
+        auto buffer = get_unsaved_buffer(filename);
+        auto a = tu->get_current_annotations(buffer, begin_line, end_line);
+        if (a == nullptr)
+        {
+            tu->update(buffer);
+            a = tu->get_annotations(begin_line, end_line);
+        }
+        return export_slist_annotations(*a, begin_line, end_line);
+    });
+}
+
+clang_complete_string clang_complete_get_usr(const char * filename, const char ** args, int argv, unsigned line, unsigned col)
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        auto tu = get_navigation_tu(filename, args, argv);
+
+        return new_string(tu->get_usr(line, col, filename));
+    });
+}
+
+void clang_complete_index_file(const char * index_file, const char * filename, const char ** args, int argv)
+{
+    DUMP_FUNCTION
+    try_void([&]
+    {
+        get_symbol_index(index_file)->queue(filename, std::vector<std::string>(args, args+argv));
+    });
+}
+
+clang_complete_string_list clang_complete_get_includes(const char * filename)
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        std::shared_ptr<async_translation_unit> tu;
+        {
+            auto lock = lock_timed(tus_mutex, tus_lock_wait);
+            auto it = tus.find(filename);
+            if (it != tus.end()) tu = it->second;
+        }
+        std::vector<std::string> result;
+        if (tu == nullptr or !tu->wait_parsed(0)) return export_slist(result);
+        auto includes = tu->get_includes();
+        std::stable_sort(includes.begin(), includes.end(), [](const translation_unit::include& x, const translation_unit::include& y)
+        {
+            return x.line < y.line;
+        });
+        for(const auto& i:includes) if (i.direct) result.push_back(i.filename);
+        return export_slist(result);
+    });
+}
+
+clang_complete_string_list clang_complete_get_includer(const char * filename)
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        return export_slist(get_includer(filename));
+    });
+}
+
+clang_complete_string_list clang_complete_index_find_uses(const char * index_file, const char * usr)
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        return export_slist(get_symbol_index(index_file)->find_uses(usr));
+    });
+}
+
+clang_complete_string clang_complete_index_find_definition(const char * index_file, const char * usr)
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        return new_string(get_symbol_index(index_file)->find_definition(usr));
+    });
+}
 
-        return new_string(tu->get_type(line, col));
+clang_complete_string_list clang_complete_index_find_symbols(const char * index_file, const char * query, unsigned limit)
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        return export_slist(get_symbol_index(index_file)->find_symbols(query, limit));
     });
 }
 
@@ -1006,32 +3589,175 @@ void clang_complete_reparse(const char * filename, const char ** args, int argv,
     try_void([&] 
     {
         auto tu = get_tu(filename, args, argv);
-        tu->reparse();
+        if (tu == nullptr) return;
+        if (buffer != nullptr) tu->update(std::make_shared<std::string>(buffer, len));
+        else tu->update(get_unsaved_buffer(filename));
+    });
+}
+
+void clang_complete_prefetch(const char * filename, const char ** args, int argv)
+{
+    DUMP_FUNCTION
+    try_void([&]
+    {
+        prefetch_tu(filename, args, argv);
     });
 }
 
+void clang_complete_cancel_prefetch()
+{
+    DUMP_FUNCTION
+    prefetch_generation++;
+}
+
 void clang_complete_free_tu(const char * filename)
 {
     DUMP_FUNCTION
     try_void([&]
     {
         std::string name = filename;
-        detach_async([=]
         {
-            std::lock_guard<std::timed_mutex> lock(tus_mutex);
+            std::lock_guard<std::mutex> lock(buffers_mutex);
+            buffers.erase(name);
+        }
+        get_pool().async(task_priority::background, [=]
+        {
+            std::shared_ptr<async_translation_unit> tu;
+            auto lock = lock_timed(tus_mutex, tus_lock_wait);
             if (tus.find(name) != tus.end())
             {
+                tu = tus[name];
                 tus.erase(name);
             }
         });
     });
 }
 
+int clang_complete_get_buffer_change_count(const char * filename)
+{
+    DUMP_FUNCTION
+    return try_([&]() -> int
+    {
+        std::lock_guard<std::mutex> lock(buffers_mutex);
+        auto it = buffers.find(filename);
+        if (it == buffers.end()) return -1;
+        else return it->second.change_count;
+    });
+}
+
+void clang_complete_set_buffer(const char * filename, unsigned change_count, const char * buffer, unsigned len)
+{
+    DUMP_FUNCTION
+    try_void([&]
+    {
+        auto contents = std::make_shared<std::string>(buffer, len);
+        {
+            std::lock_guard<std::mutex> lock(buffers_mutex);
+            auto it = buffers.find(filename);
+            // A newer buffer is kept
+            if (it != buffers.end() and it->second.change_count > change_count) return;
+            buffers[filename] = unsaved_buffer{change_count, contents};
+        }
+        invalidate_completions(filename);
+    });
+}
+
+int clang_complete_edit_buffer(const char * filename, unsigned change_count, unsigned new_change_count, 
+    unsigned begin_row, unsigned begin_col, unsigned end_row, unsigned end_col, const char * text, unsigned len, int size)
+{
+    DUMP_FUNCTION
+    return try_([&]() -> int
+    {
+        bool edited = edit_unsaved_buffer(filename, change_count, new_change_count, begin_row, begin_col, end_row, end_col, text, len, size);
+        invalidate_completions(filename, edited ? long(begin_row) : -1);
+        return edited;
+    });
+}
+
+void clang_complete_clear_buffer(const char * filename)
+{
+    DUMP_FUNCTION
+    try_void([&]
+    {
+        {
+            std::lock_guard<std::mutex> lock(buffers_mutex);
+            buffers.erase(filename);
+        }
+        invalidate_completions(filename);
+    });
+}
+
+void clang_complete_set_cache_budget(unsigned max_translation_units, unsigned max_memory_mb)
+{
+    DUMP_FUNCTION
+    try_void([&]
+    {
+        max_tus = max_translation_units;
+        max_memory = std::size_t(max_memory_mb) * 1024 * 1024;
+        get_pool().async(task_priority::background, &enforce_cache_budget);
+    });
+}
+
+void clang_complete_set_ast_cache(const char * path, unsigned max_size_mb)
+{
+    DUMP_FUNCTION
+    try_void([&]
+    {
+        {
+            std::lock_guard<std::mutex> lock(ast_cache_mutex);
+            ast_cache_dir = max_size_mb > 0 ? path : "";
+            ast_cache_max_size = std::size_t(max_size_mb) * 1024 * 1024;
+        }
+        get_pool().async(task_priority::background, &evict_ast_cache);
+    });
+}
+
+void clang_complete_set_worker_threads(unsigned n)
+{
+    DUMP_FUNCTION
+    worker_threads = n;
+}
+
+void clang_complete_set_fast_parse(int enable)
+{
+    DUMP_FUNCTION
+    fast_parse = enable != 0;
+}
+
+void clang_complete_set_shared_pch(int enable)
+{
+    DUMP_FUNCTION
+    shared_pch_enabled = enable != 0;
+}
+
+clang_complete_string clang_complete_get_shared_pch(const char * filename, const char ** args, int argv)
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        return new_string(get_shared_pch(filename, std::vector<std::string>(args, args+argv)));
+    });
+}
+
+clang_complete_string clang_complete_get_metrics()
+{
+    DUMP_FUNCTION
+    return try_([&]
+    {
+        return new_string(get_metrics());
+    });
+}
+
 void clang_complete_free_all()
 {
     DUMP_FUNCTION
-    std::lock_guard<std::timed_mutex> lock(tus_mutex);
-    tus.clear();
+    decltype(tus) old;
+    {
+        std::lock_guard<std::mutex> lock(buffers_mutex);
+        buffers.clear();
+    }
+    auto lock = lock_timed(tus_mutex, tus_lock_wait);
+    tus.swap(old);
     get_index(true);
 }
 }
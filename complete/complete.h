@@ -17,6 +17,9 @@ extern "C"
     void clang_complete_string_list_free(clang_complete_string_list list);
     int clang_complete_string_list_len(clang_complete_string_list list);
     const char * clang_complete_string_list_at(clang_complete_string_list list, int index);
+    // The whole list in one buffer: the 32-bit count, then the 32-bit length
+    // of each string, then the strings, each followed by a null terminator
+    const char * clang_complete_string_list_data(clang_complete_string_list list, unsigned * size);
 
     clang_complete_string_list clang_complete_get_completions(
         const char * filename, 
@@ -26,9 +29,15 @@ extern "C"
         unsigned col, 
         const char * prefix, 
         int timeout,
+        unsigned limit,
         const char * buffer, 
         unsigned len);
 
+    // Waits until the completions last asked for at the position are done,
+    // along with the parse they need. Returns 0 if they are still running
+    // after the timeout, which is in milliseconds.
+    int clang_complete_wait_completions(const char * filename, unsigned line, unsigned col, int timeout);
+
     clang_complete_string_list clang_complete_find_uses(const char * filename, const char ** args, int argv, unsigned line, unsigned col, const char * search);
 
     clang_complete_string_list clang_complete_get_diagnostics(const char * filename, const char ** args, int argv);
@@ -39,10 +48,91 @@ extern "C"
 
     clang_complete_string clang_complete_get_type(const char * filename, const char ** args, int argv, unsigned line, unsigned col);
 
+    clang_complete_string clang_complete_get_usr(const char * filename, const char ** args, int argv, unsigned line, unsigned col);
+
+    // Every token in the lines, which are one based and inclusive, as seven
+    // strings in a row: line, col, length, kind, cursor, type and reference.
+    // The kind is the token kind, and the cursor is the kind of cursor clang
+    // annotated it with. For identifiers, the type is their canonical type,
+    // and the reference is the location of what they refer to. The tokens
+    // are kept until the tu is reparsed, so asking again is cheap.
+    clang_complete_string_list clang_complete_get_annotations(const char * filename, const char ** args, int argv, unsigned begin_line, unsigned end_line);
+
+    // The files the parsed tu of the file includes itself, in the order they
+    // are included. The list is empty until the file is parsed.
+    clang_complete_string_list clang_complete_get_includes(const char * filename);
+
+    // The file a header is included from, followed by the files it includes
+    // before the header, as seen by the parsed tus and the project indexes.
+    // The list is empty when the header hasn't been seen yet.
+    clang_complete_string_list clang_complete_get_includer(const char * filename);
+
+    // The project index is saved to `index_file`. Files are indexed in the
+    // background, and skipped if neither they nor their headers changed
+    // since they were last indexed.
+    void clang_complete_index_file(const char * index_file, const char * filename, const char ** args, int argv);
+
+    clang_complete_string_list clang_complete_index_find_uses(const char * index_file, const char * usr);
+
+    clang_complete_string clang_complete_index_find_definition(const char * index_file, const char * usr);
+
+    // Each symbol is its name and location, separated by a newline
+    clang_complete_string_list clang_complete_index_find_symbols(const char * index_file, const char * query, unsigned limit);
+
+    // Nothing is parsed while neither the buffer nor the headers of the file
+    // changed since it was last parsed
     void clang_complete_reparse(const char * filename, const char ** args, int argv, const char * buffer, unsigned len);
 
+    // Parse the file ahead of time, at a lower priority than anything else,
+    // unless it is parsed already or the cache budget has no room for it
+    void clang_complete_prefetch(const char * filename, const char ** args, int argv);
+
+    // Drop the prefetches that haven't started yet
+    void clang_complete_cancel_prefetch();
+
     void clang_complete_free_tu(const char * filename);
 
+    // The unsaved contents of a file are kept between calls, tagged with the
+    // editor's change count for them, and are used whenever a call isn't
+    // given a buffer. Rows and columns of an edit are zero based, and columns
+    // are counted in bytes. The change count is -1 when no buffer is kept. A
+    // buffer or an edit older than the buffer kept is ignored, so syncing
+    // from several threads never goes back to an older buffer.
+    int clang_complete_get_buffer_change_count(const char * filename);
+
+    void clang_complete_set_buffer(const char * filename, unsigned change_count, const char * buffer, unsigned len);
+
+    int clang_complete_edit_buffer(const char * filename, unsigned change_count, unsigned new_change_count, 
+        unsigned begin_row, unsigned begin_col, unsigned end_row, unsigned end_col, const char * text, unsigned len, int size);
+
+    void clang_complete_clear_buffer(const char * filename);
+
+    void clang_complete_set_cache_budget(unsigned max_translation_units, unsigned max_memory_mb);
+
+    // Parsed tus are saved as ASTs in the directory, up to the size given.
+    // A size of zero turns the cache off.
+    void clang_complete_set_ast_cache(const char * path, unsigned max_size_mb);
+
+    // How many threads parse and index, which only works before the first
+    // call that needs them. Zero leaves cores free for the editor.
+    void clang_complete_set_worker_threads(unsigned n);
+
+    // Parse new tus without the function bodies in their headers first, so
+    // they answer sooner, and then in full in the background
+    void clang_complete_set_fast_parse(int enable);
+
+    // Precompile the headers that the files parsed with the same args start
+    // with once, in the AST cache, instead of in the preamble of every tu
+    void clang_complete_set_shared_pch(int enable);
+
+    // The precompiled header to parse the file with, which is passed with
+    // `-include-pch`. It is empty until the file is known to start with the
+    // headers of a pch that is built and current.
+    clang_complete_string clang_complete_get_shared_pch(const char * filename, const char ** args, int argv);
+
+    // Counters, latency histograms and the memory of each tu, as json
+    clang_complete_string clang_complete_get_metrics();
+
     void clang_complete_free_all();
 }
 
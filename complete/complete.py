@@ -10,9 +10,19 @@ from ctypes import c_char_p
 from ctypes import c_void_p
 from ctypes import c_uint
 from ctypes import py_object
+from ctypes import POINTER
+from ctypes import byref
+from ctypes import string_at
 from copy import copy
 import os
 import platform
+import struct
+import json
+import functools
+import socket
+import subprocess
+import threading
+import time
 current_path = os.path.dirname(os.path.abspath(__file__))
 suffix = 'so'
 if platform.system() == 'Darwin':
@@ -27,20 +37,51 @@ complete = cdll.LoadLibrary('%s/libcomplete.%s' % (current_path, suffix))
 
 complete.clang_complete_string_list_len.restype = c_int
 complete.clang_complete_string_list_at.restype = c_char_p
+complete.clang_complete_string_list_data.restype = c_void_p
+complete.clang_complete_string_list_data.argtypes = [c_uint, POINTER(c_uint)]
 complete.clang_complete_string_value.restype = c_char_p
 complete.clang_complete_find_uses.restype = c_uint
 complete.clang_complete_get_completions.restype = c_uint
+complete.clang_complete_wait_completions.restype = c_int
 complete.clang_complete_get_diagnostics.restype = c_uint
 complete.clang_complete_get_definition.restype = c_uint
 complete.clang_complete_get_type.restype = c_uint
+complete.clang_complete_get_usr.restype = c_uint
+complete.clang_complete_get_annotations.restype = c_uint
+complete.clang_complete_get_includes.restype = c_uint
+complete.clang_complete_get_includer.restype = c_uint
+complete.clang_complete_index_find_uses.restype = c_uint
+complete.clang_complete_index_find_definition.restype = c_uint
+complete.clang_complete_index_find_symbols.restype = c_uint
+complete.clang_complete_get_buffer_change_count.restype = c_int
+complete.clang_complete_edit_buffer.restype = c_int
+complete.clang_complete_get_metrics.restype = c_uint
+complete.clang_complete_get_shared_pch.restype = c_uint
 
 def convert_to_c_string_array(a):
     result = (c_char_p * len(a))()
     result[:] = [x.encode('utf-8') for x in a]
     return result
 
+# The buffer starts with the count and the length of each string, followed
+# by the null terminated strings. Each string is taken by its length, so it
+# can hold any character.
+def unpack_string_list(data):
+    if len(data) == 0: return []
+    n = struct.unpack_from('=I', data)[0]
+    if n == 0: return []
+    pos = 4 * (n + 1)
+    result = []
+    for length in struct.unpack_from('=%dI' % n, data, 4):
+        result.append(data[pos:pos+length].decode('utf-8'))
+        pos += length + 1
+    return result
+
 def convert_string_list(l):
-    result = [complete.clang_complete_string_list_at(l, i).decode('utf-8') for i in range(complete.clang_complete_string_list_len(l))]
+    size = c_uint(0)
+    data = complete.clang_complete_string_list_data(l, byref(size))
+    result = []
+    if data is not None: result = unpack_string_list(string_at(data, size.value))
     complete.clang_complete_string_list_free(l)
     return result
 
@@ -49,29 +90,318 @@ def convert_string(s):
     complete.clang_complete_string_free(s)
     return result
 
+#
+#
+# Server
+#
+#
+
+# Instead of loading libclang in this process, calls can be sent to a server
+# process over a unix socket. Each message is framed by its 32-bit length,
+# and values are packed as a one byte tag followed by the value.
+def pack_value(value, out):
+    if value is None: out.append(b'n')
+    elif value is True: out.append(b't')
+    elif value is False: out.append(b'f')
+    elif isinstance(value, int): out.append(struct.pack('=cq', b'i', value))
+    elif isinstance(value, float): out.append(struct.pack('=cd', b'd', value))
+    elif isinstance(value, str):
+        b = value.encode('utf-8')
+        out.append(struct.pack('=cI', b's', len(b)))
+        out.append(b)
+    elif isinstance(value, (list, tuple)):
+        out.append(struct.pack('=cI', b'l', len(value)))
+        for x in value: pack_value(x, out)
+    elif isinstance(value, dict):
+        out.append(struct.pack('=cI', b'm', len(value)))
+        for k, v in value.items():
+            pack_value(k, out)
+            pack_value(v, out)
+    else: raise TypeError('Can\'t send %r to the server' % (value,))
+
+def unpack_value(data, pos=0):
+    tag = data[pos:pos+1]
+    pos += 1
+    if tag == b'n': return None, pos
+    elif tag == b't': return True, pos
+    elif tag == b'f': return False, pos
+    elif tag == b'i': return struct.unpack_from('=q', data, pos)[0], pos + 8
+    elif tag == b'd': return struct.unpack_from('=d', data, pos)[0], pos + 8
+    n = struct.unpack_from('=I', data, pos)[0]
+    pos += 4
+    if tag == b's': return data[pos:pos+n].decode('utf-8'), pos + n
+    elif tag == b'l':
+        result = []
+        for i in range(n):
+            x, pos = unpack_value(data, pos)
+            result.append(x)
+        return result, pos
+    elif tag == b'm':
+        result = {}
+        for i in range(n):
+            k, pos = unpack_value(data, pos)
+            result[k], pos = unpack_value(data, pos)
+        return result, pos
+    raise ValueError('Bad tag %r from the server' % tag)
+
+def send_message(sock, value):
+    out = [b'']
+    pack_value(value, out)
+    data = b''.join(out)
+    sock.sendall(struct.pack('=I', len(data)) + data)
+
+def recv_exactly(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1 << 20))
+        if len(chunk) == 0: raise EOFError('The server closed the connection')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+# Returns None when the connection is closed between messages
+def recv_message(sock):
+    header = sock.recv(4, socket.MSG_WAITALL)
+    if len(header) == 0: return None
+    if len(header) < 4: header += recv_exactly(sock, 4 - len(header))
+    return unpack_value(recv_exactly(sock, struct.unpack('=I', header)[0]))[0]
+
+class RemoteError(Exception):
+    pass
+
+# Each thread gets its own connection, so calls from different threads run
+# concurrently in the server. When no server is listening, one is started.
+# The server restarts its worker after a crash, which drops the connections,
+# so a call that fails that way is retried once. Settings are sent again on
+# every new connection, since a new worker doesn't have them.
+class ServerClient(object):
+    def __init__(self, path, python):
+        self.path = path
+        self.python = python
+        self.local = threading.local()
+        self.start_lock = threading.Lock()
+        self.settings = {}
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def start(self):
+        with self.start_lock:
+            try:
+                return self.connect()
+            except socket.error:
+                pass
+            subprocess.Popen([self.python, os.path.join(current_path, 'server.py'), '--socket', self.path], 
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+            for i in range(100):
+                time.sleep(0.05)
+                try:
+                    return self.connect()
+                except socket.error:
+                    pass
+            raise RemoteError('Can\'t start the server at %s' % self.path)
+
+    def get_socket(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            try:
+                sock = self.connect()
+            except socket.error:
+                sock = self.start()
+            self.local.sock = sock
+            for name, args in list(self.settings.items()):
+                send_message(sock, [name, list(args)])
+                recv_message(sock)
+        return sock
+
+    def close(self):
+        sock = getattr(self.local, 'sock', None)
+        self.local.sock = None
+        if sock is not None: sock.close()
+
+    def call(self, name, args):
+        if name in setting_functions: self.settings[name] = args
+        for attempt in range(2):
+            try:
+                sock = self.get_socket()
+                send_message(sock, [name, list(args)])
+                response = recv_message(sock)
+                if response is None: raise EOFError('The server closed the connection')
+                ok, value = response
+                if not ok: raise RemoteError(value)
+                return value
+            except (socket.error, EOFError):
+                self.close()
+                if attempt > 0: raise
+
+server_client = None
+remote_functions = {}
+setting_functions = set()
+
+def remote(f):
+    remote_functions[f.__name__] = f
+    @functools.wraps(f)
+    def call(*args):
+        client = server_client
+        if client is None: return f(*args)
+        return client.call(f.__name__, args)
+    return call
+
+def remote_setting(f):
+    setting_functions.add(f.__name__)
+    return remote(f)
+
+# Calls are sent to the server listening at the path, and one is started with
+# the python interpreter if needed. A path of None goes back to calling
+# libclang in this process.
+def set_server(path, python='python3'):
+    global server_client
+    if path is None: server_client = None
+    elif server_client is None or server_client.path != path or server_client.python != python: server_client = ServerClient(path, python)
+
+def set_worker_threads(n):
+    complete.clang_complete_set_worker_threads(n)
+
+@remote
 def find_uses(filename, args, line, col, file_to_search):
     search = None
     if file_to_search is not None: search = file_to_search.encode('utf-8')
     return convert_string_list(complete.clang_complete_find_uses(filename.encode('utf-8'), convert_to_c_string_array(args), len(args), line, col, search))
 
-def get_completions(filename, args, line, col, prefix, timeout, unsaved_buffer):
+@remote
+def get_completions(filename, args, line, col, prefix, timeout, unsaved_buffer, limit=0):
     if unsaved_buffer is None and not os.path.exists(filename): return []
     buffer = None
     if (unsaved_buffer is not None): buffer = unsaved_buffer.encode("utf-8")
     buffer_len = 0
     if (buffer is not None): buffer_len = len(buffer)
 
-    return convert_string_list(complete.clang_complete_get_completions(filename.encode('utf-8'), convert_to_c_string_array(args), len(args), line, col, prefix.encode('utf-8'), timeout, buffer, buffer_len))
+    return convert_string_list(complete.clang_complete_get_completions(filename.encode('utf-8'), convert_to_c_string_array(args), len(args), line, col, prefix.encode('utf-8'), timeout, limit, buffer, buffer_len))
+
+@remote
+def wait_completions(filename, line, col, timeout):
+    return complete.clang_complete_wait_completions(filename.encode('utf-8'), line, col, timeout) != 0
+
+# Completions are asked for on a thread of their own, so the caller never
+# waits on clang. Only the newest request runs once the thread is free, and
+# the requests it replaced are dropped without calling back.
+class CompletionWorker(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.request = None
+        self.generation = 0
+        self.thread = None
+
+    def submit(self, request):
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, request)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
 
+    def is_current(self, generation):
+        return self.generation == generation
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None: self.condition.wait()
+                generation, request = self.request
+                self.request = None
+            try:
+                request(lambda: self.is_current(generation))
+            except Exception as e:
+                print('ClangComplete: completions failed:', e)
+
+completion_worker = CompletionWorker()
+
+# Calls back with the completions once clang has them, or after the timeout
+# with what it has by then, which can be the completions from before the last
+# edit. In that case, it calls back again with the fresh completions, if they
+# are done within the refresh timeout and no newer request came in. The
+# callback runs on the worker thread, and is given the completions and whether
+# they are fresh. The args can also be a function, which is called on the
+# worker thread to get them, so whatever they take to compute doesn't hold up
+# the caller.
+def get_completions_async(callback, filename, args, line, col, prefix, timeout, unsaved_buffer, limit=0, refresh_timeout=0):
+    def request(is_current):
+        request_args = args() if callable(args) else args
+        if not is_current(): return
+        completions = get_completions(filename, request_args, line, col, prefix, timeout, unsaved_buffer, limit)
+        fresh = wait_completions(filename, line, col, 0)
+        if not is_current(): return
+        callback(completions, fresh)
+        deadline = time.time() + refresh_timeout / 1000.0
+        while not fresh and is_current() and time.time() < deadline:
+            # Waiting in short steps lets a newer request take over
+            if not wait_completions(filename, line, col, 50): continue
+            # A tu loaded from the cache only starts completing once it is
+            # parsed, so this can start the query rather than find it done
+            completions = get_completions(filename, request_args, line, col, prefix, timeout, unsaved_buffer, limit)
+            fresh = wait_completions(filename, line, col, 0)
+            if fresh and is_current(): callback(completions, True)
+    completion_worker.submit(request)
+
+@remote
 def get_diagnostics(filename, args):
     return convert_string_list(complete.clang_complete_get_diagnostics(filename.encode('utf-8'), convert_to_c_string_array(args), len(args)))
 
+@remote
 def get_definition(filename, args, line, col):
     return convert_string(complete.clang_complete_get_definition(filename.encode('utf-8'), convert_to_c_string_array(args), len(args), line, col))
 
+@remote
 def get_type(filename, args, line, col):
     return convert_string(complete.clang_complete_get_type(filename.encode('utf-8'), convert_to_c_string_array(args), len(args), line, col))
 
+@remote
+def get_usr(filename, args, line, col):
+    return convert_string(complete.clang_complete_get_usr(filename.encode('utf-8'), convert_to_c_string_array(args), len(args), line, col))
+
+# Each token in the lines as a tuple of its line, column, length, token kind,
+# cursor kind, type and the location of what it refers to
+@remote
+def get_annotations(filename, args, begin_line, end_line):
+    fields = convert_string_list(complete.clang_complete_get_annotations(filename.encode('utf-8'), convert_to_c_string_array(args), len(args), begin_line, end_line))
+    result = []
+    for i in range(0, len(fields) - 6, 7):
+        line, col, length, kind, cursor, type, reference = fields[i:i+7]
+        result.append((int(line), int(col), int(length), kind, cursor, type, reference))
+    return result
+
+@remote
+def get_included_files(filename):
+    return convert_string_list(complete.clang_complete_get_includes(filename.encode('utf-8')))
+
+@remote
+def get_includer(filename):
+    return convert_string_list(complete.clang_complete_get_includer(filename.encode('utf-8')))
+
+@remote
+def index_file(index_path, filename, args):
+    complete.clang_complete_index_file(index_path.encode('utf-8'), filename.encode('utf-8'), convert_to_c_string_array(args), len(args))
+
+@remote
+def find_indexed_uses(index_path, usr):
+    return convert_string_list(complete.clang_complete_index_find_uses(index_path.encode('utf-8'), usr.encode('utf-8')))
+
+@remote
+def find_indexed_definition(index_path, usr):
+    return convert_string(complete.clang_complete_index_find_definition(index_path.encode('utf-8'), usr.encode('utf-8')))
+
+@remote
+def find_indexed_symbols(index_path, query, limit):
+    return [tuple(x.split('\n', 1)) for x in convert_string_list(complete.clang_complete_index_find_symbols(index_path.encode('utf-8'), query.encode('utf-8'), limit))]
+
+@remote
 def reparse(filename, args, unsaved_buffer):
     buffer = None
     if (unsaved_buffer is not None): buffer = unsaved_buffer.encode("utf-8")
@@ -80,8 +410,81 @@ def reparse(filename, args, unsaved_buffer):
 
     complete.clang_complete_reparse(filename.encode('utf-8'), convert_to_c_string_array(args), len(args), buffer, buffer_len)
 
+@remote
+def prefetch(filename, args):
+    complete.clang_complete_prefetch(filename.encode('utf-8'), convert_to_c_string_array(args), len(args))
+
+@remote
+def cancel_prefetch():
+    complete.clang_complete_cancel_prefetch()
+
+@remote
+def get_buffer_change_count(filename):
+    return complete.clang_complete_get_buffer_change_count(filename.encode('utf-8'))
+
+@remote
+def set_buffer(filename, change_count, buffer):
+    b = buffer.encode('utf-8')
+    complete.clang_complete_set_buffer(filename.encode('utf-8'), change_count, b, len(b))
+
+# Each edit is a tuple of the begin row and column, the end row and column,
+# and the replacement text, where columns are in utf-8 bytes
+@remote
+def edit_buffer(filename, change_count, new_change_count, edits, size):
+    f = filename.encode('utf-8')
+    for i, (begin_row, begin_col, end_row, end_col, text) in enumerate(edits):
+        last = i == len(edits) - 1
+        t = text.encode('utf-8')
+        if not complete.clang_complete_edit_buffer(f, change_count, new_change_count if last else change_count, begin_row, begin_col, end_row, end_col, t, len(t), size if last else -1):
+            return False
+    return True
+
+@remote
+def clear_buffer(filename):
+    complete.clang_complete_clear_buffer(filename.encode('utf-8'))
+
+@remote
 def free_tu(filename):
     complete.clang_complete_free_tu(filename.encode('utf-8'))
 
+@remote
 def free_all():
-    complete.clang_complete_free_all()
\ No newline at end of file
+    complete.clang_complete_free_all()
+
+@remote_setting
+def set_cache_budget(max_translation_units, max_memory_mb):
+    complete.clang_complete_set_cache_budget(max_translation_units, max_memory_mb)
+
+@remote_setting
+def set_ast_cache(path, max_size_mb):
+    complete.clang_complete_set_ast_cache(path.encode('utf-8'), max_size_mb)
+
+@remote_setting
+def set_fast_parse(enable):
+    complete.clang_complete_set_fast_parse(1 if enable else 0)
+
+@remote_setting
+def set_shared_pch(enable):
+    complete.clang_complete_set_shared_pch(1 if enable else 0)
+
+@remote
+def get_shared_pch(filename, args):
+    return convert_string(complete.clang_complete_get_shared_pch(filename.encode('utf-8'), convert_to_c_string_array(args), len(args)))
+
+@remote
+def get_metrics():
+    return json.loads(convert_string(complete.clang_complete_get_metrics()))
+
+# The resident memory of the process that runs libclang, which is the server
+# when there is one, along with its peak so far, both in bytes
+@remote
+def get_memory_usage():
+    # Only on unix
+    import resource
+    # In kilobytes on linux and bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() != 'Darwin': peak *= 1024
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * resource.getpagesize(), peak
+    except (IOError, OSError, ValueError):
+        return peak, peak
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2013, Paul Fultz II
+
+# Serves the complete.py api over a unix socket, so libclang runs outside of
+# the editor, and every window shares the same translation units.
+#
+# The server is a supervisor that owns the socket, and a worker that loads
+# libclang and answers the calls. When the worker crashes, the connections it
+# had are dropped, and the supervisor starts another worker on the same
+# socket. Once the worker has been idle for a while, both exit.
+#
+# Usage:
+#
+#   python server.py --socket /tmp/clangcomplete.sock
+
+import argparse, multiprocessing, os, signal, socket, subprocess, sys, threading, time
+
+import complete
+
+def handle_connection(conn, activity):
+    with conn:
+        while True:
+            try:
+                request = complete.recv_message(conn)
+            except (socket.error, EOFError):
+                return
+            if request is None: return
+            activity.touch()
+            name, args = request
+            try:
+                response = [True, complete.remote_functions[name](*args)]
+            except Exception as e:
+                response = [False, '%s: %s' % (type(e).__name__, e)]
+            try:
+                complete.send_message(conn, response)
+            except socket.error:
+                return
+            activity.touch()
+
+class Activity(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.last = time.time()
+
+    def touch(self):
+        self.last = time.time()
+
+    def open(self):
+        with self.lock:
+            self.connections += 1
+            self.last = time.time()
+
+    def close(self):
+        with self.lock:
+            self.connections -= 1
+            self.last = time.time()
+
+    def idle_time(self):
+        with self.lock:
+            if self.connections > 0: return 0
+            return time.time() - self.last
+
+def run_worker(fd, idle_timeout, nice):
+    # Parsing uses every core, at a lower priority than the editor
+    if nice > 0: os.nice(nice)
+    complete.set_worker_threads(multiprocessing.cpu_count())
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=fd)
+    activity = Activity()
+
+    def watch_idle():
+        while True:
+            time.sleep(min(idle_timeout, 10))
+            if activity.idle_time() > idle_timeout: os._exit(0)
+    if idle_timeout > 0: threading.Thread(target=watch_idle, daemon=True).start()
+
+    def serve(conn):
+        try:
+            handle_connection(conn, activity)
+        finally:
+            activity.close()
+
+    while True:
+        conn, address = listener.accept()
+        activity.open()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+# Binds the socket, unless another server is already listening on it
+def bind(path):
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return None
+        except socket.error:
+            os.unlink(path)
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(64)
+    return listener
+
+def run_supervisor(path, idle_timeout, nice):
+    listener = bind(path)
+    if listener is None: return
+    worker = None
+
+    def stop(signum, frame):
+        if worker is not None: worker.terminate()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    crashes = 0
+    try:
+        while True:
+            started = time.time()
+            worker = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                '--worker-fd', str(listener.fileno()), '--idle-timeout', str(idle_timeout), '--nice', str(nice)],
+                pass_fds=[listener.fileno()])
+            worker.wait()
+            # The worker only exits cleanly once it has been idle
+            if worker.returncode == 0: return
+            sys.stderr.write('clangcomplete: worker exited with %d, restarting\n' % worker.returncode)
+            # Back off when the worker keeps crashing right away
+            crashes = crashes + 1 if time.time() - started < 10 else 0
+            time.sleep(min(0.1 * 2 ** crashes, 10))
+    finally:
+        listener.close()
+        os.unlink(path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve libcomplete over a unix socket')
+    parser.add_argument('--socket', help='The path of the socket')
+    parser.add_argument('--idle-timeout', type=int, default=1800, help='Exit after this many seconds without connections, zero never exits')
+    parser.add_argument('--nice', type=int, default=5, help='How much to lower the priority of the worker')
+    parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker_fd is not None: run_worker(args.worker_fd, args.idle_timeout, args.nice)
+    elif args.socket is not None: run_supervisor(args.socket, args.idle_timeout, args.nice)
+    else: parser.error('The socket is needed')
+
+if __name__ == '__main__':
+    main()